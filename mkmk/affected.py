@@ -0,0 +1,110 @@
+#- Copyright 2014 GOTO 10.
+#- Licensed under the Apache License, Version 2.0 (see LICENSE).
+
+## Implements the 'affected' command.
+##
+## Given a set of changed files lists the make targets, outputs as well as
+## aliases and test runs, that have to be rebuilt because of them. This is done
+## by building an index from each path to the targets that are built from it,
+## through both the explicit dependencies and those computed by scanning
+## sources, and walking it from the changed files. Changing a build script
+## affects everything it declares, and everything at all if it can affect more
+## than its own nodes, by setting pervasive settings say, as does changing mkmk
+## itself. The targets are printed one per line such that they can be passed
+## straight to make.
+
+import os.path
+import subprocess
+import sys
+
+
+# Returns the list of files, relative to the current directory, that differ
+# between the given git revision and the working tree.
+def get_changed_files_since(rev):
+  output = subprocess.check_output(["git", "diff", "--name-only", "--relative",
+    rev, "--"])
+  return [line for line in output.splitlines() if line]
+
+
+# An index from paths to the targets that are built directly from them.
+class ReverseIndex(object):
+
+  def __init__(self):
+    self.dependents = {}
+    self.declared = {}
+    self.targets = set()
+    self.global_inputs = set()
+
+  # Records that the given target is built from the given paths and declared in
+  # the build script with the given path.
+  def add_target(self, target, inputs, script):
+    self.targets.add(target)
+    for path in inputs:
+      self.dependents.setdefault(os.path.relpath(path), set()).add(target)
+    if not script is None:
+      self.declared.setdefault(os.path.relpath(script), set()).add(target)
+
+  # Records that changes to the file with the given path affect all targets.
+  def add_global_input(self, path):
+    self.global_inputs.add(os.path.relpath(path))
+
+  # Returns the set of targets that are affected, directly or indirectly, by
+  # changes to the files with the given paths.
+  def get_affected(self, paths):
+    result = set()
+    pending = []
+    for path in paths:
+      path = os.path.relpath(path)
+      if path in self.global_inputs:
+        return set(self.targets)
+      pending.append(path)
+      for target in self.declared.get(path, []):
+        result.add(target)
+        pending.append(target)
+    while pending:
+      current = pending.pop()
+      for target in self.dependents.get(os.path.relpath(current), []):
+        if not target in result:
+          result.add(target)
+          pending.append(target)
+    return result
+
+
+# The main entry-point class for the affected command.
+class MkMkAffected(object):
+
+  def __init__(self, options, out=sys.stdout):
+    self.options = options
+    self.out = out
+
+  # Returns the reverse index of all the targets in the given environment.
+  def get_index(self, env):
+    result = ReverseIndex()
+    for node in env.all_nodes.values():
+      target = node.get_output_target()
+      if not target:
+        continue
+      script = node.get_context().get_script()
+      if not script is None:
+        script = script.get_path()
+      result.add_target(target, env.get_node_input_paths(node), script)
+    import makefile
+    for (path, digest) in env.get_scripts():
+      if makefile.may_have_global_effects(path):
+        result.add_global_input(path)
+    for path in makefile.get_mkmk_sources():
+      result.add_global_input(path)
+    return result
+
+  # Prints the targets affected by changes to the given files, and by the
+  # changes since the revision given by --since if there is one.
+  def run(self, files):
+    files = list(files)
+    if self.options.since:
+      files += get_changed_files_since(self.options.since)
+    import makefile
+    runner = makefile.MkMkMakefile(self.options)
+    (env, bindir) = runner.get_environment()
+    index = self.get_index(env)
+    for target in sorted(index.get_affected(files)):
+      self.out.write("%s\n" % target)
@@ -12,23 +12,87 @@ class Command(object):
   def __init__(self, *parts):
     self.parts = parts
     self.comment = None
+    self.jobserver = False
+    self.pool = None
+    self.trace_name = None
 
   def set_comment(self, comment):
     self.comment = comment
     return self
 
+  # Marks this command as taking part in make's jobserver. Make passes the
+  # jobserver on to such commands, and runs them even with -n, so they can run
+  # jobs of their own within the budget of the toplevel make.
+  def set_jobserver(self, value):
+    self.jobserver = value
+    return self
+
+  # Sets the name of the job pool to run this command within.
+  def set_pool(self, name):
+    self.pool = name
+    return self
+
+  # Sets the name under which this command is recorded when tracing.
+  def set_trace_name(self, name):
+    self.trace_name = name
+    return self
+
+  # Does this command have to be run through the trace or pool scripts?
+  def needs_wrapping(self, env):
+    return (self.trace_name and env.is_tracing()) or self.pool
+
+  # Wraps the given line in the scripts that record it in the trace and run it
+  # within its pool, if required.
+  def wrap_line(self, env, line):
+    if self.trace_name and env.is_tracing():
+      line = env.wrap_in_trace(self.trace_name, line)
+    if self.pool:
+      line = env.wrap_in_pool(self.pool, line)
+    return line
+
   @staticmethod
   def empty():
     return Command()
 
   def get_actions(self, env):
+    if env.is_lean():
+      return self.get_lean_actions(env)
     parts = list(self.parts)
+    # The parts are traced and take their pool slot as a whole, otherwise each
+    # would be recorded and scheduled as a job of its own.
+    if parts and self.needs_wrapping(env):
+      parts = [self.wrap_line(env, join_parts(parts))]
     if not env.is_noisy():
       parts = ["@%s" % a for a in parts]
+    if self.jobserver:
+      parts = ["+%s" % a for a in parts]
     if self.comment:
       parts = ["@echo '%s'" % self.comment] + parts
     return parts
 
+  # Returns the actions folded into a single recipe line such that make only
+  # has to spawn one shell to execute them.
+  def get_lean_actions(self, env):
+    parts = list(self.parts)
+    if self.comment:
+      parts = ["echo '%s'" % self.comment] + parts
+    if not parts:
+      return []
+    line = self.wrap_line(env, join_parts(parts))
+    if not env.is_noisy():
+      line = "@%s" % line
+    if self.jobserver:
+      line = "+%s" % line
+    return [line]
+
+# Joins the given command lines into one that runs them in turn, stopping at the
+# first that fails. Each part is grouped so operators within it don't bind to
+# the parts around it.
+def join_parts(parts):
+  if len(parts) == 1:
+    return parts[0]
+  return " && ".join(["{ %s; }" % part for part in parts])
+
 # Escapes a string such that it can be passed as an argument in a shell command.
 def shell_escape(s):
   return re.sub(r'([\s()\\])', r"\\\g<1>", s)
@@ -0,0 +1,223 @@
+#- Copyright 2014 GOTO 10.
+#- Licensed under the Apache License, Version 2.0 (see LICENSE).
+
+## Implements the 'critical-path' command.
+##
+## Combines the build graph with the durations recorded by previous builds to
+## find the chain of targets that bounds how fast the build can be with
+## unlimited parallelism. For every target it reports the slack, how much
+## longer it could take without making the build longer, and for the targets on
+## the critical path how much faster the build would be if the target took no
+## time at all. Making a target with slack faster doesn't help, so this tells
+## where optimization effort actually shortens the wall time.
+
+import heapq
+import history
+import sys
+
+
+# Differences in time smaller than this are rounding errors.
+_EPSILON = 1e-6
+
+
+# Returns the outputs in the given graph, a map from outputs to the outputs
+# they're built from, ordered such that every output comes after the outputs it
+# depends on.
+def get_topological_order(deps):
+  result = []
+  visited = set()
+  for root in sorted(deps.keys()):
+    stack = [(root, False)]
+    while stack:
+      (output, is_expanded) = stack.pop()
+      if is_expanded:
+        result.append(output)
+        continue
+      if output in visited:
+        continue
+      visited.add(output)
+      stack.append((output, True))
+      for dep in deps[output]:
+        if not dep in visited:
+          stack.append((dep, False))
+  return result
+
+
+# The timing analysis of a build graph. If the outputs depend on each other in a
+# cycle the cycle is broken at the dependency that closes it, the one that comes
+# later in the topological order, as when computing critical path costs for
+# scheduling.
+class CriticalPathAnalysis(object):
+
+  def __init__(self, deps, durations):
+    self.durations = durations
+    self.order = get_topological_order(deps)
+    self.position = dict([(o, i) for (i, o) in enumerate(self.order)])
+    self.deps = {}
+    self.dependents = {}
+    for (output, inputs) in deps.items():
+      self.deps[output] = [d for d in inputs
+        if self.position[d] < self.position[output]]
+      for dep in self.deps[output]:
+        self.dependents.setdefault(dep, []).append(output)
+    # The earliest time each output can be done.
+    self.finish = history.get_critical_path_costs(self.deps,
+      lambda o: durations[o])
+    self.total = max(self.finish.values() + [0])
+    # The longest time from each output being done to the build being done.
+    self.tail = {}
+    for output in reversed(self.order):
+      self.tail[output] = max([self.tail[d] + durations[d]
+        for d in self.dependents.get(output, [])] + [0])
+    self.savings = None
+
+  # Returns the time the build takes with unlimited parallelism.
+  def get_total(self):
+    return self.total
+
+  # Returns how much longer the given output could take without making the
+  # build any longer.
+  def get_slack(self, output):
+    return self.total - (self.finish[output] + self.tail[output])
+
+  # Returns how much shorter the build would be if the given output took no
+  # time.
+  def get_saving(self, output):
+    if self.savings is None:
+      self.savings = self.calc_savings()
+    return self.savings[output]
+
+  # Returns a map from each output to how much shorter the build would be if it
+  # took no time. Without the output the build takes as long as the longest of
+  # the chains through it, now that much shorter, and the chains that avoid it.
+  # Chains follow the topological order so one that avoids an output either
+  # lies entirely before it in the order, entirely after it, or has a step that
+  # spans it, which means the longest chain avoiding each output can be found
+  # in a single sweep over the order.
+  def calc_savings(self):
+    count = len(self.order)
+    # The longest chain among the outputs before each position.
+    before = [0] * (count + 1)
+    for (index, output) in enumerate(self.order):
+      before[index + 1] = max(before[index], self.finish[output])
+    # The longest chain among the outputs from each position on.
+    after = [0] * (count + 1)
+    for index in reversed(range(count)):
+      output = self.order[index]
+      after[index] = max(after[index + 1], self.durations[output] + self.tail[output])
+    # The steps from a dependency to an output further on, as the position they
+    # start spanning at, the last position they span, and the longest chain
+    # that takes the step.
+    spans = []
+    for (output, deps) in self.deps.items():
+      end = self.position[output] - 1
+      longest = self.durations[output] + self.tail[output]
+      for dep in deps:
+        start = self.position[dep] + 1
+        if start <= end:
+          spans.append((start, end, self.finish[dep] + longest))
+    spans.sort()
+    result = {}
+    active = []
+    next_span = 0
+    for (index, output) in enumerate(self.order):
+      while (next_span < len(spans)) and (spans[next_span][0] <= index):
+        (start, end, length) = spans[next_span]
+        heapq.heappush(active, (-length, end))
+        next_span += 1
+      while active and (active[0][1] < index):
+        heapq.heappop(active)
+      avoiding = max(before[index], after[index + 1])
+      if active:
+        avoiding = max(avoiding, -active[0][0])
+      duration = self.durations[output]
+      result[output] = max(0, min(duration, self.total - avoiding))
+    return result
+
+  # Returns the chain of outputs, first to last, whose durations add up to the
+  # total.
+  def get_critical_path(self):
+    if not self.finish:
+      return []
+    current = max(self.order, key=lambda o: (self.finish[o], o))
+    result = [current]
+    while True:
+      start = self.finish[current] - self.durations[current]
+      candidates = [d for d in self.deps[current] if self.finish[d] >= start]
+      if not candidates:
+        break
+      current = max(candidates, key=lambda o: (self.finish[o], o))
+      result.append(current)
+    return list(reversed(result))
+
+
+# The main entry-point class for the critical-path command.
+class MkMkCriticalPath(object):
+
+  def __init__(self, options, out=sys.stdout):
+    self.options = options
+    self.out = out
+
+  # Returns a triple of the graph between the outputs of the nodes required by
+  # the given goals, including dependencies found by scanning sources, the full
+  # names of the nodes, and which outputs are phony.
+  def get_graph(self, env, goals):
+    if goals:
+      nodes = env.get_reachable_nodes(goals)
+    else:
+      nodes = env.all_nodes.values()
+    inputs = {}
+    names = {}
+    phonies = set()
+    for node in nodes:
+      output = node.get_output_target()
+      if not output:
+        continue
+      inputs[output] = env.get_node_input_paths(node)
+      names[output] = str(node.get_global_name())
+      if node.is_phony():
+        phonies.add(output)
+    deps = {}
+    for (output, paths) in inputs.items():
+      deps[output] = sorted(set([p for p in paths if p in inputs]))
+    return (deps, names, phonies)
+
+  def run(self, goals):
+    import makefile
+    runner = makefile.MkMkMakefile(self.options)
+    (env, bindir) = runner.get_environment()
+    (deps, names, phonies) = self.get_graph(env, goals)
+    build_history = history.BuildHistory(history.get_history_path(self.options.bindir))
+    durations = {}
+    unknown = 0
+    for output in deps.keys():
+      if output in phonies:
+        durations[output] = 0
+      else:
+        if build_history.get_duration(output) is None:
+          unknown += 1
+        durations[output] = build_history.get_expected_duration(output)
+    analysis = CriticalPathAnalysis(deps, durations)
+    path = analysis.get_critical_path()
+    self.out.write("Critical path: %.2fs over %i targets\n" %
+      (analysis.get_total(), len([o for o in path if not o in phonies])))
+    if unknown:
+      self.out.write("(%i targets have no recorded duration and count as the average)\n" % unknown)
+    self.out.write("\n")
+    for output in path:
+      if output in phonies:
+        continue
+      self.out.write("  %8.2fs  %s\n" % (durations[output], names[output]))
+    self.out.write("\n%10s %10s %10s  %s\n" % ("duration", "slack", "saving", "target"))
+    rows = []
+    for output in deps.keys():
+      if output in phonies:
+        continue
+      slack = analysis.get_slack(output)
+      saving = analysis.get_saving(output)
+      if saving < _EPSILON:
+        saving = 0
+      rows.append((-saving, slack, -durations[output], output))
+    for (saving, slack, duration, output) in sorted(rows)[:self.options.limit]:
+      self.out.write("%9.2fs %9.2fs %9.2fs  %s\n" % (-duration, slack, -saving,
+        names[output]))
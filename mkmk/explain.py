@@ -0,0 +1,223 @@
+#- Copyright 2014 GOTO 10.
+#- Licensed under the Apache License, Version 2.0 (see LICENSE).
+
+## Implements the 'explain' command.
+##
+## Tells why building a target would do any work. The build graph is walked the
+## way make walks the generated makefile, comparing the modification time of
+## each output with those of its inputs, which gives the set of outputs that are
+## out of date and why. The reasons are then traced back to the changes that
+## cause them, an input that is newer than the outputs built from it say, and
+## for each change we report where the build scripts picked up the input and
+## how many targets it causes to be rebuilt.
+
+import critical
+import os.path
+import sys
+
+
+# The output doesn't exist.
+MISSING_OUTPUT = "missing output"
+# An input is neither a file nor built by any target.
+MISSING_INPUT = "missing input"
+# An input has been modified since the output was built.
+NEWER_INPUT = "newer input"
+# An input is itself out of date so it will be rebuilt.
+REBUILT_INPUT = "rebuilt input"
+
+
+# Returns the modification time of the file with the given path, or None if it
+# doesn't exist.
+def get_modified_time(path):
+  try:
+    return os.path.getmtime(path)
+  except OSError:
+    return None
+
+
+# Works out which outputs in a build graph are out of date and why.
+class StalenessAnalysis(object):
+
+  def __init__(self, inputs, phonies):
+    self.inputs = inputs
+    self.phonies = phonies
+    self.dependents = {}
+    for (output, paths) in inputs.items():
+      for path in paths:
+        self.dependents.setdefault(path, set()).add(output)
+    deps = {}
+    for (output, paths) in inputs.items():
+      deps[output] = [p for p in paths if p in inputs]
+    self.reasons = {}
+    for output in critical.get_topological_order(deps):
+      self.reasons[output] = self.calc_reasons(output)
+
+  # Returns the list of (kind, path) pairs that make the given output out of
+  # date, given that its inputs have already been processed.
+  def calc_reasons(self, output):
+    result = []
+    is_phony = output in self.phonies
+    output_time = None
+    if not is_phony:
+      output_time = get_modified_time(output)
+      if output_time is None:
+        result.append((MISSING_OUTPUT, output))
+    for path in sorted(set(self.inputs[output])):
+      if path in self.inputs:
+        if self.is_stale(path):
+          result.append((REBUILT_INPUT, path))
+          continue
+        if path in self.phonies:
+          continue
+      input_time = get_modified_time(path)
+      if input_time is None:
+        if not path in self.inputs:
+          result.append((MISSING_INPUT, path))
+      elif (not output_time is None) and (input_time > output_time):
+        result.append((NEWER_INPUT, path))
+    return result
+
+  # Returns the list of (kind, path) pairs that make the given output out of
+  # date. The list is empty if the output is up to date.
+  def get_reasons(self, output):
+    return self.reasons[output]
+
+  def is_stale(self, output):
+    return len(self.reasons[output]) > 0
+
+  # Returns the outputs that will be rebuilt, excluding phony ones.
+  def get_stale_outputs(self):
+    return sorted([o for (o, r) in self.reasons.items()
+      if r and not o in self.phonies])
+
+  # Returns a map from the changes that cause outputs to be rebuilt, as
+  # (kind, path) pairs, to the outputs they directly affect.
+  def get_causes(self):
+    result = {}
+    for (output, reasons) in self.reasons.items():
+      for reason in reasons:
+        if reason[0] != REBUILT_INPUT:
+          result.setdefault(reason, []).append(output)
+    return result
+
+  # Returns the non-phony outputs that will be rebuilt because the given stale
+  # outputs are, including themselves. Other outputs built from the same inputs
+  # may be up to date, or stale for other reasons, so rather than everything
+  # downstream of a change this is only what the change itself causes to be
+  # rebuilt.
+  def get_downstream(self, outputs):
+    result = set(outputs)
+    pending = list(outputs)
+    while pending:
+      current = pending.pop()
+      for output in self.dependents.get(current, []):
+        if not output in result:
+          result.add(output)
+          pending.append(output)
+    return set([o for o in result if not o in self.phonies])
+
+
+# The main entry-point class for the explain command.
+class MkMkExplain(object):
+
+  def __init__(self, options, out=sys.stdout):
+    self.options = options
+    self.out = out
+
+  # Returns a triple of the map from outputs to the paths they're built from,
+  # the nodes that produce the outputs, and which outputs are phony.
+  def get_graph(self, env, goals):
+    if goals:
+      nodes = env.get_reachable_nodes(goals)
+    else:
+      nodes = env.all_nodes.values()
+    inputs = {}
+    producers = {}
+    phonies = set()
+    for node in nodes:
+      output = node.get_output_target()
+      if not output:
+        continue
+      inputs[output] = env.get_node_input_paths(node)
+      producers[output] = node
+      if node.is_phony():
+        phonies.add(output)
+    return (inputs, producers, phonies)
+
+  # Returns a description of where the given node was declared.
+  def get_declaration(self, node):
+    script = node.get_context().get_script()
+    if script is None:
+      return "declared as %s" % node.get_full_name()
+    else:
+      return "declared in %s" % script.get_path()
+
+  # Returns a description of where the build scripts picked up the given path
+  # as an input to the given node.
+  def get_origin(self, node, path):
+    declared = self.get_declaration(node)
+    for edge in node.get_flat_edges():
+      if edge.get_target().get_input_file().get_path() == path:
+        return declared
+    origin = node.get_computed_dependency_origin(path)
+    if origin is None:
+      return declared
+    return "%s, %s" % (origin, declared)
+
+  # Prints the chain of rebuilt inputs that makes the given output out of date.
+  def write_chain(self, analysis, output, indent, seen):
+    for (kind, path) in analysis.get_reasons(output):
+      if kind == REBUILT_INPUT:
+        if path in seen:
+          continue
+        seen.add(path)
+        self.out.write("%s%s will be rebuilt\n" % (indent, path))
+        self.write_chain(analysis, path, indent + "  ", seen)
+      elif kind == NEWER_INPUT:
+        self.out.write("%s%s is newer\n" % (indent, path))
+      elif kind == MISSING_INPUT:
+        self.out.write("%s%s is missing\n" % (indent, path))
+      else:
+        self.out.write("%s%s doesn't exist\n" % (indent, path))
+
+  def run(self, goals):
+    import makefile
+    runner = makefile.MkMkMakefile(self.options)
+    (env, bindir) = runner.get_environment()
+    (inputs, producers, phonies) = self.get_graph(env, goals)
+    analysis = StalenessAnalysis(inputs, phonies)
+    for goal in goals:
+      node = env.find_goal(goal)
+      if node is None:
+        self.out.write("Unknown target %s\n" % goal)
+        continue
+      output = node.get_output_target()
+      if not output:
+        self.out.write("%s has no target, nothing is built for it\n" % goal)
+      elif not analysis.is_stale(output):
+        self.out.write("%s is up to date\n" % goal)
+      else:
+        self.out.write("%s is out of date:\n" % goal)
+        self.write_chain(analysis, output, "  ", set())
+      self.out.write("\n")
+    stale = analysis.get_stale_outputs()
+    total = len([o for o in inputs.keys() if not o in phonies])
+    self.out.write("%i of %i targets are out of date\n" % (len(stale), total))
+    rows = []
+    for ((kind, path), outputs) in analysis.get_causes().items():
+      downstream = analysis.get_downstream(outputs)
+      rows.append((-len(downstream), path, kind, sorted(outputs)))
+    for (count, path, kind, outputs) in sorted(rows)[:self.options.limit]:
+      if kind == MISSING_OUTPUT:
+        self.out.write("\n  %s doesn't exist\n" % path)
+        self.out.write("    target %s\n" % self.get_declaration(producers[path]))
+      else:
+        if kind == NEWER_INPUT:
+          description = "is newer than %i of its outputs" % len(outputs)
+        else:
+          description = "is missing"
+        self.out.write("\n  %s %s\n" % (path, description))
+        output = outputs[0]
+        self.out.write("    brought in for %s: %s\n" % (output,
+          self.get_origin(producers[output], path)))
+      self.out.write("    %i targets will be rebuilt\n" % -count)
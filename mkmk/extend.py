@@ -39,3 +39,30 @@ class ToolController(object):
   @abstractmethod
   def get_tools(self, context):
     pass
+
+
+# A stand-in for the tool set of a given extension within a given context. The
+# extension's controller and the actual tool set are only created the first
+# time the tool set is used, so contexts that never touch an extension don't
+# pay for it. Any attribute access is forwarded to the underlying tool set.
+class LazyToolSet(object):
+
+  def __init__(self, env, name, context):
+    self._env = env
+    self._name = name
+    self._context = context
+    self._tools = None
+
+  # Returns the underlying tool set, creating it if necessary.
+  def _get_tools(self):
+    if self._tools is None:
+      controller = self._env.get_extension(self._name)
+      self._tools = controller.get_tools(self._context)
+    return self._tools
+
+  def __getattr__(self, name):
+    # Python looks up special methods like __getstate__ with getattr so don't
+    # let those force the tool set into existence.
+    if name.startswith("__"):
+      raise AttributeError(name)
+    return getattr(self._get_tools(), name)
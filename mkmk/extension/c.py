@@ -11,6 +11,7 @@ import os.path
 from ..command import Command, shell_escape
 from .. import extend
 from .. import node
+from .. import profiling
 import operator
 import re
 
@@ -61,6 +62,7 @@ class Settings:
     self.is_pervasive = is_pervasive
 
   def get(self, name, context, defawlt=None, only_sticky=False):
+    profiling.count("Settings.get calls")
     attrib = self.attribs.get(name, None)
     if (attrib is None) or (only_sticky and not attrib.is_sticky):
       if self.parent is None:
@@ -90,6 +92,39 @@ class Settings:
   def add_pervasive(self, name, *values, **restrictions):
     self.set(name, list(values), self.MODE_PERVASIVE, True, restrictions)
 
+  # Returns the number of values set for each setting so far. Values set later
+  # can be told apart from the ones set before by comparing against the mark.
+  def get_mark(self):
+    return dict([(n, len(s.values)) for (n, s) in self.attribs.items()])
+
+  # Returns the values set since the given mark as a map from setting names to
+  # (is_sticky, is_additive, values) triples.
+  def get_changes_since(self, mark):
+    result = {}
+    for (name, setting) in self.attribs.items():
+      values = setting.values[mark.get(name, 0):]
+      if values:
+        result[name] = (setting.is_sticky, setting.is_additive, values)
+    return result
+
+  # Inserts changes made elsewhere, starting from the given mark, as if they had
+  # been made at the time of the mark. The shifts map tells, for each setting,
+  # how many values have been inserted before the mark since it was taken.
+  # Returns a map from setting names to the number of values inserted.
+  def insert_changes(self, changes, mark, shifts):
+    result = {}
+    for (name, (is_sticky, is_additive, values)) in changes.items():
+      setting = self.attribs.get(name, None)
+      if setting is None:
+        setting = Setting(is_sticky, is_additive)
+        self.attribs[name] = setting
+      assert (setting.is_additive == is_additive)
+      assert (setting.is_sticky == is_sticky)
+      index = mark.get(name, 0) + shifts.get(name, 0)
+      setting.values[index:index] = values
+      result[name] = len(values)
+    return result
+
   def set(self, name, value, mode, is_additive, restrictions):
     if (mode == self.MODE_PERVASIVE) and (not self.is_pervasive):
       return self.parent.set(name, value, mode, is_additive, restrictions)
@@ -455,6 +490,10 @@ class ExecutableNode(AbstractNode):
     return self.get_toolchain().get_executable_compile_command(outpath, inpaths,
         obj_libs, self.settings)
 
+  # Linking can take a lot of memory so it gets its own pool.
+  def get_default_pool(self):
+    return "link"
+
   def get_run_command_builder(self, platform):
     executable = self.get_output_file().get_path()
     args = []
@@ -507,6 +546,9 @@ class SharedLibraryNode(AbstractNode):
     libs = self.get_libraries(platform)
     return self.get_toolchain().get_shared_library_compile_command(outpath, inpaths, libs, self.settings)
 
+  def get_default_pool(self):
+    return "link"
+
 
 class MessageResourceNode(AbstractNode):
 
@@ -577,9 +619,13 @@ class CSourceNode(AbstractNode):
   # source file.
   def get_included_headers(self):
     if self.headers is None:
-      self.headers = self.calc_included_headers()
+      with profiling.phase("header scanning"):
+        self.headers = self.calc_included_headers()
     return self.headers
 
+  def invalidate(self):
+    self.headers = None
+
   # Returns the string paths of all the includepaths.
   def get_include_paths(self):
     return [i.get_path() for i in self.get_local_includes()] + sorted(self.system_includes)
@@ -593,8 +639,10 @@ class CSourceNode(AbstractNode):
       result += inc.get_input_files()
     return sorted(result)
 
-  # Calculates the list of handles of files included by this source file.
-  def calc_included_headers(self):
+  # Calculates the list of handles of files included by this source file. If a
+  # map of includers is given it is filled with the path of the file each
+  # header was first found to be included from.
+  def calc_included_headers(self, includers=None):
     headers = set()
     files_scanned = set()
     folders = [self.handle.get_parent()] + self.get_local_includes()
@@ -606,10 +654,10 @@ class CSourceNode(AbstractNode):
         return
       files_scanned.add(handle.get_path())
       for name in CSourceNode.get_include_names(handle):
-        resolve_include(name)
+        resolve_include(name, handle)
     # Looks for the source of a given include in the include paths and if found
     # recursively scans the file for includes.
-    def resolve_include(name):
+    def resolve_include(name, includer):
       if name in names_seen:
         return
       names_seen.add(name)
@@ -618,11 +666,27 @@ class CSourceNode(AbstractNode):
         if candidate.exists():
           if not candidate in headers:
             headers.add(candidate)
+            if not includers is None:
+              includers[candidate.get_path()] = includer.get_path()
             scan_file(candidate)
           return
     scan_file(self.handle)
     return sorted(list(headers))
 
+  # Returns the chain of paths through which the header with the given path is
+  # included into this source file, starting with the file that includes the
+  # header and ending with this source file, or None if it isn't included.
+  def get_include_chain(self, path):
+    includers = {}
+    self.calc_included_headers(includers)
+    if not path in includers:
+      return None
+    result = []
+    while path in includers:
+      path = includers[path]
+      result.append(path)
+    return result
+
   # Add a folder to the include paths required by this source file. Adding the
   # same path more than once is safe.
   def add_include(self, path):
@@ -665,7 +729,7 @@ class ObjectNode(AbstractNode):
     info = self.context.get_library_info(lib)
     system = self.context.get_system()
     instance = info.get_instance(system.get_os())
-    instance.ensure_auto_resolved(system)
+    self.context.ensure_library_resolved(instance)
     for inc in instance.get_includes():
       self.source.add_system_include(inc)
     for lib in instance.get_libs():
@@ -692,6 +756,12 @@ class ObjectNode(AbstractNode):
   def get_computed_dependencies(self):
     return self.get_source().get_included_headers()
 
+  def get_computed_dependency_origin(self, path):
+    chain = self.get_source().get_include_chain(path)
+    if chain is None:
+      return None
+    return "included by %s" % " <- ".join(chain)
+
 
 # Node that represents the action of printing the build environment to stdout.
 class EnvPrinterNode(AbstractNode):
@@ -711,21 +781,28 @@ class CTools(extend.ToolSet):
   def __init__(self, controller, context):
     super(CTools, self).__init__(context)
     self.controller = controller
-    self.settings = self.new_settings(context)
+    self.settings = CTools.get_settings_from_context(context)
 
-  def new_settings(self, context):
+  @staticmethod
+  def new_settings(context):
     parent_context = context.get_parent()
     if parent_context is None:
       parent_settings = CTools.get_or_create_settings_from_env(context)
     else:
       parent_settings = CTools.get_settings_from_context(parent_context)
     result = Settings(parent_settings)
-    context.set_attribute(self.SETTINGS_KEY, result)
+    context.set_attribute(CTools.SETTINGS_KEY, result)
     return result
 
+  # Returns the settings for the given context. Tool sets are created lazily so
+  # the settings of a parent context may not exist yet when a child needs them,
+  # in which case they're created on demand.
   @staticmethod
   def get_settings_from_context(context):
-    return context.get_attribute(CTools.SETTINGS_KEY)
+    result = context.get_attribute(CTools.SETTINGS_KEY)
+    if result is None:
+      result = CTools.new_settings(context)
+    return result
 
   @staticmethod
   def get_or_create_settings_from_env(context):
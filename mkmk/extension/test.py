@@ -24,6 +24,11 @@ class ExecTestCaseNode(node.CustomExecNode):
   def should_tee_output(self):
     return True
 
+  # Tests, particularly under valgrind, can be heavy so they can be limited
+  # separately.
+  def get_default_pool(self):
+    return "test"
+
 
 
 # The tools for working with C. Available in mkmk files as "c".
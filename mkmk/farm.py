@@ -0,0 +1,640 @@
+#- Copyright 2014 GOTO 10.
+#- Licensed under the Apache License, Version 2.0 (see LICENSE).
+
+## A native build coordinator that spreads the commands of a build across a
+## pool of long-lived worker processes.
+##
+## Rather than writing a makefile the coordinator works out itself which
+## targets are out of date and hands their commands to workers over unix or tcp
+## sockets. The workers are assumed to share the file system with the
+## coordinator: they run the commands in the same folder and the coordinator
+## checks the outputs they produce. Each worker runs one job at a time and
+## reports back with the output of the commands and how long they took.
+##
+## Messages are json objects, one per line. The coordinator sends
+##
+##   {"id": 4, "cwd": "/path", "lines": ["mkdir -p out", "cc -c ..."]}
+##
+## and the worker runs the lines in order, stopping at the first that fails,
+## and responds with
+##
+##   {"id": 4, "status": 0, "output": "...", "start": 1.0, "end": 2.5,
+##    "peak_rss": 20480}
+##
+## where peak_rss is the largest resident set size, in kilobytes, of any of the
+## processes that ran, if the worker can measure it.
+
+import bisect
+import critical
+import history
+import json
+import logging
+import multiprocessing
+import os
+import os.path
+import progress
+import re
+import select
+import socket
+import subprocess
+import sys
+import time
+
+
+# How often, in seconds, to check for a free job slot when waiting for the
+# jobserver.
+_SLOT_POLL_INTERVAL = 0.05
+
+
+# The values make gives the variables used in commands if they're not set in
+# the environment.
+_MAKE_DEFAULTS = {
+  "CC": "cc",
+  "CXX": "g++",
+}
+
+
+# Expands the make variable references and escapes in the given recipe line such
+# that it can be executed directly by the shell.
+def expand_make_variables(line, environ):
+  def replace(match):
+    if match.group(1) == "$":
+      return "$"
+    name = match.group(2)
+    return environ.get(name, _MAKE_DEFAULTS.get(name, ""))
+  return re.sub(r'\$(\$|\((\w+)\))', replace, line)
+
+
+# Returns a (family, address) pair for the given address string which is either
+# "unix:<path>" or "<host>:<port>".
+def parse_address(address):
+  if address.startswith("unix:"):
+    return (socket.AF_UNIX, address[len("unix:"):])
+  (host, port) = address.rsplit(":", 1)
+  return (socket.AF_INET, (host, int(port)))
+
+
+# Wraps a socket and reads and writes json messages, one per line.
+class MessageChannel(object):
+
+  def __init__(self, sock):
+    self.sock = sock
+    self.buffer = ""
+
+  def fileno(self):
+    return self.sock.fileno()
+
+  def send(self, message):
+    self.sock.sendall("%s\n" % json.dumps(message))
+
+  # Reads the next message, blocking until it has arrived. Returns None if the
+  # other end has closed the connection.
+  def receive(self):
+    while not "\n" in self.buffer:
+      chunk = self.sock.recv(65536)
+      if not chunk:
+        return None
+      self.buffer += chunk
+    (line, self.buffer) = self.buffer.split("\n", 1)
+    return json.loads(line)
+
+  def close(self):
+    self.sock.close()
+
+
+# A single step of the build: the commands that produce an output from a set of
+# inputs.
+class BuildStep(object):
+
+  def __init__(self, output, inputs, commands, is_phony, pool=None, name=None):
+    self.output = output
+    self.name = name or output
+    self.inputs = inputs
+    self.commands = commands
+    self.is_phony = is_phony
+    self.pool = pool
+
+  def get_output(self):
+    return self.output
+
+  def get_inputs(self):
+    return self.inputs
+
+  # Returns the full name of the node this step builds.
+  def get_name(self):
+    return self.name
+
+  # Returns the name of the job pool this step runs within, or None.
+  def get_pool(self):
+    return self.pool
+
+  # Returns the comments to display when running this step.
+  def get_comments(self):
+    return [c.comment for c in self.commands if c.comment]
+
+  # Returns the shell lines to execute to run this step.
+  def get_lines(self, environ):
+    result = []
+    for command in self.commands:
+      for part in command.parts:
+        result.append(expand_make_variables(part, environ))
+    return result
+
+  # Does the output of this step have to be regenerated?
+  def is_out_of_date(self):
+    if self.is_phony or not os.path.exists(self.output):
+      return True
+    output_time = os.path.getmtime(self.output)
+    for path in self.inputs:
+      if os.path.exists(path) and os.path.getmtime(path) > output_time:
+        return True
+    return False
+
+
+# Returns the outputs of the steps that build the given goals, which like for the
+# makefile can be either targets or the full names of nodes. Goals that don't
+# name a node with an output are passed through unchanged.
+def get_goal_outputs(env, goals):
+  result = []
+  for goal in goals:
+    node = env.find_goal(goal)
+    if (not node is None) and node.get_output_target():
+      result.append(node.get_output_target())
+    else:
+      result.append(goal)
+  return result
+
+
+# Returns a map from output paths to the build steps for the given environment,
+# the same steps the makefile would contain. Only the nodes required by the
+# given goals are included if there are any.
+def get_build_steps(env, bindir, goals):
+  system = env.get_system()
+  result = {}
+  if goals:
+    nodes = env.get_reachable_nodes(goals)
+  else:
+    nodes = env.all_nodes.values()
+  for node in nodes:
+    output = node.get_output_target()
+    if not output:
+      continue
+    commands = []
+    output_file = node.get_output_file()
+    if not output_file is None:
+      output_parent = output_file.get_parent().get_path()
+      commands.append(system.get_ensure_folder_command(output_parent))
+    process_command = node.get_command_line(system)
+    if not process_command is None:
+      commands.append(process_command)
+    inputs = env.get_node_input_paths(node)
+    pool = env.get_node_pool(node)
+    result[output] = BuildStep(output, inputs, commands, node.is_phony(), pool,
+      str(node.get_full_name()))
+  clean_command = system.get_clear_folder_command(bindir.get_path())
+  result["clean"] = BuildStep("clean", [], [clean_command], True)
+  return result
+
+
+# Runs jobs sent by a coordinator. A worker serves one coordinator at a time and
+# keeps running after the coordinator disconnects, waiting for the next one.
+class Worker(object):
+
+  def __init__(self, address):
+    self.address = address
+
+  # Runs the given shell line and returns a triple of its output, exit status
+  # and peak resident set size in kilobytes, or None if that can't be measured.
+  @staticmethod
+  def run_line(line, cwd):
+    process = subprocess.Popen(line, shell=True, cwd=cwd,
+      stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    output = process.stdout.read()
+    process.stdout.close()
+    if not hasattr(os, "wait4"):
+      process.wait()
+      return (output, process.returncode, None)
+    # The resource usage reported for the shell covers the processes it waited
+    # for, so this is the peak of the command itself.
+    (pid, status, usage) = os.wait4(process.pid, 0)
+    if os.WIFSIGNALED(status):
+      process.returncode = -os.WTERMSIG(status)
+    else:
+      process.returncode = os.WEXITSTATUS(status)
+    return (output, process.returncode, usage.ru_maxrss)
+
+  # Runs the given job and returns the response to send back.
+  def run_job(self, job):
+    start = time.time()
+    outputs = []
+    status = 0
+    peak_rss = None
+    for line in job["lines"]:
+      (output, status, line_rss) = self.run_line(line, job["cwd"])
+      outputs.append(output)
+      if (peak_rss is None) or (line_rss > peak_rss):
+        peak_rss = line_rss
+      if status != 0:
+        break
+    return {
+      "id": job["id"],
+      "status": status,
+      "output": "".join(outputs).decode("utf-8", "replace"),
+      "start": start,
+      "end": time.time(),
+      "peak_rss": peak_rss
+    }
+
+  # Serves the given connection until the coordinator closes it.
+  def serve_connection(self, channel):
+    while True:
+      job = channel.receive()
+      if job is None:
+        return
+      channel.send(self.run_job(job))
+
+  def run(self):
+    (family, address) = parse_address(self.address)
+    if family == socket.AF_UNIX and os.path.exists(address):
+      os.remove(address)
+    server = socket.socket(family, socket.SOCK_STREAM)
+    server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    server.bind(address)
+    server.listen(1)
+    try:
+      while True:
+        (connection, peer) = server.accept()
+        channel = MessageChannel(connection)
+        try:
+          self.serve_connection(channel)
+        except socket.error, e:
+          logging.warning("Lost connection to coordinator: %s", e)
+        finally:
+          channel.close()
+    finally:
+      server.close()
+
+
+# Entry-point for local worker processes.
+def run_worker(address):
+  try:
+    Worker(address).run()
+  except KeyboardInterrupt:
+    pass
+
+
+# A set of worker processes running on this machine, listening on unix sockets
+# in the given folder.
+class LocalWorkers(object):
+
+  def __init__(self, count, folder):
+    self.addresses = []
+    self.processes = []
+    if not os.path.exists(folder):
+      os.makedirs(folder)
+    for index in range(0, count):
+      path = os.path.join(folder, "worker-%i.sock" % index)
+      if os.path.exists(path):
+        os.remove(path)
+      address = "unix:%s" % path
+      process = multiprocessing.Process(target=run_worker, args=(address,))
+      process.daemon = True
+      process.start()
+      self.addresses.append(address)
+      self.processes.append(process)
+
+  def get_addresses(self):
+    return self.addresses
+
+  def stop(self):
+    for process in self.processes:
+      process.terminate()
+      process.join()
+
+
+# Connects to the worker at the given address, retrying for a while in case the
+# worker is still starting up.
+def connect_to_worker(address, timeout=10):
+  (family, sockaddr) = parse_address(address)
+  deadline = time.time() + timeout
+  while True:
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    try:
+      sock.connect(sockaddr)
+      return MessageChannel(sock)
+    except socket.error:
+      sock.close()
+      if time.time() > deadline:
+        raise
+      time.sleep(0.05)
+
+
+# Schedules the steps of a build across a set of workers, starting a step as
+# soon as all the steps that produce its inputs have completed.
+class BuildCoordinator(object):
+
+  def __init__(self, steps, noisy=False, out=sys.stdout, jobserver=None,
+      pools={}, history=None, memory_budget=None, progress_out=None):
+    self.steps = steps
+    self.pools = pools
+    self.history = history
+    # The most memory, in kilobytes, that the jobs running at the same time are
+    # predicted to use, or None if there is no limit.
+    self.memory_budget = memory_budget
+    # The stream to write progress events to, or None.
+    self.progress_out = progress_out
+    self.progress = None
+    self.noisy = noisy
+    self.out = out
+    self.jobserver = jobserver
+    # The jobserver tokens held on top of the one implicit job slot.
+    self.tokens = []
+    self.environ = dict(os.environ)
+    self.cwd = os.getcwd()
+    # The (output, worker address, start, end, status) of each job run.
+    self.results = []
+
+  # Returns the outputs of the steps that must be considered to build the given
+  # goals, or everything but clean if there are none.
+  def get_required_outputs(self, goals):
+    if goals:
+      pending = list(goals)
+    else:
+      pending = [o for o in self.steps.keys() if o != "clean"]
+    result = set()
+    while pending:
+      output = pending.pop()
+      if output in result:
+        continue
+      if not output in self.steps:
+        raise BuildError("No rule to make target '%s'" % output)
+      result.add(output)
+      for path in self.steps[output].get_inputs():
+        if path in self.steps:
+          pending.append(path)
+        elif not os.path.exists(path):
+          raise BuildError("No rule to make target '%s', needed by '%s'" % (path, output))
+    return result
+
+  # Builds the given goals using the workers at the given addresses. Returns
+  # True iff all steps succeeded.
+  def run(self, goals, addresses):
+    required = self.get_required_outputs(goals)
+    # Map each step to the number of inputs still to be built and each output to
+    # the steps waiting for it. Steps only become ready once everything they
+    # depend on is done, and only steps that have work to do are kept in the
+    # ready list.
+    self.waiting = {}
+    self.dependents = {}
+    self.ready = []
+    self.running = {}
+    initial = []
+    for output in sorted(required):
+      deps = [p for p in set(self.steps[output].get_inputs()) if p in required]
+      self.waiting[output] = len(deps)
+      for dep in deps:
+        self.dependents.setdefault(dep, []).append(output)
+      if not deps:
+        initial.append(output)
+    self.costs = {}
+    if not self.history is None:
+      inputs = dict([(o, self.steps[o].get_inputs()) for o in required])
+      self.costs = history.get_critical_path_costs(inputs, self.get_expected_duration)
+    if not self.progress_out is None:
+      planned = self.get_planned_outputs(required)
+      self.progress = progress.ProgressReporter(self.progress_out, len(planned),
+        self.get_expected_duration, len(addresses))
+      self.progress.build_started(planned)
+    for output in initial:
+      self.make_ready(output)
+    idle = [connect_to_worker(address) for address in addresses]
+    addresses = dict([(channel, address) for (channel, address) in zip(idle, addresses)])
+    failed = False
+    next_id = 0
+    try:
+      while self.ready or self.running:
+        blocked = False
+        while self.ready and idle and not failed:
+          index = self.find_startable()
+          if index is None:
+            break
+          if not self.acquire_slot(len(self.running)):
+            blocked = True
+            break
+          output = self.ready.pop(index)
+          step = self.steps[output]
+          for comment in step.get_comments():
+            self.out.write("%s\n" % comment)
+          lines = step.get_lines(self.environ)
+          if self.noisy:
+            for line in lines:
+              self.out.write("%s\n" % line)
+          channel = idle.pop()
+          next_id += 1
+          channel.send({"id": next_id, "cwd": self.cwd, "lines": lines})
+          self.running[channel] = output
+          if not self.progress is None:
+            self.progress.target_started(output, step.get_name())
+        if not self.running:
+          break
+        # If we're waiting for a job slot poll the jobserver periodically.
+        timeout = None
+        if blocked:
+          timeout = _SLOT_POLL_INTERVAL
+        (readable, writable, errors) = select.select(list(self.running.keys()),
+          [], [], timeout)
+        for channel in readable:
+          output = self.running.pop(channel)
+          self.release_surplus_slots(len(self.running))
+          response = channel.receive()
+          if response is None:
+            raise BuildError("Lost connection to worker %s" % addresses[channel])
+          idle.append(channel)
+          self.out.write(response["output"].encode("utf-8"))
+          self.results.append((output, addresses[channel], response["start"],
+            response["end"], response["status"]))
+          duration = response["end"] - response["start"]
+          if response["status"] == 0:
+            if not self.history is None:
+              self.history.record(output, duration, response.get("peak_rss", None))
+            if not self.progress is None:
+              self.progress.target_finished(output, duration)
+            self.complete(output)
+          else:
+            self.out.write("Failed to build '%s' (exit status %i)\n" %
+              (output, response["status"]))
+            if not self.progress is None:
+              self.progress.target_failed(output, response["status"])
+            failed = True
+    finally:
+      for channel in idle + list(self.running.keys()):
+        channel.close()
+      self.release_surplus_slots(0)
+      if not self.progress is None:
+        self.progress.build_finished(not failed and not self.ready and not self.running)
+    return not failed and not self.ready
+
+  # Returns the required outputs whose commands are expected to run: those that
+  # are out of date now and those that depend on outputs that will be rebuilt.
+  def get_planned_outputs(self, required):
+    deps = {}
+    for output in required:
+      deps[output] = [p for p in self.steps[output].get_inputs() if p in required]
+    rebuilt = set()
+    for output in critical.get_topological_order(deps):
+      if self.steps[output].is_out_of_date() or any([d in rebuilt for d in deps[output]]):
+        rebuilt.add(output)
+    return sorted([o for o in rebuilt if self.steps[o].get_lines(self.environ)])
+
+  # Writes the jobs run so far to a trace at the given path. Each worker is a
+  # job slot.
+  def write_trace(self, path, addresses):
+    import timeline
+    slots = dict([(address, index) for (index, address) in enumerate(addresses)])
+    events = []
+    for (output, address, start, end, status) in self.results:
+      args = {"output": output, "worker": address, "status": status}
+      name = self.steps[output].get_name()
+      events.append(timeline.TraceEvent(name, start, end, slots[address], args))
+    timeline.write_trace(path, events)
+
+  # Returns the index of the first ready step that can start without exceeding
+  # the depth of its pool or the memory budget, or None if there is none.
+  def find_startable(self):
+    in_use = {}
+    memory = 0
+    for output in self.running.values():
+      pool = self.steps[output].get_pool()
+      in_use[pool] = in_use.get(pool, 0) + 1
+      memory += self.get_predicted_rss(output)
+    for (index, output) in enumerate(self.ready):
+      pool = self.steps[output].get_pool()
+      if (not pool is None) and (in_use.get(pool, 0) >= self.pools[pool]):
+        continue
+      # A job is always allowed to run on its own, even if it's predicted to
+      # need more than the budget, otherwise it would never run.
+      if ((not self.memory_budget is None) and self.running and
+          (memory + self.get_predicted_rss(output) > self.memory_budget)):
+        continue
+      return index
+    return None
+
+  # Returns the number of seconds the step for the given output is expected to
+  # take.
+  def get_expected_duration(self, output):
+    if self.steps[output].is_phony or (self.history is None):
+      return 0
+    return self.history.get_expected_duration(output)
+
+  # Returns the number of kilobytes of memory the given output is expected to
+  # need while building, based on previous builds. Outputs that haven't been
+  # built before are assumed to need as much as the average.
+  def get_predicted_rss(self, output):
+    if self.history is None:
+      return 0
+    result = self.history.get_peak_rss(output)
+    if result is None:
+      result = self.history.get_average_peak_rss()
+    return result or 0
+
+  # Ensures that there is a job slot for one more job when the given number of
+  # jobs are already running. Without a jobserver there's no limit beyond the
+  # number of workers. Returns True if there is a slot.
+  def acquire_slot(self, running_count):
+    if (self.jobserver is None) or (running_count < len(self.tokens) + 1):
+      return True
+    token = self.jobserver.try_acquire()
+    if token is None:
+      return False
+    self.tokens.append(token)
+    return True
+
+  # Returns any tokens beyond what the given number of running jobs need to the
+  # jobserver.
+  def release_surplus_slots(self, running_count):
+    while len(self.tokens) > max(running_count - 1, 0):
+      self.jobserver.release(self.tokens.pop())
+
+  # Called when all the steps the given output depends on are done. If the step
+  # has work to do it's added to the ready list, otherwise it's done too.
+  def make_ready(self, output):
+    step = self.steps[output]
+    if step.is_out_of_date() and step.get_lines(self.environ):
+      # Keep the ready list ordered by descending cost so the steps on the
+      # longest chains start first.
+      key = (-self.costs.get(output, 0), output)
+      index = bisect.bisect([(-self.costs.get(o, 0), o) for o in self.ready], key)
+      self.ready.insert(index, output)
+    else:
+      self.complete(output)
+
+  # Marks the given output as done and makes the steps that were only waiting
+  # for it ready.
+  def complete(self, output):
+    for dependent in self.dependents.get(output, []):
+      self.waiting[dependent] -= 1
+      if self.waiting[dependent] == 0:
+        self.make_ready(dependent)
+
+
+# Raised if a build can't be carried out.
+class BuildError(Exception):
+  pass
+
+
+# The main entry-point class for the farm command.
+class MkMkFarm(object):
+
+  def __init__(self, options):
+    self.options = options
+
+  # Returns the addresses of the workers to use, starting local workers if
+  # required. Returns a pair of the addresses and the local workers, if any.
+  def get_workers(self):
+    workers = self.options.workers
+    if workers is None:
+      workers = str(multiprocessing.cpu_count())
+    if workers.isdigit():
+      folder = os.path.join(self.options.bindir, "workers")
+      local = LocalWorkers(int(workers), folder)
+      return (local.get_addresses(), local)
+    else:
+      return (workers.split(","), None)
+
+  # Builds the given goals, returns True on success.
+  def run(self, goals):
+    import makefile
+    runner = makefile.MkMkMakefile(self.options)
+    (env, bindir) = runner.get_environment()
+    steps = get_build_steps(env, bindir, goals)
+    outputs = get_goal_outputs(env, goals)
+    import jobserver
+    build_history = history.BuildHistory(history.get_history_path(self.options.bindir))
+    memory_budget = None
+    if not self.options.memory_budget is None:
+      memory_budget = self.options.memory_budget * 1024
+    progress_out = None
+    if self.options.progress:
+      # The progress file usually lives in the bindir which may not exist yet.
+      makefile.ensure_parent(self.options.progress)
+      progress_out = open(self.options.progress, "wt")
+    coordinator = BuildCoordinator(steps, env.is_noisy(),
+      jobserver=jobserver.get_jobserver(), pools=env.get_pools(),
+      history=build_history, memory_budget=memory_budget,
+      progress_out=progress_out)
+    (addresses, local) = self.get_workers()
+    try:
+      return coordinator.run(outputs, addresses)
+    except BuildError, e:
+      logging.error("%s", e)
+      return False
+    finally:
+      build_history.save()
+      if self.options.trace:
+        import timeline
+        coordinator.write_trace(timeline.get_trace_path(self.options.bindir),
+          addresses)
+      if not local is None:
+        local.stop()
+      if not progress_out is None:
+        progress_out.close()
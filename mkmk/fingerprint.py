@@ -0,0 +1,98 @@
+#- Copyright 2014 GOTO 10.
+#- Licensed under the Apache License, Version 2.0 (see LICENSE).
+
+## Implements the 'fingerprint' command.
+##
+## Computes a single digest of everything the given goals are built from: the
+## contents of the source files, headers and other files at the leaves of the
+## build graph, including test runners that aren't built, the command lines of
+## the steps with make variables expanded as they would be at build time, the
+## build scripts, the build flags and mkmk itself. If the digest is the same as
+## for a previous build then building the goals again will produce the same
+## result, so it can be used as a cache key for skipping builds or restoring
+## their outputs.
+
+import farm
+import gitindex
+import hashlib
+import logging
+import os
+import os.path
+import sys
+
+
+# Returns the hash git gives the contents of the file at the given path, such
+# that files hash the same whether or not the git index is used.
+def get_blob_hash(path):
+  digest = hashlib.sha1()
+  digest.update("blob %i\0" % os.path.getsize(path))
+  with open(path, "rb") as source:
+    while True:
+      block = source.read(65536)
+      if not block:
+        break
+      digest.update(block)
+  return digest.hexdigest()
+
+
+# The main entry-point class for the fingerprint command.
+class MkMkFingerprint(object):
+
+  def __init__(self, options, out=sys.stdout):
+    self.options = options
+    self.out = out
+
+  # Returns the sorted list of (kind, key, value) triples that determine the
+  # outputs of the given goals.
+  def get_entries(self, env, bindir, goals):
+    steps = farm.get_build_steps(env, bindir, goals)
+    del steps["clean"]
+    result = []
+    leaves = set()
+    for (output, step) in steps.items():
+      result.append(("command", output, "\n".join(step.get_lines(os.environ))))
+      for path in step.get_inputs():
+        if not path in steps:
+          leaves.add(path)
+    index = gitindex.get_index()
+    for path in leaves:
+      entry = None
+      if not index is None:
+        entry = index.get_entry(path)
+      if not entry is None:
+        # The index already has a hash of the contents.
+        result.append(("file", path, entry.get_blob()))
+      elif os.path.isfile(path):
+        result.append(("file", path, get_blob_hash(path)))
+      elif not os.path.exists(path):
+        result.append(("file", path, "missing"))
+    # Any script can set pervasive settings that change how the goals are built
+    # so all of them are included, not just the ones that declare the goals.
+    for (path, digest) in env.get_scripts():
+      result.append(("script", path, digest))
+    import makefile
+    package_root = os.path.dirname(os.path.abspath(makefile.__file__))
+    for path in makefile.get_mkmk_sources():
+      name = os.path.relpath(path, package_root)
+      result.append(("mkmk", name, get_blob_hash(path)))
+    result.append(("flags", "buildflags", self.options.buildflags or ""))
+    result.append(("flags", "system", self.options.system))
+    result.append(("flags", "extensions", " ".join(sorted(self.options.extension))))
+    return sorted(result)
+
+  # Prints the digest of the given goals, or of everything if there are none.
+  # Returns False if any of the goals are unknown.
+  def run(self, goals):
+    import makefile
+    runner = makefile.MkMkMakefile(self.options)
+    (env, bindir) = runner.get_environment()
+    unknown = [g for g in goals if env.find_goal(g) is None]
+    if unknown:
+      logging.error("Unknown targets: %s", " ".join(unknown))
+      return False
+    digest = hashlib.md5()
+    for (kind, key, value) in self.get_entries(env, bindir, goals):
+      digest.update("%s %s %s\n" % (kind, len(key), key))
+      digest.update("%s\n%s\n" % (len(value), value))
+    self.out.write("%s\n" % digest.hexdigest())
+    return True
@@ -0,0 +1,175 @@
+#- Copyright 2014 GOTO 10.
+#- Licensed under the Apache License, Version 2.0 (see LICENSE).
+
+## File metadata read in bulk from the index of a git checkout.
+##
+## Stat-ing and reading files one at a time is slow on network file systems.
+## In a git checkout the index already knows the size, modification time and
+## blob hash of every tracked file, so when enabled we read it with a single
+## call to git and let the file layer consult it before going to the file
+## system. Git itself works out which tracked files have been modified or
+## deleted since they were added to the index, using its own fast paths, and
+## those, along with untracked and generated files, are left to the file
+## system. The blob hash of a clean file is a hash of its contents, which we
+## use to tell whether attributes cached about it are still valid.
+
+import logging
+import os
+import os.path
+import subprocess
+
+
+# The kinds of paths the index can vouch for.
+FILE = "file"
+FOLDER = "folder"
+
+
+# Modes of index entries that are regular files. Symlinks and submodules are
+# left to the file system.
+_REGULAR_MODES = set(["100644", "100755"])
+
+
+# What the index knows about a single tracked file.
+class IndexEntry(object):
+
+  def __init__(self, blob, size, mtime):
+    self.blob = blob
+    self.size = size
+    self.mtime = mtime
+
+  # Returns the blob hash of the file's contents.
+  def get_blob(self):
+    return self.blob
+
+  def get_size(self):
+    return self.size
+
+  # Returns the modification time, in seconds, recorded when the file was last
+  # added to the index.
+  def get_modified_time(self):
+    return self.mtime
+
+
+# Runs git in the given folder with the given arguments and returns the output.
+def run_git(cwd, *args):
+  process = subprocess.Popen(["git"] + list(args), cwd=cwd,
+    stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+  (output, errors) = process.communicate()
+  if process.returncode != 0:
+    raise subprocess.CalledProcessError(process.returncode, "git", errors)
+  return output
+
+
+# Parses the output of "git ls-files -s --debug -z" into a map from paths,
+# relative to the root of the checkout, to index entries. Each entry is a
+# header line terminated by a nul followed by five debug lines.
+def parse_index(output):
+  result = {}
+  chunks = output.split("\0")
+  header = chunks[0]
+  for chunk in chunks[1:]:
+    parts = chunk.split("\n", 5)
+    if len(parts) < 6:
+      break
+    (meta, path) = header.split("\t", 1)
+    (mode, blob, stage) = meta.split(" ")
+    fields = {}
+    for line in parts[:5]:
+      for field in line.strip().split("\t"):
+        (name, value) = field.split(": ", 1)
+        fields[name] = value
+    if (mode in _REGULAR_MODES) and (stage == "0"):
+      (secs, nsecs) = fields["mtime"].split(":")
+      mtime = int(secs) + int(nsecs) / 1e9
+      result[path] = IndexEntry(blob, int(fields["size"]), mtime)
+    header = parts[5]
+  return result
+
+
+class GitIndex(object):
+
+  # Creates an index with the given entries for a checkout within which the
+  # current directory is at the given prefix. The paths of dirty entries are the
+  # ones that have changed since they were added.
+  def __init__(self, prefix, entries, dirty):
+    self.prefix = prefix
+    self.entries = entries
+    for path in dirty:
+      self.entries.pop(path, None)
+    self.folders = None
+
+  # Reads the index of the checkout the current directory is within. Returns
+  # None if it isn't within a checkout or git isn't available.
+  @staticmethod
+  def read():
+    try:
+      root = run_git(None, "rev-parse", "--show-toplevel").strip()
+      output = run_git(root, "ls-files", "-s", "--debug", "-z")
+      changed = run_git(root, "ls-files", "-m", "-d", "-z")
+    except (OSError, subprocess.CalledProcessError), e:
+      logging.info("Not using the git index: %s", e)
+      return None
+    prefix = os.path.relpath(os.getcwd(), root)
+    dirty = [p for p in changed.split("\0") if p]
+    return GitIndex(prefix, parse_index(output), dirty)
+
+  # Returns the path, relative to the root of the checkout, of the given path,
+  # or None if it's outside the checkout.
+  def get_index_path(self, path):
+    result = os.path.normpath(os.path.join(self.prefix, path))
+    if result.startswith(".." + os.sep) or (result == "..") or os.path.isabs(result):
+      return None
+    return result.replace(os.sep, "/")
+
+  # Returns the entry for the file with the given path if it's tracked and
+  # hasn't been modified, otherwise None.
+  def get_entry(self, path):
+    index_path = self.get_index_path(path)
+    if index_path is None:
+      return None
+    return self.entries.get(index_path, None)
+
+  # Returns FILE if the given path is a clean tracked file, FOLDER if it's a
+  # folder that contains one, otherwise None which means the file system has
+  # to be asked.
+  def get_kind(self, path):
+    index_path = self.get_index_path(path)
+    if index_path is None:
+      return None
+    if index_path in self.entries:
+      return FILE
+    if index_path in self.get_folders():
+      return FOLDER
+    return None
+
+  # Returns the set of folders that contain clean tracked files.
+  def get_folders(self):
+    if self.folders is None:
+      self.folders = set(["."])
+      for path in self.entries.keys():
+        parent = os.path.dirname(path)
+        while parent and not parent in self.folders:
+          self.folders.add(parent)
+          parent = os.path.dirname(parent)
+    return self.folders
+
+  # Forgets what the index knows about the file with the given path, for
+  # instance because it has changed since the index was read.
+  def forget(self, path):
+    index_path = self.get_index_path(path)
+    if not index_path is None:
+      self.entries.pop(index_path, None)
+
+
+_INDEX = None
+# Reads the git index to consult for this process, replacing any index read
+# before.
+def load():
+  global _INDEX
+  _INDEX = GitIndex.read()
+
+
+# Returns the git index to consult for file metadata, or None if it isn't being
+# used.
+def get_index():
+  return _INDEX
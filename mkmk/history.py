@@ -0,0 +1,136 @@
+#- Copyright 2014 GOTO 10.
+#- Licensed under the Apache License, Version 2.0 (see LICENSE).
+
+## The build database: what previous builds have learned about each target.
+##
+## Every time a target is built the time it took and the peak memory use of the
+## commands that built it are recorded, keyed by the target's output path, such
+## that later builds can schedule work based on what it's likely to cost.
+
+import json
+import os
+import os.path
+
+
+# Returns the path of the build database for the given bindir.
+def get_history_path(bindir):
+  return os.path.join(bindir, "History.mkmk")
+
+
+# Given a map from outputs to the paths they're built from, returns a map from
+# each output to the cost of the most expensive chain of outputs that ends with
+# it, where the cost of each individual output is given by the get_cost
+# function. Work on the outputs with the highest cost should start first since
+# they determine how long the build takes. If the outputs depend on each other
+# in a cycle, which make will refuse to build anyway, the cycle is broken at the
+# dependency that closes it.
+def get_critical_path_costs(inputs, get_cost):
+  result = {}
+  for root in sorted(inputs.keys()):
+    # Walk the graph iteratively since chains can be longer than python's
+    # recursion limit. The outputs being expanded are the ones on the chain from
+    # the root to the current output.
+    stack = [(root, False)]
+    expanding = set()
+    while stack:
+      (output, is_expanded) = stack.pop()
+      if (output in result) or ((not is_expanded) and (output in expanding)):
+        continue
+      deps = [p for p in inputs[output] if p in inputs]
+      if is_expanded:
+        expanding.remove(output)
+        longest = max([result.get(dep, 0) for dep in deps] + [0])
+        result[output] = get_cost(output) + longest
+      else:
+        expanding.add(output)
+        stack.append((output, True))
+        for dep in deps:
+          if not (dep in result or dep in expanding):
+            stack.append((dep, False))
+  return result
+
+
+class BuildHistory(object):
+
+  def __init__(self, path):
+    self.path = path
+    self.entries = {}
+    self.is_dirty = False
+    self.averages = None
+    if os.path.exists(path):
+      with open(path, "rt") as f:
+        self.entries = json.load(f)
+
+  # Returns the recorded information about the given output, or None.
+  def get(self, output):
+    return self.entries.get(output, None)
+
+  # Returns the number of seconds it took to build the given output last time,
+  # or None if it's not known.
+  def get_duration(self, output):
+    entry = self.get(output)
+    if entry is None:
+      return None
+    return entry["duration"]
+
+  # Returns the peak resident set size, in kilobytes, of the commands that built
+  # the given output last time, or None if it's not known.
+  def get_peak_rss(self, output):
+    entry = self.get(output)
+    if entry is None:
+      return None
+    return entry.get("peak_rss", None)
+
+  # Returns a pair of the average duration and peak resident set size over all
+  # outputs, computed once until the next change.
+  def get_averages(self):
+    if self.averages is None:
+      durations = [e["duration"] for e in self.entries.values()]
+      peaks = [e["peak_rss"] for e in self.entries.values() if e.get("peak_rss", None)]
+      average_duration = 0
+      if durations:
+        average_duration = sum(durations) / len(durations)
+      average_peak = None
+      if peaks:
+        average_peak = sum(peaks) / len(peaks)
+      self.averages = (average_duration, average_peak)
+    return self.averages
+
+  # Returns the average peak resident set size over all outputs, or None if
+  # none are known.
+  def get_average_peak_rss(self):
+    return self.get_averages()[1]
+
+  # Returns the average build duration over all outputs, or 0 if none are known.
+  def get_average_duration(self):
+    return self.get_averages()[0]
+
+  # Returns the number of seconds building the given output is expected to take.
+  # Outputs that haven't been built before are assumed to take as long as the
+  # average.
+  def get_expected_duration(self, output):
+    result = self.get_duration(output)
+    if result is None:
+      result = self.get_average_duration()
+    return result
+
+  # Records that building the given output took the given number of seconds and
+  # used at most the given number of kilobytes of memory.
+  def record(self, output, duration, peak_rss):
+    entry = {"duration": duration}
+    if not peak_rss is None:
+      entry["peak_rss"] = peak_rss
+    self.entries[output] = entry
+    self.is_dirty = True
+    self.averages = None
+
+  # Writes the database to disk if it has changed.
+  def save(self):
+    if not self.is_dirty:
+      return
+    parent = os.path.dirname(self.path)
+    if parent and not os.path.exists(parent):
+      os.makedirs(parent)
+    with open(self.path, "wt") as f:
+      json.dump(self.entries, f, sort_keys=True, indent=None)
+    self.is_dirty = False
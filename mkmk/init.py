@@ -36,6 +36,16 @@ set -e
 # The version of the init script the produced this build script.
 INIT_VERSION="%(version)s"
 
+# Fast path: if this script hasn't changed since the makefile was generated and
+# none of the makefile's inputs, which mkmk lists in the .deps file and which
+# include mkmk itself, have changed either we can go straight to make without
+# starting python at all.
+MAKEFILE="%(Makefile.mkmk)s"
+if [ -f "$MAKEFILE" ] && [ ! "$0" -nt "$MAKEFILE" ] \\
+    && make -q -f "$MAKEFILE.deps" "$MAKEFILE" > /dev/null 2>&1%(goals_check)s; then
+  %(fast_make)s
+fi
+
 # Check whether init.py has changed. If it has regenerate this file and run it
 # again.
 INIT_CHANGED=$(%(init_tool)s has_changed --before $INIT_VERSION)
@@ -53,7 +63,7 @@ if [ $INIT_CHANGED = "Changed" ]; then
   exit $?
 fi
 
-# Rebuild makefile every time.
+# Rebuild makefile.
 "%(mkmk_tool)s" makefile \\
   --config "%(config)s" \\
   --bindir "%(bindir)s" \\
@@ -67,7 +77,7 @@ fi
   %(cond_flags)s
 
 # Delegate to the resulting makefile.
-make -f "%(Makefile.mkmk)s" "$@"
+%(make)s
 """
 
 
@@ -116,6 +126,33 @@ _SHELLS = {
 }
 
 
+# Map from shell names to how to pass the build script's arguments as goals.
+_GOALS_ARGUMENTS = {
+  "sh": '"$*"',
+  "bat": '"%*"'
+}
+
+
+# Map from shell names to the extra condition that must hold for the makefile
+# to be reused when it only contains the rules for some goals: the goals must be
+# the same as last time.
+_GOALS_CHECKS = {
+  "sh": ' \\\n    && printf \'%s\\n\' "$*" | cmp -s - "$MAKEFILE.goals"',
+  "bat": ''
+}
+
+
+# Returns a pair of the commands the sh script uses to run make in the fast path
+# and after regenerating the makefile. When tracing the trace log is converted
+# once make is done, whether or not it succeeded.
+def get_sh_make_commands(mkmk, flags):
+  if not flags.trace:
+    return ('exec make -f "$MAKEFILE" "$@"', 'make -f "%s" "$@"' % get_makefile_name(flags))
+  command = ('status=0; make -f "$MAKEFILE" "$@" || status=$?; '
+    '"%s" trace --bindir "%s"; exit $status' % (mkmk, flags.bindir))
+  return (command, command)
+
+
 # Checks that the flags are sane, otherwise bails.
 def validate_flags(flags):
   if flags.shell is None:
@@ -178,6 +215,12 @@ def generate_build_script(version, mkmk, flags, variant_flags):
   if flags.noisy:
     cond_flags.append('--noisy')
   cond_flags += ['--system', flags.system]
+  if flags.lazy:
+    # Only load the scripts needed for the targets passed to the build script.
+    cond_flags += ['--lazy', '--goals', _GOALS_ARGUMENTS[flags.shell]]
+  if flags.trace:
+    cond_flags.append('--trace')
+  (fast_make, make) = get_sh_make_commands(mkmk, flags)
   makefile_src = template % {
     "version": version,
     "init_tool": mkmk,
@@ -187,7 +230,10 @@ def generate_build_script(version, mkmk, flags, variant_flags):
     "bindir": flags.bindir,
     "Makefile.mkmk": get_makefile_name(flags),
     "variant_flags": " ".join(variant_flags),
-    "cond_flags": " ".join(cond_flags)
+    "cond_flags": " ".join(cond_flags),
+    "goals_check": _GOALS_CHECKS[flags.shell] if flags.lazy else "",
+    "fast_make": fast_make,
+    "make": make
   }
   with open(filename, "wt") as out:
     out.write(makefile_src)
@@ -0,0 +1,119 @@
+#- Copyright 2014 GOTO 10.
+#- Licensed under the Apache License, Version 2.0 (see LICENSE).
+
+## Participation in the GNU make jobserver.
+##
+## When make runs with -j it hands out job slots as single-byte tokens in a
+## pipe (or, since make 4.4, a named fifo) whose location it passes to the
+## processes it spawns through MAKEFLAGS. Every process implicitly holds one
+## slot; to run more than one thing at a time it must read a token from the pipe
+## for each additional job and write it back when the job is done. That way
+## the whole build, including any parallelism inside the tools make runs, stays
+## within the one budget given to the toplevel make.
+
+import errno
+import logging
+import os
+import re
+import select
+
+
+# A client of the jobserver of the make that started this process.
+class JobServer(object):
+
+  def __init__(self, read_fd, write_fd):
+    self.read_fd = read_fd
+    self.write_fd = write_fd
+
+  # Takes a token if one is available without waiting. Returns the token or
+  # None if there was none.
+  def try_acquire(self):
+    try:
+      (readable, writable, errors) = select.select([self.read_fd], [], [], 0)
+      if not readable:
+        return None
+      token = os.read(self.read_fd, 1)
+    except (OSError, select.error), e:
+      if e.args[0] in [errno.EAGAIN, errno.EINTR]:
+        return None
+      raise
+    if not token:
+      return None
+    return token
+
+  # Takes as many tokens as are available, up to the given count, without
+  # waiting. Returns the list of tokens taken.
+  def try_acquire_many(self, count):
+    result = []
+    while len(result) < count:
+      token = self.try_acquire()
+      if token is None:
+        break
+      result.append(token)
+    return result
+
+  # Returns a token taken with one of the acquire methods.
+  def release(self, token):
+    os.write(self.write_fd, token)
+
+  def release_all(self, tokens):
+    for token in tokens:
+      self.release(token)
+
+
+# Opens the given path, a fifo or one of our own file descriptors under /proc,
+# for non-blocking reading. Opening it again rather than changing the flags of
+# the descriptor we were given gives us a private file description so the
+# change doesn't affect make or anyone else sharing the pipe.
+def open_nonblocking(path):
+  try:
+    return os.open(path, os.O_RDONLY | os.O_NONBLOCK)
+  except OSError:
+    return None
+
+
+# Returns the descriptor if it's open, otherwise None.
+def check_fd(fd):
+  try:
+    os.fstat(fd)
+    return fd
+  except OSError:
+    return None
+
+
+# Parses the jobserver location out of the given make flags. Returns a
+# JobServer or None if make isn't running a jobserver or didn't pass it on to
+# us.
+def parse_makeflags(makeflags):
+  if not makeflags:
+    return None
+  fifo = re.search(r'--jobserver-auth=fifo:(\S+)', makeflags)
+  if fifo:
+    path = fifo.group(1)
+    read_fd = open_nonblocking(path)
+    if read_fd is None:
+      return None
+    return JobServer(read_fd, os.open(path, os.O_WRONLY))
+  fds = re.search(r'--jobserver-(?:auth|fds)=(\d+),(\d+)', makeflags)
+  if not fds:
+    return None
+  read_fd = check_fd(int(fds.group(1)))
+  write_fd = check_fd(int(fds.group(2)))
+  if (read_fd is None) or (write_fd is None):
+    # Make only keeps the pipe open for recipes it knows are recursive.
+    logging.warning("The make jobserver is not available; mark the recipe that "
+      "runs mkmk with '+' to share the job budget.")
+    return None
+  private_fd = open_nonblocking("/proc/self/fd/%i" % read_fd)
+  if not private_fd is None:
+    read_fd = private_fd
+  return JobServer(read_fd, write_fd)
+
+
+_JOBSERVER = []
+# Returns the jobserver of the make that started this process, or None if there
+# is none.
+def get_jobserver():
+  if not _JOBSERVER:
+    _JOBSERVER.append(parse_makeflags(os.environ.get("MAKEFLAGS", None)))
+  return _JOBSERVER[0]
@@ -11,14 +11,16 @@ import node
 import os
 import os.path
 import platform
+import profiling
 import re
 import subprocess
 import sys
+import time
 
 
 # Current version of the init script. Bump this to force build scripts to
 # regenerate.
-_VERSION = 2
+_VERSION = 3
 
 
 # Returns the default value to use for the language.
@@ -79,6 +81,44 @@ class MkMk(object):
       help='The system/os we\'re building on')
     parser.add_argument('--self', default=None,
       help='Optional argument specifying how to run mkmk.')
+    parser.add_argument('--snapshot', default=False, action='store_true',
+      help='Reuse a snapshot of the build graph if no scripts have changed')
+    parser.add_argument('--lazy', default=False, action='store_true',
+      help='Only load the build scripts required to build the goals')
+    parser.add_argument('--goals', default=None,
+      help='Space-separated list of the targets or nodes to generate rules for')
+    parser.add_argument('--jobs', default=1, type=int,
+      help='Number of worker processes to use when generating the makefile')
+    parser.add_argument('--fragments', default=False, action='store_true',
+      help='Write the rules for each build script to a separate fragment')
+    parser.add_argument('--lean', default=False, action='store_true',
+      help='Generate a makefile that spawns as few processes as possible (posix only)')
+    parser.add_argument('--socket', default=None,
+      help='The socket the server listens on, by default mkmk.sock in the bindir')
+    parser.add_argument('--workers', default=None,
+      help='Number of local workers to build with, or comma-separated worker addresses')
+    parser.add_argument('--listen', default=None,
+      help='The address a worker listens on, unix:<path> or <host>:<port>')
+    parser.add_argument('--trace', default=False, action='store_true',
+      help='Record a timeline of the build jobs in trace.json in the bindir')
+    parser.add_argument('--progress', default=None,
+      help='File or fifo to write json progress events of a farm build to')
+    parser.add_argument('--git-index', default=False, action='store_true',
+      help='Read file metadata in bulk from the git index where possible')
+    parser.add_argument('--since', default=None,
+      help='Git revision to compare the working tree with when listing affected targets')
+    parser.add_argument('--limit', default=20, type=int,
+      help='Maximum number of targets to list in reports')
+    parser.add_argument('--profile', default=False, action='store_true',
+      help='Report the time spent in each phase of generating the makefile')
+    parser.add_argument('--profile-stats', default=None,
+      help='File to write cProfile statistics to when profiling')
+    parser.add_argument('--profile-memory', default=False, action='store_true',
+      help='Also report peak memory use when profiling')
+    parser.add_argument('--stats', default=False, action='store_true',
+      help='Report counters of the file system calls made generating the makefile')
+    parser.add_argument('--memory-budget', default=None, type=int,
+      help='Megabytes of memory the jobs of a farm build may be predicted to use at once')
     return parser
 
   # Returns a map from handler names to handlers.
@@ -90,6 +130,8 @@ class MkMk(object):
         continue
       action = match.group(1)
       result[action] = value
+      # Commands with more than one word can also be spelled with dashes.
+      result[action.replace("_", "-")] = value
     return result
 
 
@@ -97,8 +139,92 @@ class MkMk(object):
   def handle_makefile(self):
     self.ensure_no_unknown()
     import makefile
+    import server
     runner = makefile.MkMkMakefile(self.options)
-    runner.run()
+    run = runner.run
+    if self.options.stats:
+      run = lambda: profiling.run_counted(self.options.makefile, runner.run)
+    if self.options.profile:
+      # Requests to a server would only measure the client so always generate
+      # the makefile here when profiling.
+      profiling.run_profiled(self.options, run)
+    elif self.options.stats:
+      run()
+    elif server.try_request(self.options, "makefile", goals=self.options.goals) is None:
+      runner.run()
+
+  # Keeps the build graph in memory and serves makefile requests until stopped.
+  def handle_serve(self):
+    self.ensure_no_unknown()
+    if self.options.lazy:
+      print "The server always loads all build scripts; --lazy is not supported."
+      sys.exit(1)
+    import server
+    server.MkMkServer(self.options).run()
+
+  # Asks a running server to stop.
+  def handle_stop(self):
+    self.ensure_no_unknown()
+    import server
+    if server.try_request(self.options, "stop") is None:
+      print "No server running."
+      sys.exit(1)
+
+  # Brings the makefile up to date, through the server if there is one, then
+  # runs make with the extra arguments.
+  def handle_build(self):
+    self.handle_makefile()
+    command = ["make", "-f", self.options.makefile] + self.extras
+    return subprocess.check_call(command)
+
+  # Builds the given targets by running their commands on a pool of workers.
+  def handle_farm(self):
+    self.ensure_no_unknown()
+    import farm
+    if not farm.MkMkFarm(self.options).run(self.extras):
+      sys.exit(1)
+
+  # Runs a worker that executes build commands on behalf of a farm coordinator.
+  def handle_worker(self):
+    self.ensure_no_unknown()
+    if self.options.listen is None:
+      print "A worker needs an address to --listen on."
+      sys.exit(1)
+    import farm
+    farm.run_worker(self.options.listen)
+
+  # Reports the longest chain of targets to build and how much each target
+  # contributes to the length of the build.
+  def handle_critical_path(self):
+    goals = self.get_positional_arguments()
+    import critical
+    critical.MkMkCriticalPath(self.options).run(goals)
+
+  # Reports why the given targets are out of date and which changes cause the
+  # most targets to be rebuilt.
+  def handle_explain(self):
+    goals = self.get_positional_arguments()
+    import explain
+    explain.MkMkExplain(self.options).run(goals)
+
+  # Lists the targets affected by changes to the given files.
+  def handle_affected(self):
+    files = self.get_positional_arguments()
+    import affected
+    affected.MkMkAffected(self.options).run(files)
+
+  # Prints a digest of everything the given goals are built from.
+  def handle_fingerprint(self):
+    goals = self.get_positional_arguments()
+    import fingerprint
+    if not fingerprint.MkMkFingerprint(self.options).run(goals):
+      sys.exit(1)
+
+  # Converts the jobs recorded by a traced make build into trace.json.
+  def handle_trace(self):
+    self.ensure_no_unknown()
+    import timeline
+    timeline.MkMkTrace(self.options).run()
 
   def handle_init(self):
     import init
@@ -118,6 +244,14 @@ class MkMk(object):
     else:
       print("Changed")
 
+  # Returns the arguments following the command, given either directly or after
+  # --. Dies with an error if there are unknown flags.
+  def get_positional_arguments(self):
+    result = [arg for arg in self.unknown if not arg.startswith("-")]
+    self.unknown = [arg for arg in self.unknown if arg.startswith("-")]
+    self.ensure_no_unknown()
+    return result + self.extras
+
   # Checks that there were no unknown flags, otherwise dies with an error.
   def ensure_no_unknown(self):
     if len(self.unknown) > 0:
@@ -133,7 +267,11 @@ class MkMk(object):
 
 
 def main():
+  wall_start = time.time()
+  cpu_start = profiling.get_cpu_time()
   mkmk = MkMk(sys.argv[1:])
+  profiling.get_profiler().record("argument parsing", time.time() - wall_start,
+    profiling.get_cpu_time() - cpu_start)
   try:
     mkmk.run()
   except KeyboardInterrupt, ki:
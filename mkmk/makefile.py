@@ -4,14 +4,29 @@
 
 from command import Command, shell_escape
 import argparse
+import extend
+import gitindex
+import hashlib
+import logging
 import node
 import os
 import os.path
 import platform
+import profiling
 import re
 import stat
 import sys
 
+try:
+  import cPickle as pickle
+except ImportError:
+  import pickle
+
+try:
+  from cStringIO import StringIO
+except ImportError:
+  from io import StringIO
+
 
 ## Implements the 'makefile' command.
 
@@ -19,21 +34,32 @@ import sys
 # An individual target within a makefile.
 class MakefileTarget(object):
 
-  def __init__(self, output, inputs, commands):
+  def __init__(self, output, inputs, commands, order_only):
     self.output = output
     self.inputs = inputs
     self.commands = commands
+    self.order_only = order_only
 
   # Returns the string output path for this target.
   def get_output_path(self):
     return self.output
 
-  # Write this target, in Makefile syntax, to the given output stream.
-  def write(self, out):
+  # Write this target, in Makefile syntax, to the given output stream. If costs
+  # are given the inputs are ordered by descending cost such that make starts
+  # the most expensive work first, otherwise alphabetically.
+  def write(self, out, costs=None):
     raw_inputs = sorted(set(self.inputs))
+    if costs:
+      raw_inputs.sort(key=lambda path: -costs.get(path, 0))
+    inpaths = " ".join(map(shell_escape, raw_inputs))
+    if self.order_only:
+      # Order-only prerequisites must exist but don't cause a rebuild when they
+      # change.
+      order_only = sorted(set(self.order_only))
+      inpaths = "%s | %s" % (inpaths, " ".join(map(shell_escape, order_only)))
     out.write("%(outpath)s: %(inpaths)s\n\t%(commands)s\n\n" % {
       "outpath": shell_escape(self.output),
-      "inpaths": " ".join(map(shell_escape, raw_inputs)),
+      "inpaths": inpaths,
       "commands": "\n\t".join(self.commands)
     })
 
@@ -48,11 +74,15 @@ class Makefile(object):
     self.targets = {}
     self.phonies = set()
     self.metadata = None
+    self.includes = []
+    self.default_goal = None
+    self.preamble = []
+    self.costs = None
 
   # Add a target that builds the given output from the given inputs by invoking
   # the given commands in sequence.
-  def add_target(self, output, inputs, commands, is_phony):
-    target = MakefileTarget(output, inputs, commands)
+  def add_target(self, output, inputs, commands, is_phony, order_only=[]):
+    target = MakefileTarget(output, inputs, commands, order_only)
     self.targets[output] = target
     if is_phony:
       self.phonies.add(output)
@@ -60,11 +90,51 @@ class Makefile(object):
   def set_metadata(self, value):
     self.metadata = value
 
+  # Adds a line to write before anything else in the makefile.
+  def add_preamble(self, line):
+    self.preamble.append(line)
+
+  # Adds another makefile to be included into this one.
+  def add_include(self, path):
+    self.includes.append(path)
+
+  # Sets the target to build if none is given explicitly.
+  def set_default_goal(self, value):
+    self.default_goal = value
+
+  # Sets the map from target names to the estimated cost of building them,
+  # used to order prerequisites.
+  def set_costs(self, costs):
+    self.costs = costs
+
+  # Returns a map from the names of the targets defined by this makefile to
+  # their inputs.
+  def get_target_inputs(self):
+    return dict([(k, t.inputs) for (k, t) in self.targets.items()])
+
+  # Returns the sorted names of the targets defined by this makefile.
+  def get_target_names(self):
+    return sorted(self.targets.keys())
+
+  # Is the target with the given name phony?
+  def is_phony(self, name):
+    return name in self.phonies
+
   # Write this makefile in Makefile syntax to the given stream.
   def write(self, out):
+    for line in self.preamble:
+      out.write("%s\n" % line)
+    if self.preamble:
+      out.write("\n")
+    if self.default_goal:
+      out.write(".DEFAULT_GOAL := %s\n\n" % shell_escape(self.default_goal))
+    for path in self.includes:
+      out.write("include %s\n" % shell_escape(path))
+    if self.includes:
+      out.write("\n")
     for name in sorted(self.targets.keys()):
       target = self.targets[name]
-      target.write(out)
+      target.write(out, self.costs)
     # Mike Moffit says: list *all* the phonies.
     if self.phonies:
       out.write(".PHONY: %s\n\n" % " ".join(sorted(list(self.phonies))))
@@ -78,18 +148,39 @@ class Makefile(object):
 # ambiguities that might be caused by multiple relative paths pointing to the
 # same thing and differences in path separators etc. Names compare
 # lexicographically and are equal if their parts are structurally equal.
+#
+# Names are interned so there is only ever one instance for a given sequence of
+# parts, which means that equality is usually an identity check and the hash is
+# only ever computed once. Don't create names directly, use Name.of or one of
+# the methods that derive new names from existing ones.
 class Name(object):
+  __slots__ = ['parts', 'hash', 'children']
 
   def __init__(self, parts):
-    self.parts = tuple(parts)
+    self.parts = parts
+    self.hash = ~hash(parts)
+    self.children = {}
 
   # Returns a new name that consists of this name followed by the given parts.
   def append(self, *subparts):
-    return Name(self.parts + subparts)
+    current = self
+    for part in subparts:
+      current = current.get_child(part)
+    return current
+
+  # Returns the name that consists of this name followed by the single given
+  # part. The result is cached on this name so repeatedly appending the same
+  # part doesn't allocate anything.
+  def get_child(self, part):
+    child = self.children.get(part, None)
+    if child is None:
+      child = Name.intern(self.parts + (part,))
+      self.children[part] = child
+    return child
 
   # Returns a new name that consists of the given prefix followed by this name.
   def prepend(self, *prefix):
-    return Name(prefix + self.parts)
+    return Name.intern(prefix + self.parts)
 
   # Returns a tuple that holds the parts of this name.
   def get_parts(self):
@@ -99,15 +190,32 @@ class Name(object):
   def get_last_part(self):
     return self.parts[-1]
 
+  # Returns true if this name is a prefix of the given name, for instance a|b is
+  # a prefix of both a|b and a|b|c but not of a|c.
+  def is_prefix_of(self, that):
+    return that.parts[:len(self.parts)] == self.parts
+
   @staticmethod
   def of(*parts):
-    return Name(parts)
+    return Name.intern(parts)
+
+  # Returns the unique name instance with the given tuple of parts.
+  @staticmethod
+  def intern(parts):
+    result = _NAME_TABLE.get(parts, None)
+    if result is None:
+      result = Name(parts)
+      _NAME_TABLE[parts] = result
+    return result
 
   def __hash__(self):
-    return ~hash(self.parts)
+    return self.hash
 
   def __eq__(self, that):
-    return (self.parts == that.parts)
+    return (self is that) or (self.parts == that.parts)
+
+  def __ne__(self, that):
+    return not (self == that)
 
   def __cmp__(self, that):
     return cmp(self.parts, that.parts)
@@ -118,6 +226,31 @@ class Name(object):
   def __repr__(self):
     return str(self)
 
+  # Names are pickled by their parts and re-interned when unpickled so a graph
+  # snapshot doesn't break the one-instance-per-name invariant.
+  def __reduce__(self):
+    return (_unpickle_name, (self.parts,))
+
+
+# Returns the interned name with the given parts. Used when unpickling.
+def _unpickle_name(parts):
+  return Name.intern(parts)
+
+
+# The table of all interned names, keyed by their parts.
+_NAME_TABLE = {}
+
+
+# Like os.path.isfile but consults the git index first, if there is one, and
+# counts the stat calls it makes.
+def _counted_isfile(path):
+  index = gitindex.get_index()
+  if (not index is None) and (index.get_kind(path) == gitindex.FILE):
+    profiling.count("git index hits")
+    return True
+  profiling.count("stat calls")
+  return os.path.isfile(path)
+
 
 # An abstract file wrapper that encapsulates various file operations.
 class AbstractFile(object):
@@ -134,9 +267,20 @@ class AbstractFile(object):
   # file the path points to.
   @staticmethod
   def at(path, env, parent):
+    # Paths the git index knows about don't have to be stat'ed.
+    index = gitindex.get_index()
+    if not index is None:
+      kind = index.get_kind(path)
+      if kind == gitindex.FILE:
+        profiling.count("git index hits")
+        return RegularFile(path, env, parent)
+      elif kind == gitindex.FOLDER:
+        profiling.count("git index hits")
+        return Folder(path, env, parent)
     try:
       # Try to state the file first since this lets us determine all the
       # properties in one call. Fall through on failure.
+      profiling.count("stat calls")
       mode = os.stat(path).st_mode
       if stat.S_ISDIR(mode):
         return Folder(path, env, parent)
@@ -151,7 +295,7 @@ class AbstractFile(object):
   def get_parent(self):
     if self.parent is None:
       dirname = os.path.dirname(self.path)
-      if (not dirname) and os.path.isfile(self.path):
+      if (not dirname) and _counted_isfile(self.path):
         # If this file is a naked file ("foo.mkmk" say) then we take the parent
         # to be the relative current directory since that's where the file is
         # assumed to be.
@@ -184,14 +328,48 @@ class AbstractFile(object):
     return self.path
 
   def get_modified_time(self):
-    mtime_secs = os.path.getmtime(self.get_path())
+    entry = self.get_index_entry()
+    if entry is None:
+      profiling.count("stat calls")
+      mtime_secs = os.path.getmtime(self.get_path())
+    else:
+      mtime_secs = entry.get_modified_time()
     return int(1000 * mtime_secs)
 
+  # Returns what the git index knows about this file if it's a clean tracked
+  # file and the index is being used, otherwise None.
+  def get_index_entry(self):
+    index = gitindex.get_index()
+    if index is None:
+      return None
+    return index.get_entry(self.get_path())
+
+  # Returns a pair of the kind of version and the version of the contents of
+  # this file, which changes whenever the contents do: the blob hash if the git
+  # index knows it, otherwise the modification time.
+  def get_version(self):
+    entry = self.get_index_entry()
+    if entry is None:
+      return ("mtime", self.get_modified_time())
+    else:
+      return ("blob", entry.get_blob())
+
   # Is this file handle backed by a physical file?
   def exists(self):
     # Checking for file existence is slow on windows so cache the result.
     if self.exists_cache is None:
-      self.exists_cache = os.path.exists(self.get_path())
+      index = gitindex.get_index()
+      if (not index is None) and (not index.get_kind(self.get_path()) is None):
+        profiling.count("git index hits")
+        self.exists_cache = True
+      else:
+        profiling.count("exists probes")
+        self.exists_cache = os.path.exists(self.get_path())
+      # Whether the file exists may affect the build so any file being added to
+      # or removed from the folder means the makefile has to be regenerated.
+      self.env.add_input_file(os.path.dirname(self.get_path()) or ".")
+    else:
+      profiling.count("exists cache hits")
     return self.exists_cache
 
   # Returns an in-memory attribute associated with this file, computing it using
@@ -206,10 +384,14 @@ class AbstractFile(object):
       # If the value is sticky we first try to get it from the cache in the env.
       cached = self.env.peek_file_attribute(self, name)
       if not cached is None:
+        if not self.attribs:
+          self.env.register_cached_file(self)
         self.attribs[name] = cached
         return cached
     # Calculate the value then.
     value = thunk(self)
+    if not self.attribs:
+      self.env.register_cached_file(self)
     self.attribs[name] = value
     if sticky:
       # If the value is sticky store it for later use.
@@ -226,6 +408,21 @@ class AbstractFile(object):
   def __lt__(self, that):
     return self.path < that.path
 
+  # Discards any information cached about the contents of this file.
+  def invalidate(self):
+    self.attribs = {}
+
+  # Files are pickled by path only. When a snapshot is loaded the file is looked
+  # up afresh so its type and existence reflect the current state of the file
+  # system rather than the state when the snapshot was taken.
+  def __reduce__(self):
+    return (_unpickle_file, (self.path, self.env, self.parent))
+
+
+# Returns a fresh file object for the given path. Used when unpickling.
+def _unpickle_file(path, env, parent):
+  return AbstractFile.at(path, env, parent)
+
 
 # A wrapper that represents a file that doesn't exist yet. Using files that
 # don't exist is fine but if you try to interact with them in any nontrivial
@@ -253,13 +450,20 @@ class RegularFile(AbstractFile):
   def open(self, mode):
     return open(self.get_path(), mode)
 
+  def invalidate(self):
+    super(RegularFile, self).invalidate()
+    self.lines = None
+
   # Returns the contents of this file as a list of strings, one for each line.
   def read_lines(self):
     if self.lines is None:
+      self.env.register_cached_file(self)
       self.lines = []
+      profiling.count("files opened")
       with self.open("rt") as source:
         for line in source:
           self.lines.append(line)
+      profiling.count("bytes read", sum([len(l) for l in self.lines]))
     return self.lines
 
 
@@ -321,6 +525,7 @@ class ConfigContext(object):
     self.full_name = full_name
     self.parent = parent
     self.attribs = {}
+    self.script = None
 
   def get_attribute(self, name, defawlt=None):
     return self.attribs.get(name, defawlt)
@@ -337,6 +542,10 @@ class ConfigContext(object):
   def get_parent(self):
     return self.parent
 
+  # Returns the build script that was evaluated in this context, or None.
+  def get_script(self):
+    return self.script
+
   # Builds the environment dictionary containing all the toplevel functions in
   # the mkmk.
   def get_script_environment(self):
@@ -355,14 +564,14 @@ class ConfigContext(object):
     full_name = self.full_name.append(*rel_parent_path)
     mkmk_home = full_mkmk.get_parent()
     subcontext = ConfigContext(self.nodespace, mkmk_home, full_name, self)
-    subcontext.load(full_mkmk)
+    self.env.load_script(subcontext, full_mkmk)
 
   @export_to_build_scripts
   def include_dep(self, *rel_mkmk_path):
     rel_parent_path = rel_mkmk_path[:-1]
     dep_name = rel_parent_path[0]
     existing = self.env.get_dep(dep_name)
-    if not existing is None:
+    if (not existing is None) or self.env.is_foreign_dep(dep_name):
       # This dep has already been loaded
       return
     full_mkmk = self.home.get_child('deps', *rel_mkmk_path)
@@ -371,7 +580,7 @@ class ConfigContext(object):
     bindir = self.nodespace.bindir.get_child('deps', dep_name)
     nodespace = self.env.create_dep(dep_name, mkmk_home, bindir)
     subcontext = ConfigContext(nodespace, mkmk_home, Name.of(), None)
-    subcontext.load(full_mkmk)
+    self.env.load_dep_script(subcontext, full_mkmk)
 
   # Returns a group node with the given name, creating it if it doesn't already
   # exist.
@@ -390,7 +599,7 @@ class ConfigContext(object):
 
   @export_to_build_scripts
   def get_dep_external(self, name, *names):
-    nodespace = self.env.get_dep(name)
+    nodespace = self.env.get_loaded_dep(name)
     return nodespace.get_node(Name.of(*names))
 
   # Returns a file object representing the root of the source tree, that is,
@@ -402,7 +611,7 @@ class ConfigContext(object):
   # Returns a file object representing the dependency with the given name.
   @export_to_build_scripts
   def get_dep(self, name):
-    return self.env.get_dep(name).root
+    return self.env.get_loaded_dep(name).root
 
   # Returns a file object representing the root of the build output directory.
   @export_to_build_scripts
@@ -456,6 +665,12 @@ class ConfigContext(object):
       alias.add_member(child)
     return alias
 
+  # Defines a job pool with the given name that allows at most the given number
+  # of commands assigned to it to run at the same time.
+  @export_to_build_scripts
+  def add_pool(self, name, depth):
+    self.env.add_pool(name, depth)
+
   # Loads information about a given library.
   @export_to_build_scripts
   def get_library_info(self, name):
@@ -474,17 +689,46 @@ class ConfigContext(object):
 
   # Does the actual work of loading the mkmk file this context corresponds to.
   def load(self, mkmk_file):
-    with open(mkmk_file.get_path()) as handle:
-      code = compile(handle.read(), mkmk_file.get_path(), "exec")
-      exec(code, self.get_script_environment())
+    self.script = mkmk_file
+    with profiling.phase("script: %s" % mkmk_file.get_path()):
+      with open(mkmk_file.get_path()) as handle:
+        source = handle.read()
+        self.env.add_script(mkmk_file.get_path(), source)
+        code = compile(source, mkmk_file.get_path(), "exec")
+        exec(code, self.get_script_environment())
 
   # Returns the full name of the script represented by this context.
   def get_full_name(self):
     return self.full_name
 
+  # Returns the nodespace this context creates its nodes within.
+  def get_nodespace(self):
+    return self.nodespace
+
+  # Returns true if evaluating this context's script is likely to produce the
+  # node for the given goal. Goals given as full names (a::b::c) match if this
+  # context's name is a prefix, goals given as output paths match if the path
+  # lies within this context's output folder, and aliases prefixed with a dep
+  # name match the contexts of that dep.
+  def may_produce_goal(self, goal):
+    if "::" in goal:
+      global_name = self.nodespace.get_global_name(self.full_name)
+      return global_name.is_prefix_of(Name.of(*goal.split("::")))
+    prefix = self.nodespace.get_prefix()
+    if (not prefix is None) and goal.startswith("%s_" % prefix):
+      return True
+    outdir = self.nodespace.get_bindir().get_path()
+    folder = os.path.normpath(os.path.join(outdir, *self.full_name.get_parts()))
+    path = os.path.normpath(goal)
+    return (path == folder) or path.startswith(folder + os.sep)
+
   def get_system(self):
     return self.env.get_system()
 
+  # Ensures that the given library instance has been resolved.
+  def ensure_library_resolved(self, instance):
+    self.env.ensure_library_resolved(instance)
+
   # Returns a file in the output directory with the given name and, optionally,
   # extension.
   def get_outdir_file(self, name, ext=None):
@@ -528,18 +772,29 @@ class Nodespace(object):
 
   def add_node(self, full_name, node):
     self.nodes[full_name] = node
+    self.env.add_node(self.get_global_name(full_name), node)
+    return node
+
+  # Returns the globally unique name of the node with the given name within
+  # this nodespace.
+  def get_global_name(self, full_name):
     if self.prefix is None:
-      global_name = full_name
+      return full_name
     else:
-      global_name = full_name.prepend(self.prefix)
-    self.env.add_node(global_name, node)
-    return node
+      return full_name.prepend(self.prefix)
 
   def get_prefix(self):
     return self.prefix
 
-  # Returns the node with the given full name, which must already exist.
+  # Returns the node with the given full name, which must already exist. If
+  # scripts are being loaded lazily this will load the scripts that may define
+  # the node first.
   def get_node(self, full_name):
+    self.env.ensure_dep_loaded(self.prefix)
+    if not full_name in self.nodes:
+      self.env.load_pending_until(
+        lambda: full_name in self.nodes,
+        lambda c: (c.get_nodespace() is self) and c.get_full_name().is_prefix_of(full_name))
     return self.nodes[full_name]
 
   # Returns a handle to the root folder.
@@ -617,7 +872,7 @@ class Environment(object):
   def __init__(self, options, metasource=None):
     self.options = options
     self.extension_names = options.extension
-    self.extensions = None
+    self.extensions = {}
     self.custom_flags = None
     self.system = None
     self.all_nodes = {}
@@ -626,16 +881,160 @@ class Environment(object):
     self.attrib_cache = self.read_attrib_cache(metasource)
     self.system_file_cache = {}
     self.transient_attribs = {}
+    self.scripts = []
+    self.pending_scripts = []
+    self.jobs = options.jobs
+    self.input_files = set()
+    self.cached_files = {}
+    self.dep_evaluator = None
+    # When evaluating a dependency in a worker, the names of the dependencies
+    # that were loaded outside the worker.
+    self.foreign_deps = set()
+    self.goal_index = {}
+    self.unindexed_nodes = []
+    self.pools = {}
 
   def is_noisy(self):
     return self.options.noisy
 
+  # Should the makefile be generated using the lean profile that minimizes the
+  # number of processes make has to spawn? Only systems whose makefiles run
+  # under GNU make and a posix shell support it.
+  def is_lean(self):
+    return self.options.lean and self.get_system().supports_lean_makefiles()
+
   def add_node(self, full_name, node):
     self.all_nodes[full_name] = node
+    self.unindexed_nodes.append((full_name, node))
+
+  # Should included scripts be loaded on demand rather than immediately?
+  def is_lazy(self):
+    return self.options.lazy
+
+  # Loads the script for the given context, or if loading is lazy records it
+  # such that it can be loaded later if its nodes turn out to be needed. Only
+  # scripts that do nothing but define nodes can be deferred, the others are
+  # loaded in order as they would be eagerly.
+  def load_script(self, context, mkmk_file):
+    path = mkmk_file.get_path()
+    if self.is_lazy() and not may_have_global_effects(path):
+      # The makefile still depends on the script since it could change to do
+      # more than define nodes.
+      self.add_input_file(path)
+      self.pending_scripts.append((context, mkmk_file))
+    else:
+      context.load(mkmk_file)
+
+  # Loads the root script of a dependency. If we're using multiple jobs the
+  # script is evaluated by a worker process in the background.
+  def load_dep_script(self, context, mkmk_file):
+    if (self.jobs <= 1) or self.is_lazy():
+      self.load_script(context, mkmk_file)
+      return
+    if self.dep_evaluator is None:
+      from . import parallel
+      self.dep_evaluator = parallel.DepEvaluator(self, self.jobs)
+    self.dep_evaluator.submit(context.get_nodespace(), mkmk_file)
+
+  # If the dependency with the given name is being evaluated in the background,
+  # waits for it to complete.
+  def ensure_dep_loaded(self, name):
+    if (not self.dep_evaluator is None) and self.dep_evaluator.is_pending(name):
+      with profiling.phase("waiting for dependency workers"):
+        self.dep_evaluator.join(name)
+
+  # Stops evaluating dependencies in the background, discarding the results.
+  def abandon_dep_workers(self):
+    if not self.dep_evaluator is None:
+      self.dep_evaluator.terminate()
+      self.dep_evaluator = None
+
+  # Waits for all dependencies being evaluated in the background to complete.
+  def ensure_all_deps_loaded(self):
+    if not self.dep_evaluator is None:
+      with profiling.phase("waiting for dependency workers"):
+        self.dep_evaluator.join_all()
+      self.dep_evaluator = None
+
+  # Loads pending scripts one at a time until is_done returns true or there are
+  # no more scripts to load. Scripts for which is_preferred returns true are
+  # loaded first, but since we can't know in general which script defines what
+  # we fall back to loading the rest in the order they were included.
+  def load_pending_until(self, is_done, is_preferred):
+    while not is_done():
+      if not self.pending_scripts:
+        return
+      index = 0
+      for (i, (context, mkmk_file)) in enumerate(self.pending_scripts):
+        if is_preferred(context):
+          index = i
+          break
+      (context, mkmk_file) = self.pending_scripts.pop(index)
+      context.load(mkmk_file)
+
+  # Loads all scripts that haven't been loaded yet.
+  def load_all_pending(self):
+    self.load_pending_until(lambda: False, lambda c: False)
+
+  # Loads the scripts required to produce the given goals, names of make targets
+  # or full node names. If no goals are given everything is loaded.
+  def load_goals(self, goals):
+    if not goals:
+      self.load_all_pending()
+    for goal in goals:
+      self.load_pending_until(
+        lambda: not self.find_goal(goal) is None,
+        lambda c: c.may_produce_goal(goal))
+
+  # Returns the node that produces the given goal, either a make target or a
+  # full node name, or None if no such node has been loaded.
+  def find_goal(self, goal):
+    for (full_name, node) in self.unindexed_nodes:
+      self.goal_index[str(full_name)] = node
+      output_target = node.get_output_target()
+      if output_target:
+        self.goal_index[output_target] = node
+    self.unindexed_nodes = []
+    return self.goal_index.get(goal, None)
+
+  # Returns the set of nodes that have to be built to build the given goals,
+  # that is, the goals' nodes and everything reachable from them through
+  # flattened edges. Goals that don't correspond to any node are ignored.
+  def get_reachable_nodes(self, goals):
+    result = set()
+    pending = []
+    for goal in goals:
+      node = self.find_goal(goal)
+      if not node is None:
+        pending.append(node)
+    while pending:
+      node = pending.pop()
+      if node in result:
+        continue
+      result.add(node)
+      for edge in node.get_flat_edges():
+        pending.append(edge.get_target())
+    return result
 
   def get_dep(self, name):
     return self.deps.get(name, None)
 
+  # Returns the nodespace of the dependency with the given name, failing if it
+  # hasn't been loaded. A worker can't see dependencies loaded outside it so
+  # the scripts then have to be evaluated serially.
+  def get_loaded_dep(self, name):
+    result = self.get_dep(name)
+    if not result is None:
+      return result
+    if self.is_foreign_dep(name):
+      from . import parallel
+      raise parallel.SerialFallback("dependency %s is used by another dependency" % name)
+    raise AssertionError("Dependency %s has not been loaded" % name)
+
+  # Was the dependency with the given name loaded outside this worker?
+  def is_foreign_dep(self, name):
+    return name in self.foreign_deps
+
   def create_dep(self, name, root, bindir):
     result = Nodespace(self, name, root, bindir)
     self.deps[name] = result
@@ -644,6 +1043,102 @@ class Environment(object):
   def get_attrib_cache(self):
     return self.attrib_cache
 
+  # Records that the script with the given path and source has been loaded.
+  def add_script(self, path, source):
+    self.scripts.append((path, get_digest(source)))
+
+  # Returns a list of (path, digest) pairs, one for each script loaded.
+  def get_scripts(self):
+    return self.scripts
+
+  # Records that the contents of the makefile depend on the file or folder with
+  # the given path.
+  def add_input_file(self, path):
+    self.input_files.add(path)
+
+  # Returns the paths of all the files and folders, besides the build scripts,
+  # that the contents of the makefile depend on.
+  def get_input_files(self):
+    return self.input_files
+
+  # Records that information about the contents of the given file is being
+  # cached such that it can be discarded if the file changes.
+  def register_cached_file(self, file):
+    path = file.get_path()
+    if not path in self.cached_files:
+      self.cached_files[path] = []
+    self.cached_files[path].append(file)
+
+  # Discards any information cached about the contents of the file with the
+  # given path, including anything computed by nodes from it.
+  def invalidate_file(self, path):
+    index = gitindex.get_index()
+    if not index is None:
+      index.forget(path)
+    for file in self.cached_files.pop(path, []):
+      file.invalidate()
+    for node in self.all_nodes.values():
+      node.invalidate()
+
+  # Defines a pool, failing if it wouldn't allow any commands to run since the
+  # build would then stall.
+  def add_pool(self, name, depth):
+    if depth < 1:
+      raise AssertionError("Pool %s must have a depth of at least 1, not %s" % (name, depth))
+    self.pools[name] = depth
+
+  # Returns a map from the names of the pools defined to their depths.
+  def get_pools(self):
+    return self.pools
+
+  # Returns the name of the pool the command for the given node should run
+  # within, or None if it's not limited.
+  def get_node_pool(self, node):
+    pool = node.get_pool()
+    if not pool is None:
+      if not pool in self.pools:
+        raise AssertionError("Pool %s not defined" % pool)
+      return pool
+    pool = node.get_default_pool()
+    if pool in self.pools:
+      return pool
+    return None
+
+  # Returns the path of the script that implements the pool with the given name.
+  def get_pool_script_path(self, name):
+    return os.path.join(self.options.bindir, "pools", "%s.sh" % name)
+
+  # Returns a command line that runs the given line within the given pool.
+  def wrap_in_pool(self, name, line):
+    return self.get_system().wrap_in_pool(self.get_pool_script_path(name), line)
+
+  # Should each job of the build be recorded in a trace?
+  def is_tracing(self):
+    return self.options.trace
+
+  # Returns a command line that runs the given line and records it in the trace
+  # under the given name.
+  def wrap_in_trace(self, name, line):
+    return self.get_system().wrap_in_trace(self.get_trace_script_path(), name, line)
+
+  # Returns the path of the script that records jobs in the trace.
+  def get_trace_script_path(self):
+    return os.path.join(self.options.bindir, "trace.sh")
+
+  # Writes the script that records jobs in the trace.
+  def write_trace_script(self):
+    from . import timeline
+    script = self.get_system().get_trace_script(timeline.get_log_path(self.options.bindir))
+    if not script is None:
+      write_contents_if_changed(self.get_trace_script_path(), script)
+
+  # Writes the scripts that implement the pools.
+  def write_pool_scripts(self):
+    for (name, depth) in sorted(self.pools.items()):
+      script = self.get_system().get_pool_script(depth)
+      if not script is None:
+        write_contents_if_changed(self.get_pool_script_path(name), script)
+
   def set_transient_attribute(self, key, value):
     self.transient_attribs[key] = value
 
@@ -673,47 +1168,76 @@ class Environment(object):
       self.system_file_cache[name] = AbstractFile.at(name, self, None)
     return self.system_file_cache[name]
 
-  # Returns the map of tools for the given context.
+  # Returns the map of tools for the given context. The tool sets are proxies
+  # that are only created when a script actually uses them.
   def get_tools(self, context):
     result = {}
-    for (name, controller) in self.get_extensions():
-      tools = controller.get_tools(context)
-      result[name] = tools
+    for name in self.extension_names:
+      result[name] = extend.LazyToolSet(self, name, context)
     return result
 
   def get_system(self):
     if self.system is None:
       from . import system
       self.system = system.get(self.options.system)
+      cache_path = os.path.join(self.options.bindir, "Libraries.mkmk")
+      self.system.set_library_cache(system.LibraryCache(cache_path))
     return self.system
 
+  # Returns the names to resolve automatically for the library instances on
+  # the current platform.
+  def get_autoresolve_names(self):
+    os_name = self.get_system().get_os()
+    result = []
+    for info in self.library_info.values():
+      instance = info.platforms.get(os_name, None)
+      if (not instance is None) and (not instance.autoresolve is None):
+        result.append(instance.autoresolve)
+    return sorted(result)
+
+  # Resolves the given library instance if it needs to be resolved
+  # automatically. Rather than resolve just this one all the libraries declared
+  # so far are resolved in parallel since they're likely to be needed too.
+  def ensure_library_resolved(self, instance):
+    if instance.autoresolve is None:
+      return
+    with profiling.phase("library resolution"):
+      system = self.get_system()
+      system.prefetch_libraries(self.get_autoresolve_names())
+      instance.ensure_auto_resolved(system)
+
   # Gets a persisted file attribute if a valid one can be found, otherwise None.
   def peek_file_attribute(self, file, attrib):
     path = file.get_path()
+    self.add_input_file(path)
     attrib_cache = self.get_attrib_cache()
     if (attrib_cache is None) or (not path in attrib_cache):
+      profiling.count("sticky attribute misses")
       return None
     file_cache = attrib_cache[path]
-    cache_time = file_cache.get("mtime", 0)
-    file_time = file.get_modified_time()
-    if cache_time == file_time:
-      return file_cache.get(attrib, None)
+    (kind, version) = file.get_version()
+    result = None
+    if file_cache.get(kind, None) == version:
+      result = file_cache.get(attrib, None)
+    if result is None:
+      profiling.count("sticky attribute misses")
     else:
-      return None
+      profiling.count("sticky attribute hits")
+    return result
 
   # Persist the given attribute on the given file.
   def set_file_attribute(self, file, attrib, value):
     path = file.get_path()
+    self.add_input_file(path)
     attrib_cache = self.get_attrib_cache()
     if attrib_cache is None:
       return
     if not path in attrib_cache:
       attrib_cache[path] = {}
     file_cache = attrib_cache[path]
-    file_time = file.get_modified_time()
-    cache_time = file_cache.get("mtime", 0)
-    if cache_time != file_time:
-      attrib_cache[path] = {"mtime": file_time}
+    (kind, version) = file.get_version()
+    if file_cache.get(kind, None) != version:
+      attrib_cache[path] = {kind: version}
     attrib_cache[path][attrib] = value
 
   # Returns the library info for the given name, creating it if it doesn't
@@ -746,13 +1270,16 @@ class Environment(object):
   # Returns a list of (name, controller) pairs with an entry for each extension
   # enabled for this build process.
   def get_extensions(self):
-    if self.extensions is None:
-      result = []
-      for (name, module) in self.get_modules():
-        controller = module.get_controller(self)
-        result.append((name, controller))
-      self.extensions = result
-    return self.extensions
+    return [(name, self.get_extension(name)) for name in self.extension_names]
+
+  # Returns the controller for the extension with the given name, importing the
+  # extension module the first time it's requested.
+  def get_extension(self, name):
+    if not name in self.extensions:
+      with profiling.phase("extension loading"):
+        module = self.get_module(name)
+        self.extensions[name] = module.get_controller(self)
+    return self.extensions[name]
 
   # Parse any custom flags understood by the extensions.
   def parse_custom_flags(self, flags):
@@ -800,36 +1327,122 @@ class Environment(object):
     out.write("}\n")
 
   # Writes the nodes loaded into this environment in Makefile syntax to the
-  # given out stream.
-  def write_makefile(self, out, bindir):
+  # given out stream. If a list of goals is given only the nodes required to
+  # build those goals are written. If fragments are enabled the rules for each
+  # context are written to a separate fragment which is included from the
+  # toplevel makefile and only rewritten when its contents change.
+  def write_makefile(self, out, bindir, goals=None):
     makefile = Makefile()
-    for node in self.all_nodes.values():
-      output_target = node.get_output_target()
-      if not output_target:
-        # If the node has no output target there's nothing to do to generate it.
-        continue
-      all_edges = node.get_flat_edges()
-      direct_input_files = [e.get_target().get_input_file() for e in all_edges]
-      extra_input_files = node.get_computed_dependencies()
-      input_files = direct_input_files + extra_input_files
-      input_paths = [f.get_path() for f in input_files]
-      commands = []
-      output_file = node.get_output_file()
-      # If there's a file to produce make sure the parent folder exists.
-      if not output_file is None:
-        output_parent = output_file.get_parent().get_path()
-        mkdir_command = self.get_system().get_ensure_folder_command(output_parent)
-        commands += mkdir_command.get_actions(self)
-      process_command = node.get_command_line(self.get_system())
-      if not process_command is None:
-        commands += process_command.get_actions(self)
-      makefile.add_target(output_target, input_paths, commands, node.is_phony())
+    fragments = {}
+    folders = set()
+    if self.is_lean():
+      # Save the values of the compiler variables before disabling the builtin
+      # ones, otherwise they'll be undefined unless they're set explicitly.
+      makefile.add_preamble("CC := $(CC)")
+      makefile.add_preamble("CXX := $(CXX)")
+      makefile.add_preamble("MAKEFLAGS += -rR")
+      makefile.add_preamble(".SUFFIXES:")
+    if goals:
+      nodes = self.get_reachable_nodes(goals)
+    else:
+      nodes = self.all_nodes.values()
+    for node in nodes:
+      if self.options.fragments:
+        path = self.get_fragment_path(node.get_context())
+        if not path in fragments:
+          fragments[path] = Makefile()
+        self.add_node_target(fragments[path], node, folders)
+      else:
+        self.add_node_target(makefile, node, folders)
+    # In lean mode output folders are created by their own targets which the
+    # outputs depend on, so each is only created once.
+    for folder in sorted(folders):
+      mkdir_command = self.get_system().get_ensure_folder_command(folder)
+      makefile.add_target(folder, [], mkdir_command.get_actions(self), False)
     clean_command = self.get_system().get_clear_folder_command(bindir.get_path())
     clean_actions = clean_command.get_actions(self)
     makefile.add_target("clean", [], clean_actions, True)
+    costs = self.get_target_costs([makefile] + fragments.values())
+    makefile.set_costs(costs)
+    target_names = list(makefile.get_target_names())
+    for (path, fragment) in sorted(fragments.items()):
+      fragment.set_costs(costs)
+      write_if_changed(path, fragment)
+      makefile.add_include(path)
+      target_names += fragment.get_target_names()
+    if fragments:
+      # Make's default goal would otherwise be the first target in the first
+      # fragment; keep it the same as for a single makefile.
+      makefile.set_default_goal(min(target_names))
+    self.write_pool_scripts()
+    if self.is_tracing():
+      self.write_trace_script()
     makefile.set_metadata(self.attrib_cache)
     makefile.write(out)
 
+  # Returns a map from the targets of the given makefiles to the duration of the
+  # longest chain of targets ending with them, based on the durations recorded
+  # by previous builds. Returns None if nothing has been recorded.
+  def get_target_costs(self, makefiles):
+    from . import history
+    path = history.get_history_path(self.options.bindir)
+    if not os.path.exists(path):
+      return None
+    build_history = history.BuildHistory(path)
+    inputs = {}
+    for makefile in makefiles:
+      inputs.update(makefile.get_target_inputs())
+    def get_cost(output):
+      if any([m.is_phony(output) for m in makefiles]):
+        return 0
+      return build_history.get_expected_duration(output)
+    return history.get_critical_path_costs(inputs, get_cost)
+
+  # Adds the target that builds the given node, if there is one, to the given
+  # makefile. In lean mode the output folders required are added to the given
+  # set of folders rather than created by the target itself.
+  def add_node_target(self, makefile, node, folders):
+    output_target = node.get_output_target()
+    if not output_target:
+      # If the node has no output target there's nothing to do to generate it.
+      return
+    input_paths = self.get_node_input_paths(node)
+    commands = []
+    order_only = []
+    output_file = node.get_output_file()
+    # If there's a file to produce make sure the parent folder exists.
+    if not output_file is None:
+      output_parent = output_file.get_parent().get_path()
+      if self.is_lean():
+        folders.add(output_parent)
+        order_only.append(output_parent)
+      else:
+        mkdir_command = self.get_system().get_ensure_folder_command(output_parent)
+        commands += mkdir_command.get_actions(self)
+    with profiling.phase("command lines and flags"):
+      process_command = node.get_command_line(self.get_system())
+    if not process_command is None:
+      process_command.set_pool(self.get_node_pool(node))
+      process_command.set_trace_name(str(node.get_full_name()))
+      commands += process_command.get_actions(self)
+    makefile.add_target(output_target, input_paths, commands, node.is_phony(),
+      order_only)
+
+  # Returns the paths of all the files the given node's output is built from.
+  def get_node_input_paths(self, node):
+    all_edges = node.get_flat_edges()
+    direct_input_files = [e.get_target().get_input_file() for e in all_edges]
+    extra_input_files = node.get_computed_dependencies()
+    input_files = direct_input_files + extra_input_files
+    return [f.get_path() for f in input_files]
+
+  # Returns the path of the makefile fragment that holds the rules for the nodes
+  # created by the given context.
+  def get_fragment_path(self, context):
+    bindir = context.get_nodespace().get_bindir().get_path()
+    parts = context.get_full_name().get_parts()
+    return os.path.join(bindir, *(parts + ("Fragment.mkmk",)))
+
   # Returns a list of the python modules supported by this environment.
   def get_modules(self):
     return list(self.generate_tool_modules())
@@ -838,36 +1451,157 @@ class Environment(object):
   # to build scripts.
   def generate_tool_modules(self):
     for extension in self.extension_names:
-      # So yeah, there are subtle differences between the different ways of
-      # importing programmatically and the plain import statement which means
-      # that I can't for the life of me figure out how to do this cleanly. Also
-      # my life is just too short.
-      if extension == 'c':
-        import mkmk.extension.c
-        yield (extension, mkmk.extension.c)
-      elif extension == 'py':
-        import mkmk.extension.py
-        yield (extension, mkmk.extension.py)
-      elif extension == 'n':
-        import mkmk.extension.n
-        yield (extension, mkmk.extension.n)
-      elif extension == 'test':
-        import mkmk.extension.test
-        yield (extension, mkmk.extension.test)
-      elif extension == 'toc':
-        import mkmk.extension.toc
-        yield (extension, mkmk.extension.toc)
-      else:
-        raise AssertionError("Unknown extension %s" % extension)
+      yield (extension, self.get_module(extension))
+
+  # Imports and returns the tool module for the extension with the given name.
+  def get_module(self, extension):
+    # So yeah, there are subtle differences between the different ways of
+    # importing programmatically and the plain import statement which means
+    # that I can't for the life of me figure out how to do this cleanly. Also
+    # my life is just too short.
+    if extension == 'c':
+      import mkmk.extension.c
+      return mkmk.extension.c
+    elif extension == 'py':
+      import mkmk.extension.py
+      return mkmk.extension.py
+    elif extension == 'n':
+      import mkmk.extension.n
+      return mkmk.extension.n
+    elif extension == 'test':
+      import mkmk.extension.test
+      return mkmk.extension.test
+    elif extension == 'toc':
+      import mkmk.extension.toc
+      return mkmk.extension.toc
+    else:
+      raise AssertionError("Unknown extension %s" % extension)
+
+
+# The folder that holds mkmk's sources. The module's path may be relative to
+# the working directory at the time it was imported so it's resolved right away.
+_PACKAGE_ROOT = os.path.dirname(os.path.abspath(__file__))
+
+
+# Returns the paths of the python source files that make up mkmk.
+def get_mkmk_sources():
+  result = []
+  for (dirpath, dirnames, filenames) in os.walk(_PACKAGE_ROOT):
+    for filename in sorted(filenames):
+      if filename.endswith(".py"):
+        result.append(os.path.join(dirpath, filename))
+  return sorted(result)
+
+
+# Returns the hex md5 digest of the given string.
+def get_digest(source):
+  return hashlib.md5(source).hexdigest()
+
+
+# Writes the given makefile to the given path, unless the file already has
+# exactly the same contents in which case it is left untouched.
+def write_if_changed(path, makefile):
+  out = StringIO()
+  makefile.write(out)
+  write_contents_if_changed(path, out.getvalue())
+
+
+# Moves the file at the given source path to the given target path, replacing
+# any file already there.
+def replace_file(source, target):
+  if (os.name == "nt") and os.path.exists(target):
+    # Renaming onto an existing file fails on windows.
+    os.remove(target)
+  os.rename(source, target)
+
+
+# The stack size of the thread deep recursions run on and the recursion limit
+# within it. Pickling recurses through the graph so deep graphs need a deep
+# stack. The limit is well within what the stack can hold such that a graph
+# that is too deep raises a RuntimeError rather than crashing the process.
+_DEEP_STACK_SIZE = 256 * 1024 * 1024
+_DEEP_RECURSION_LIMIT = 100000
+
+
+# Calls the given function on a thread with a deep stack, waits for it and
+# returns its result or raises its exception. If the stack size can't be set
+# the function is called directly, with the default recursion limit.
+def call_with_deep_stack(fun):
+  import threading
+  try:
+    old_size = threading.stack_size(_DEEP_STACK_SIZE)
+  except (ValueError, threading.ThreadError):
+    return fun()
+  outcome = {}
+  def run():
+    try:
+      outcome["result"] = fun()
+    except BaseException:
+      outcome["error"] = sys.exc_info()
+  limit = sys.getrecursionlimit()
+  sys.setrecursionlimit(max(limit, _DEEP_RECURSION_LIMIT))
+  try:
+    thread = threading.Thread(target=run)
+    thread.start()
+    thread.join()
+  finally:
+    sys.setrecursionlimit(limit)
+    threading.stack_size(old_size)
+  if "error" in outcome:
+    (kind, value, trace) = outcome["error"]
+    raise kind, value, trace
+  return outcome.get("result", None)
+
+
+# Writes the given string to the given path unless the file already has exactly
+# those contents.
+def write_contents_if_changed(path, contents):
+  if os.path.exists(path):
+    with open(path, "rt") as f:
+      if f.read() == contents:
+        return
+  ensure_parent(path)
+  with open(path, "wt") as f:
+    f.write(contents)
 
 
 # Ensures that the parent folder of the given path exists.
 def ensure_parent(path):
   parent = os.path.dirname(path)
-  if not os.path.exists(parent):
+  if parent and not os.path.exists(parent):
     os.makedirs(parent)
 
 
+# Names that, when they occur in a build script, mean evaluating it may affect
+# more than the nodes it defines: pervasive settings, aliases, pools, library
+# info and included scripts. The result of those depends on the order scripts
+# are evaluated in, or they're needed whether or not the script's nodes are.
+_GLOBAL_EFFECT_NAMES = ["pervasive", "alias", "pool", "library_info", "include"]
+
+
+# Returns true if evaluating the build script at the given path may have effects
+# beyond the nodes it defines. This looks at the source only so it is
+# conservative, a comment that mentions an alias is enough.
+def may_have_global_effects(path):
+  with open(path) as handle:
+    source = handle.read()
+  return any([name in source for name in _GLOBAL_EFFECT_NAMES])
+
+
+# Returns the list of goals in the given value of --goals. The goals are
+# typically the arguments passed through to make so anything that looks like an
+# option or a variable assignment is skipped.
+def parse_goals(goals):
+  if goals is None:
+    return []
+  result = []
+  for goal in goals.split():
+    if goal.startswith("-") or ("=" in goal):
+      continue
+    result.append(goal)
+  return result
+
+
 # The main entry-point class for creating a makefile.
 class MkMkMakefile(object):
 
@@ -875,14 +1609,190 @@ class MkMkMakefile(object):
     self.options = options
 
   def run(self):
+    (env, bindir) = self.get_environment()
+    self.write_outputs(env, bindir, self.options.goals)
+
+  # Returns a pair of the environment with all the build scripts evaluated and
+  # the bindir, reusing the snapshot if enabled and still valid.
+  def get_environment(self):
+    self.load_file_metadata()
+    snapshot = None
+    if self.options.snapshot:
+      with profiling.phase("loading snapshot"):
+        snapshot = self.load_snapshot()
+    if snapshot is None:
+      with profiling.phase("evaluating build scripts"):
+        (env, bindir) = self.load_environment()
+      if self.options.snapshot:
+        with profiling.phase("saving snapshot"):
+          self.save_snapshot(env, bindir)
+      return (env, bindir)
+    else:
+      return snapshot
+
+  # Writes the makefile and the files that accompany it for the given
+  # environment, with the rules for the goals given as the value of --goals, or
+  # for everything if that is None.
+  def write_outputs(self, env, bindir, goals):
+    with profiling.phase("writing makefile"):
+      makefile = self.options.makefile
+      ensure_parent(makefile)
+      with open(makefile, "wt") as out:
+        env.write_makefile(out, bindir, parse_goals(goals))
+      self.write_makefile_deps(env, goals)
+
+  # Writes a makefile next to the generated one that lists everything the
+  # generated makefile depends on: build scripts, scanned sources and headers,
+  # folders that were probed, and mkmk itself. This allows a build script to
+  # check whether the makefile is up to date with "make -q" rather than by
+  # running mkmk. If the makefile was generated for a set of goals those are
+  # also written out so they can be compared.
+  def write_makefile_deps(self, env, goals):
     makefile = self.options.makefile
-    env = Environment(self.options, metasource=makefile)
+    inputs = set(env.get_input_files())
+    inputs.update([path for (path, digest) in env.get_scripts()])
+    inputs.update(get_mkmk_sources())
+    deps = Makefile()
+    deps.add_target(makefile, sorted(inputs), ["@false"], False)
+    write_if_changed("%s.deps" % makefile, deps)
+    if not goals is None:
+      with open("%s.goals" % makefile, "wt") as out:
+        out.write("%s\n" % goals)
+
+  # Reads the git index, if enabled, such that the file layer can use it rather
+  # than stat-ing files one at a time.
+  def load_file_metadata(self):
+    if self.options.git_index:
+      with profiling.phase("reading git index"):
+        gitindex.load()
+
+  # Creates the environment and evaluates all the build scripts. Returns a pair
+  # of the environment and the bindir.
+  # Evaluates the build scripts and returns a pair of the environment and the
+  # bindir. If the dependencies turn out not to be independent of each other
+  # when evaluating them in workers, everything is evaluated again serially.
+  def load_environment(self, jobs=None):
+    from . import parallel
+    env = Environment(self.options, metasource=self.options.makefile)
+    if not jobs is None:
+      env.jobs = jobs
     env.parse_custom_flags(self.options.buildflags)
     root_mkmk = AbstractFile.at(self.options.config, env, None)
     root_mkmk_home = root_mkmk.get_parent()
     bindir = AbstractFile.at(self.options.bindir, env, None)
     nodespace = Nodespace(env, None, root_mkmk_home, bindir)
     context = ConfigContext(nodespace, root_mkmk_home, Name.of(), None)
-    context.load(root_mkmk)
-    ensure_parent(makefile)
-    env.write_makefile(open(makefile, "wt"), bindir)
+    try:
+      context.load(root_mkmk)
+      env.ensure_all_deps_loaded()
+    except parallel.SerialFallback, e:
+      env.abandon_dep_workers()
+      logging.info("Evaluating build scripts serially: %s", e)
+      return self.load_environment(1)
+    if env.is_lazy():
+      env.load_goals(self.get_goals())
+    env.get_system().save_library_cache()
+    return (env, bindir)
+
+  # Returns the list of goals requested on the command-line.
+  def get_goals(self):
+    return parse_goals(self.options.goals)
+
+  # Returns the path of the graph snapshot file.
+  def get_snapshot_path(self):
+    return os.path.join(self.options.bindir, "Snapshot.mkmk")
+
+  # Returns the key that determines whether a snapshot taken with a given set
+  # of options can be reused. This covers all the options that influence how
+  # the scripts are evaluated, as well as the mkmk implementation itself since
+  # the snapshot contains pickled instances of its classes.
+  def get_snapshot_flags_key(self):
+    options = self.options
+    modules = [(path, os.path.getmtime(path)) for path in get_mkmk_sources()]
+    return (options.config, options.bindir, options.buildflags,
+      tuple(options.extension), options.system, options.noisy, options.lazy,
+      options.fragments, options.lean, options.trace,
+      tuple(self.get_goals()), tuple(modules))
+
+  # Returns the key that determines whether the libraries resolved while
+  # evaluating the scripts would still resolve the same way: the pkg-config
+  # search path and the .pc files they were resolved from with their
+  # modification times. Returns None if the .pc files of a library aren't
+  # known, in which case a snapshot can't be reused.
+  @staticmethod
+  def get_snapshot_libraries_key(env):
+    file_times = env.get_system().get_library_file_times()
+    if file_times is None:
+      return None
+    return (os.environ.get("PKG_CONFIG_PATH", ""), file_times)
+
+  # Loads the graph snapshot if there is one and it is still valid, that is,
+  # none of the scripts it was built from has changed and it was produced with
+  # the same flags. Returns a pair of the environment and the bindir, or None if
+  # the scripts have to be evaluated.
+  def load_snapshot(self):
+    path = self.get_snapshot_path()
+    if not os.path.exists(path):
+      return None
+    try:
+      return self.read_snapshot(path)
+    except (EOFError, ValueError, pickle.UnpicklingError, AttributeError,
+        ImportError), e:
+      # A snapshot that was cut short or written by a different version of mkmk
+      # is just a snapshot we can't use.
+      logging.info("Couldn't load snapshot: %s", e)
+      return None
+
+  def read_snapshot(self, path):
+    with open(path, "rb") as f:
+      (flags_key, scripts, libraries_key) = pickle.load(f)
+      if flags_key != self.get_snapshot_flags_key():
+        return None
+      if libraries_key is None:
+        return None
+      (pkg_config_path, file_times) = libraries_key
+      if pkg_config_path != os.environ.get("PKG_CONFIG_PATH", ""):
+        return None
+      from . import system
+      for (pc_file, mtime) in file_times:
+        if system.LibraryCache.get_mtime(pc_file) != mtime:
+          return None
+      for (script, digest) in scripts:
+        if not os.path.exists(script):
+          return None
+        with open(script, "rb") as source:
+          if get_digest(source.read()) != digest:
+            return None
+      (env, bindir) = pickle.load(f)
+    # The attribute cache is read fresh from the current makefile rather than
+    # the stale one that was current when the snapshot was taken.
+    env.options = self.options
+    env.attrib_cache = env.read_attrib_cache(self.options.makefile)
+    return (env, bindir)
+
+  # Writes a snapshot of the given environment's graph that can be reused by
+  # later runs as long as no scripts change. The snapshot is taken before any
+  # headers are scanned so those are always recomputed.
+  def save_snapshot(self, env, bindir):
+    path = self.get_snapshot_path()
+    ensure_parent(path)
+    key = (self.get_snapshot_flags_key(), env.get_scripts(),
+      self.get_snapshot_libraries_key(env))
+    # The snapshot is written next to the old one and moved into place once
+    # complete such that an interrupted write never leaves a truncated one.
+    temp_path = "%s.%i.tmp" % (path, os.getpid())
+    def write():
+      with open(temp_path, "wb") as f:
+        pickle.dump(key, f, pickle.HIGHEST_PROTOCOL)
+        pickle.dump((env, bindir), f, pickle.HIGHEST_PROTOCOL)
+    try:
+      call_with_deep_stack(write)
+      replace_file(temp_path, path)
+    except (pickle.PicklingError, TypeError, RuntimeError), e:
+      # Scripts can stash arbitrary values on nodes so not every graph can be
+      # pickled, and some graphs are too deep. That's fine, we just won't be
+      # able to reuse this one.
+      logging.warning("Couldn't snapshot build graph: %s", e)
+      for stale in [temp_path, path]:
+        if os.path.exists(stale):
+          os.remove(stale)
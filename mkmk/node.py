@@ -5,6 +5,7 @@
 
 from abc import ABCMeta, abstractmethod
 from command import Command, shell_escape
+import profiling
 
 # An abstract build node. Build nodes are the basic unit of dependencies in the
 # build system. They may or may not correspond to a physical file. You don't
@@ -18,6 +19,7 @@ class Node(object):
     self.name = name
     self.edges = []
     self.full_name = self.context.get_full_name().append(self.name)
+    self.pool = None
 
   # Returns the name of this node, the last part of the full name of this node.
   def get_name(self):
@@ -27,6 +29,11 @@ class Node(object):
   def get_full_name(self):
     return self.full_name
 
+  # Returns the name of this node that is unique across all dependencies, the
+  # full name prefixed with the name of the dependency it belongs to.
+  def get_global_name(self):
+    return self.context.get_nodespace().get_global_name(self.full_name)
+
   # Returns the display name that best describes this node. This is only used
   # for describing the node in output, it makes no semantic difference.
   def get_display_name(self):
@@ -51,6 +58,7 @@ class Node(object):
   # Generated the edges emanating from this node, flattening groups. Only edges
   # that match the given annotations are returned.
   def get_flat_edges(self, **annots):
+    profiling.count("get_flat_edges calls")
     for edge in self.edges:
       target = edge.get_target()
       for transitive in target.get_flat_edges_through(edge, annots):
@@ -115,10 +123,36 @@ class Node(object):
   def get_computed_dependencies(self):
     return []
 
+  # Returns a description of how the computed dependency with the given path
+  # came to be a dependency of this node, or None if it isn't known.
+  def get_computed_dependency_origin(self, path):
+    return None
+
   # Should the corresponding makefile target be marked as phony?
   def is_phony(self):
     return False
 
+  # Runs the command that produces this node within the job pool with the given
+  # name, which limits how many commands from the pool can run at the same time.
+  def set_pool(self, name):
+    self.pool = name
+    return self
+
+  # Returns the name of the job pool this node was explicitly assigned to, or
+  # None.
+  def get_pool(self):
+    return self.pool
+
+  # Returns the name of the pool to use for this node if it hasn't been assigned
+  # one and a pool with that name has been defined. By default None.
+  def get_default_pool(self):
+    return None
+
+  # Discards anything this node has computed from the contents of files, for
+  # instance because a file has changed. By default does nothing.
+  def invalidate(self):
+    pass
+
   def __str__(self):
     return "%s(%s, %s)" % (type(self).__name__, self.context, self.name)
 
@@ -175,6 +209,7 @@ class CustomExecNode(PhysicalNode):
     self.args = []
     self.env = []
     self.title = None
+    self.jobserver = False
 
   def get_output_file(self):
     return self.get_context().get_outdir_file(self.subject)
@@ -187,7 +222,8 @@ class CustomExecNode(PhysicalNode):
     builder = (self.get_run_command_builder(system)
         .add_arguments(self.get_arguments())
         .add_env(self.env)
-        .set_comment(title))
+        .set_comment(title)
+        .set_jobserver(self.jobserver))
     if self.should_tee_output():
       outpath = self.get_output_path()
       builder.set_tee_destination(outpath)
@@ -212,6 +248,13 @@ class CustomExecNode(PhysicalNode):
     self.title = title
     return self
 
+  # Declares that the runner takes part in make's jobserver, for instance
+  # because it runs make or a tool that runs jobs in parallel, such that its jobs
+  # count against the budget of the toplevel make.
+  def set_jobserver_aware(self, value=True):
+    self.jobserver = value
+    return self
+
   # Sets the (string) arguments to pass to the runner.
   def set_arguments(self, *args):
     self.args = args
@@ -0,0 +1,300 @@
+#- Copyright 2014 GOTO 10.
+#- Licensed under the Apache License, Version 2.0 (see LICENSE).
+
+## Evaluation of dependency build scripts in worker processes.
+##
+## Each dependency lives in its own nodespace with its own root and bindir so
+## the scripts of one dependency can be evaluated independently of the others.
+## The evaluator hands each dependency to a worker process which evaluates it
+## in a fresh environment and sends the resulting nodes back, pickled. Objects
+## that are shared with the parent, the environment itself, the extension
+## controllers, the pervasive attributes and so on, are pickled by reference
+## such that the nodes that come back point to the parent's instances rather
+## than to copies.
+##
+## Pervasive settings are shared by all scripts so the order in which they're
+## changed matters. When a dependency is submitted we take a mark of the
+## pervasive attributes that support it and the changes the worker makes are
+## later inserted at that mark, which gives the same result as evaluating the
+## dependency's scripts at the point where they were included. Results are
+## merged in the order the dependencies were submitted for the same reason.
+##
+## This only works if the dependencies are independent of each other. A worker
+## can't see the dependencies loaded outside it, and if several of them load
+## the same nested dependency each gets its own copy. In either case evaluation
+## fails with SerialFallback and the scripts are evaluated again serially.
+
+import jobserver
+import makefile
+import multiprocessing
+
+try:
+  import cPickle as pickle
+except ImportError:
+  import pickle
+
+try:
+  from cStringIO import StringIO
+except ImportError:
+  from io import BytesIO as StringIO
+
+
+# Raised when dependencies being evaluated in workers turn out to depend on each
+# other such that the scripts have to be evaluated serially.
+class SerialFallback(Exception):
+  pass
+
+
+# Keeps track of the dependencies being evaluated by a pool of workers on behalf
+# of an environment.
+class DepEvaluator(object):
+
+  def __init__(self, env, jobs):
+    self.env = env
+    # When running under make -j the workers beyond the first take their job
+    # slots from make's budget.
+    self.jobserver = jobserver.get_jobserver()
+    self.tokens = []
+    if (not self.jobserver is None) and (jobs > 1):
+      self.tokens = self.jobserver.try_acquire_many(jobs - 1)
+      jobs = len(self.tokens) + 1
+    self.pool = multiprocessing.Pool(jobs)
+    self.pending = {}
+    # The names of the pending dependencies in the order they were submitted.
+    self.order = []
+    # Map from (attribute, setting) pairs to the number of pervasive values
+    # inserted by the results merged so far.
+    self.inserted = {}
+
+  # Starts evaluating the given mkmk file, the root of the dependency whose
+  # nodes live in the given nodespace, in a worker.
+  def submit(self, nodespace, mkmk_file):
+    name = nodespace.get_prefix()
+    loaded = sorted([d for d in self.env.deps.keys() if d != name])
+    args = (self.env.options, name, nodespace.get_root().get_path(),
+      nodespace.get_bindir().get_path(), mkmk_file.get_path(),
+      encode_state(self.env), loaded)
+    marks = get_pervasive_marks(self.env)
+    self.pending[name] = (self.pool.apply_async(evaluate_dep, args), marks,
+      dict(self.inserted))
+    self.order.append(name)
+
+  # Is the dependency with the given name still being evaluated?
+  def is_pending(self, name):
+    return name in self.pending
+
+  # Waits for the dependency with the given name, and those submitted before it,
+  # to be evaluated and merges the results into the environment.
+  def join(self, name):
+    while name in self.pending:
+      current = self.order.pop(0)
+      (result, marks, inserted) = self.pending.pop(current)
+      # Values inserted by results merged since this dependency was submitted
+      # were inserted before its mark so they shift where its values go.
+      shifts = {}
+      for (key, count) in self.inserted.items():
+        shifts[key] = count - inserted.get(key, 0)
+      added = merge_result(self.env, current, result.get(), marks, shifts)
+      for (key, count) in added.items():
+        self.inserted[key] = self.inserted.get(key, 0) + count
+
+  # Shuts down the workers without waiting for the pending dependencies.
+  def terminate(self):
+    self.pool.terminate()
+    self.pool.join()
+    self.pending = {}
+    self.order = []
+    if self.tokens:
+      self.jobserver.release_all(self.tokens)
+      self.tokens = []
+
+  # Waits for all dependencies to be evaluated, then shuts down the workers.
+  def join_all(self):
+    while self.pending:
+      self.join(self.order[-1])
+    self.pool.close()
+    self.pool.join()
+    if self.tokens:
+      self.jobserver.release_all(self.tokens)
+      self.tokens = []
+
+
+# Returns a map from the keys of the pervasive attributes of the given
+# environment that can have changes inserted, such as the c settings, to their
+# marks.
+def get_pervasive_marks(env):
+  result = {}
+  for (key, value) in env.transient_attribs.items():
+    if hasattr(value, "get_mark"):
+      result[key] = value.get_mark()
+  return result
+
+
+# Returns the objects owned by the given environment that should be pickled by
+# reference, as a map from their ids to (reference, object) pairs.
+def get_shared_objects(env):
+  result = {}
+  def add(ref, obj):
+    result[id(obj)] = (ref, obj)
+  add("env", env)
+  for (name, controller) in env.extensions.items():
+    add(("extension", name), controller)
+  for (key, value) in env.transient_attribs.items():
+    add(("transient", key), value)
+  for (name, info) in env.library_info.items():
+    add(("library", name), info)
+  for (name, nodespace) in env.deps.items():
+    add(("nodespace", name), nodespace)
+  return result
+
+
+# Resolves a reference produced by get_shared_objects to the corresponding
+# object in the given environment.
+def resolve_shared_object(env, ref):
+  if ref == "env":
+    return env
+  (kind, name) = ref
+  if kind == "extension":
+    return env.get_extension(name)
+  elif kind == "transient":
+    return env.get_transient_attribute(name)
+  elif kind == "library":
+    return env.get_library_info(name)
+  elif kind == "nodespace":
+    return env.get_dep(name)
+  else:
+    raise AssertionError("Unknown reference %s" % kind)
+
+
+# Pickles the given value, replacing any of the given shared objects with their
+# references.
+def dumps(value, shared):
+  def persistent_id(obj):
+    entry = shared.get(id(obj), None)
+    if (entry is None) or not (entry[1] is obj):
+      return None
+    return entry[0]
+  out = StringIO()
+  pickler = pickle.Pickler(out, pickle.HIGHEST_PROTOCOL)
+  pickler.persistent_id = persistent_id
+  pickler.dump(value)
+  return out.getvalue()
+
+
+# Unpickles the given data, resolving references against the given environment.
+def loads(data, env):
+  unpickler = pickle.Unpickler(StringIO(data))
+  unpickler.persistent_load = lambda ref: resolve_shared_object(env, ref)
+  return unpickler.load()
+
+
+# Returns the state of the environment that the scripts of a dependency may
+# need: the pervasive attributes, the library info and the job pools.
+def encode_state(env):
+  return pickle.dumps((env.transient_attribs, env.library_info, env.pools),
+    pickle.HIGHEST_PROTOCOL)
+
+
+# The entry-point of the workers. Evaluates the given dependency in a fresh
+# environment and returns a (deps, scripts, body) triple, where deps describes
+# the nodespaces created, scripts lists the scripts loaded and body holds the
+# pickled nodes and any new pervasive attributes, library info and pools. The
+# names of the dependencies already loaded outside the worker are given as
+# loaded.
+def evaluate_dep(options, name, root_path, bindir_path, script_path, state,
+    loaded):
+  env = makefile.Environment(options, metasource=options.makefile)
+  env.parse_custom_flags(options.buildflags)
+  # Nested deps are evaluated within this worker.
+  env.jobs = 1
+  env.foreign_deps = set(loaded)
+  (transient_attribs, library_info, pools) = pickle.loads(state)
+  env.transient_attribs.update(transient_attribs)
+  env.library_info.update(library_info)
+  env.pools.update(pools)
+  marks = get_pervasive_marks(env)
+  shared = get_shared_objects(env)
+  root = makefile.AbstractFile.at(root_path, env, None)
+  bindir = makefile.AbstractFile.at(bindir_path, env, None)
+  nodespace = env.create_dep(name, root, bindir)
+  context = makefile.ConfigContext(nodespace, root, makefile.Name.of(), None)
+  context.load(makefile.AbstractFile.at(script_path, env, root))
+  # The controllers and nodespaces created while loading are shared too. New
+  # pervasive attributes are sent by value ahead of the nodes such that the
+  # parent can decide which instance to use before the nodes are unpickled.
+  for (ref, obj) in get_shared_objects(env).values():
+    if ref == "env" or ref[0] in ["extension", "nodespace"]:
+      shared[id(obj)] = (ref, obj)
+  new_transient = dict([(k, v) for (k, v) in env.transient_attribs.items()
+    if not k in transient_attribs])
+  transient_body = dumps(new_transient, shared)
+  changes = {}
+  for (key, value) in env.transient_attribs.items():
+    if hasattr(value, "get_changes_since"):
+      changes[key] = value.get_changes_since(marks.get(key, {}))
+    shared[id(value)] = (("transient", key), value)
+  deps = []
+  nodes = {}
+  for (dep_name, dep) in sorted(env.deps.items()):
+    deps.append((dep_name, dep.get_root().get_path(), dep.get_bindir().get_path()))
+    nodes[dep_name] = list(dep.nodes.items())
+  new_libraries = dict([(k, v) for (k, v) in env.library_info.items()
+    if not k in library_info])
+  new_pools = dict([(k, v) for (k, v) in env.pools.items() if not k in pools])
+  body = dumps((nodes, changes, new_libraries, new_pools), shared)
+  return (deps, env.get_scripts(), transient_body, body)
+
+
+# Merges the result of evaluating the dependency with the given name in a worker
+# into the given environment. The marks are those of the pervasive attributes
+# when the dependency was submitted and the shifts tell how many values have
+# been inserted before them since. Returns a map from (attribute, setting) pairs
+# to the number of pervasive values inserted.
+def merge_result(env, name, result, marks, shifts):
+  (deps, scripts, transient_body, body) = result
+  # Create the nodespaces of the nested dependencies before unpickling since the
+  # nodes refer to them. If one has been loaded by someone else in the meantime
+  # the worker's copy would be loaded a second time.
+  owned = set([name])
+  for (dep_name, root_path, bindir_path) in deps:
+    if dep_name == name:
+      continue
+    if not env.get_dep(dep_name) is None:
+      raise SerialFallback("dependency %s is loaded by more than one script" % dep_name)
+    root = makefile.AbstractFile.at(root_path, env, None)
+    bindir = makefile.AbstractFile.at(bindir_path, env, None)
+    env.create_dep(dep_name, root, bindir)
+    owned.add(dep_name)
+  # Pervasive attributes the worker created are only used if they still don't
+  # exist here, otherwise the changes are applied to the existing ones.
+  inserted = {}
+  adopted = set()
+  for (key, value) in loads(transient_body, env).items():
+    if env.get_transient_attribute(key) is None:
+      env.set_transient_attribute(key, value)
+      adopted.add(key)
+      if hasattr(value, "get_mark"):
+        for (setting, count) in value.get_mark().items():
+          inserted[(key, setting)] = count
+  (nodes, changes, new_libraries, new_pools) = loads(body, env)
+  for (key, attrib_changes) in changes.items():
+    if key in adopted:
+      continue
+    value = env.get_transient_attribute(key)
+    attrib_shifts = dict([(s, c) for ((k, s), c) in shifts.items() if k == key])
+    added = value.insert_changes(attrib_changes, marks.get(key, {}), attrib_shifts)
+    for (setting, count) in added.items():
+      inserted[(key, setting)] = count
+  for dep_name in sorted(owned):
+    nodespace = env.get_dep(dep_name)
+    for (full_name, node) in nodes.get(dep_name, []):
+      nodespace.add_node(full_name, node)
+  for (lib_name, info) in new_libraries.items():
+    if not lib_name in env.library_info:
+      env.library_info[lib_name] = info
+  for (pool_name, depth) in new_pools.items():
+    if not pool_name in env.pools:
+      env.add_pool(pool_name, depth)
+  for (path, source_digest) in scripts:
+    env.scripts.append((path, source_digest))
+  return inserted
@@ -0,0 +1,282 @@
+#- Copyright 2014 GOTO 10.
+#- Licensed under the Apache License, Version 2.0 (see LICENSE).
+
+## Self-profiling of mkmk itself.
+##
+## The different phases of generating a makefile are wrapped in calls to
+## phase(name) which, when profiling is enabled, records the wall and cpu time
+## spent in them. Phases nest, build scripts include each other and scanning
+## headers happens while writing the makefile, so besides the total time of
+## each phase we also keep its self time, the time not spent in nested phases,
+## which is what adds up to the total.
+##
+## Separately there are counters of the file system calls and other operations
+## on the hot paths of the generator, which tell how the cost of generating the
+## makefile scales with the size of the build.
+
+from contextlib import contextmanager
+import os
+import sys
+import time
+
+
+# Returns the cpu time, user and system, used by this process so far.
+def get_cpu_time():
+  times = os.times()
+  return times[0] + times[1]
+
+
+# The statistics gathered about a single phase.
+class PhaseStats(object):
+
+  def __init__(self, name):
+    self.name = name
+    self.count = 0
+    self.wall = 0.0
+    self.cpu = 0.0
+    self.self_wall = 0.0
+    self.self_cpu = 0.0
+
+
+# An active phase: when it started and how much time was spent in nested phases.
+class PhaseFrame(object):
+
+  def __init__(self, name):
+    self.name = name
+    self.wall_start = time.time()
+    self.cpu_start = get_cpu_time()
+    self.child_wall = 0.0
+    self.child_cpu = 0.0
+
+
+class Profiler(object):
+
+  def __init__(self):
+    self.enabled = False
+    self.stats = {}
+    self.stack = []
+    self.wall_start = time.time()
+    self.cpu_start = get_cpu_time()
+
+  def enable(self):
+    self.enabled = True
+
+  def is_enabled(self):
+    return self.enabled
+
+  def get_stats(self, name):
+    if not name in self.stats:
+      self.stats[name] = PhaseStats(name)
+    return self.stats[name]
+
+  # Records time spent in a phase that wasn't measured using phase(), for
+  # instance because it happened before profiling could be enabled.
+  def record(self, name, wall, cpu):
+    stats = self.get_stats(name)
+    stats.count += 1
+    stats.wall += wall
+    stats.cpu += cpu
+    stats.self_wall += wall
+    stats.self_cpu += cpu
+
+  # Measures the time spent in the body of the with statement as the given phase.
+  @contextmanager
+  def phase(self, name):
+    if not self.enabled:
+      yield
+      return
+    frame = PhaseFrame(name)
+    self.stack.append(frame)
+    try:
+      yield
+    finally:
+      self.stack.pop()
+      wall = time.time() - frame.wall_start
+      cpu = get_cpu_time() - frame.cpu_start
+      stats = self.get_stats(name)
+      stats.count += 1
+      # A phase that is already active further down the stack, a script that
+      # includes another script say, has its time counted only once.
+      if not name in [f.name for f in self.stack]:
+        stats.wall += wall
+        stats.cpu += cpu
+      stats.self_wall += wall - frame.child_wall
+      stats.self_cpu += cpu - frame.child_cpu
+      if self.stack:
+        parent = self.stack[-1]
+        parent.child_wall += wall
+        parent.child_cpu += cpu
+
+  # Writes a report of the phases to the given stream. Phases whose names start
+  # with one of the given prefixes are listed in their own sections.
+  def write_report(self, out, sections=[]):
+    total_wall = time.time() - self.wall_start
+    total_cpu = get_cpu_time() - self.cpu_start
+    out.write("Total: %.3fs wall, %.3fs cpu\n" % (total_wall, total_cpu))
+    groups = [("Phases", None)] + sections
+    for (title, prefix) in groups:
+      if prefix is None:
+        stats = [s for s in self.stats.values()
+          if not any([s.name.startswith(p) for (t, p) in sections])]
+      else:
+        stats = [s for s in self.stats.values() if s.name.startswith(prefix)]
+      if not stats:
+        continue
+      out.write("\n%s:\n" % title)
+      out.write("%10s %10s %10s %10s %7s  %s\n" % ("self wall", "wall",
+        "self cpu", "cpu", "calls", "name"))
+      for s in sorted(stats, key=lambda s: (-s.self_wall, s.name)):
+        name = s.name
+        if not prefix is None:
+          name = name[len(prefix):]
+        out.write("%9.3fs %9.3fs %9.3fs %9.3fs %7i  %s\n" % (s.self_wall, s.wall,
+          s.self_cpu, s.cpu, s.count, name))
+
+
+_PROFILER = Profiler()
+# Returns the profiler for this process.
+def get_profiler():
+  return _PROFILER
+
+
+# A context manager that does nothing, used for phases when profiling is off
+# such that they cost no more than a function call on the hot paths.
+class NullPhase(object):
+
+  def __enter__(self):
+    return None
+
+  def __exit__(self, *args):
+    return False
+
+
+_NULL_PHASE = NullPhase()
+# Shorthand for measuring a phase with the profiler for this process.
+def phase(name):
+  if not _PROFILER.enabled:
+    return _NULL_PHASE
+  return _PROFILER.phase(name)
+
+
+# Tracks the memory allocated by mkmk. Uses tracemalloc where it's available,
+# otherwise falls back to the peak resident set size of the process which is
+# coarser but always there.
+class MemoryTracker(object):
+
+  def __init__(self):
+    try:
+      import tracemalloc
+      self.tracemalloc = tracemalloc
+    except ImportError:
+      self.tracemalloc = None
+
+  def start(self):
+    if not self.tracemalloc is None:
+      self.tracemalloc.start()
+
+  def write_report(self, out):
+    if not self.tracemalloc is None:
+      (current, peak) = self.tracemalloc.get_traced_memory()
+      out.write("\nPeak traced allocations: %.1f MB\n" % (peak / (1024.0 * 1024.0)))
+      snapshot = self.tracemalloc.take_snapshot()
+      for stat in snapshot.statistics("lineno")[:10]:
+        out.write("  %s\n" % stat)
+    else:
+      import resource
+      peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+      out.write("\nPeak resident set size: %.1f MB (tracemalloc not available)\n" %
+        (peak / 1024.0))
+
+
+# Runs the given function with profiling enabled as requested by the given
+# options, then reports the results to stderr.
+def run_profiled(options, fun):
+  profiler = get_profiler()
+  profiler.enable()
+  memory = None
+  if options.profile_memory:
+    memory = MemoryTracker()
+    memory.start()
+  stats = None
+  if options.profile_stats:
+    import cProfile
+    stats = cProfile.Profile()
+    stats.enable()
+  try:
+    return fun()
+  finally:
+    if not stats is None:
+      stats.disable()
+      stats.dump_stats(options.profile_stats)
+    profiler.write_report(sys.stderr, [("Build scripts", "script: ")])
+    if not memory is None:
+      memory.write_report(sys.stderr)
+
+
+# Counters of how often the generator performs the operations that are
+# expensive at scale, file system calls in particular, keyed by name. They're
+# only kept when enabled, for --stats, since they're updated on the hot paths.
+_COUNTERS = {}
+_COUNTING = False
+
+
+# Starts keeping counters.
+def enable_counting():
+  global _COUNTING
+  _COUNTING = True
+
+
+# Adds the given amount to the counter with the given name, if counting.
+def count(name, amount=1):
+  if not _COUNTING:
+    return
+  _COUNTERS[name] = _COUNTERS.get(name, 0) + amount
+
+
+# Returns a copy of the current counter values.
+def get_counters():
+  return dict(_COUNTERS)
+
+
+# Returns the given number of hits as a percentage of all lookups, or None if
+# there were no lookups.
+def get_hit_rate(hits, misses):
+  total = hits + misses
+  if total == 0:
+    return None
+  return 100.0 * hits / total
+
+
+# Writes a readable report of the counters to the given stream.
+def write_counters(out, counters):
+  out.write("Counters:\n")
+  for name in sorted(counters.keys()):
+    out.write("%12i  %s\n" % (counters[name], name))
+  rates = [
+    ("exists() cache", "exists cache hits", "exists probes"),
+    ("sticky attributes", "sticky attribute hits", "sticky attribute misses"),
+  ]
+  for (title, hits, misses) in rates:
+    rate = get_hit_rate(counters.get(hits, 0), counters.get(misses, 0))
+    if not rate is None:
+      out.write("%11.1f%%  %s hit rate\n" % (rate, title))
+
+
+# Returns the path of the file the counters of generating the given makefile
+# are written to.
+def get_counters_path(makefile):
+  return "%s.stats" % makefile
+
+
+# Runs the given function with counting enabled then prints the counters to
+# stderr and writes them as json next to the given makefile.
+def run_counted(makefile, fun):
+  enable_counting()
+  try:
+    return fun()
+  finally:
+    counters = get_counters()
+    write_counters(sys.stderr, counters)
+    import json
+    with open(get_counters_path(makefile), "wt") as out:
+      json.dump(counters, out, sort_keys=True, indent=2)
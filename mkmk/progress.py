@@ -0,0 +1,81 @@
+#- Copyright 2014 GOTO 10.
+#- Licensed under the Apache License, Version 2.0 (see LICENSE).
+
+## A machine-readable stream of the progress of a build.
+##
+## Events are written as json objects, one per line, to a file or fifo such
+## that dashboards and terminals can follow along while the build runs. A build
+## produces
+##
+##   {"event": "build", "time": 1.0, "total": 120, "eta": 95.2}
+##   {"event": "start", "time": 1.0, "target": "out/foo.o", "name": "src/foo.c:object"}
+##   {"event": "finish", "time": 2.5, "target": "out/foo.o", "duration": 1.5,
+##    "done": 1, "total": 120, "eta": 93.7}
+##   {"event": "failure", "time": 2.5, "target": "out/bar.o", "status": 1,
+##    "done": 1, "total": 120, "eta": 93.7}
+##   {"event": "end", "time": 60.1, "success": false, "done": 1, "total": 120}
+##
+## where total is the number of targets the build is expected to run commands
+## for and eta is the number of seconds the rest of the build is expected to
+## take, estimated from the durations recorded by previous builds.
+
+import json
+import time
+
+
+class ProgressReporter(object):
+
+  # Reports to the given stream. The total is the number of targets expected to
+  # be built, get_expected_duration returns how many seconds a target is
+  # expected to take, and slots is how many targets can be built at once.
+  def __init__(self, out, total, get_expected_duration, slots):
+    self.out = out
+    self.total = total
+    self.get_expected_duration = get_expected_duration
+    self.slots = max(slots, 1)
+    self.done = 0
+    # The expected duration of the targets that haven't been started.
+    self.pending_work = 0
+    # Map from targets that are being built to when they started.
+    self.running = {}
+
+  def write_event(self, event, **fields):
+    fields["event"] = event
+    fields["time"] = time.time()
+    self.out.write("%s\n" % json.dumps(fields, sort_keys=True))
+    self.out.flush()
+
+  # Returns the number of seconds the rest of the build is expected to take if
+  # the remaining work is spread evenly across the slots.
+  def get_eta(self):
+    now = time.time()
+    running = [max(self.get_expected_duration(t) - (now - s), 0)
+      for (t, s) in self.running.items()]
+    spread = (self.pending_work + sum(running)) / self.slots
+    return round(max([spread] + running), 1)
+
+  # Called before the build starts with the targets it expects to build.
+  def build_started(self, targets):
+    self.pending_work = sum([self.get_expected_duration(t) for t in targets])
+    self.write_event("build", total=self.total, eta=self.get_eta())
+
+  def target_started(self, target, name):
+    self.pending_work = max(self.pending_work - self.get_expected_duration(target), 0)
+    self.running[target] = time.time()
+    self.write_event("start", target=target, name=name)
+
+  def target_finished(self, target, duration):
+    del self.running[target]
+    self.done += 1
+    # Targets that weren't expected to be built are still counted.
+    self.total = max(self.total, self.done)
+    self.write_event("finish", target=target, duration=duration, done=self.done,
+      total=self.total, eta=self.get_eta())
+
+  def target_failed(self, target, status):
+    del self.running[target]
+    self.write_event("failure", target=target, status=status, done=self.done,
+      total=self.total, eta=self.get_eta())
+
+  def build_finished(self, success):
+    self.write_event("end", success=success, done=self.done, total=self.total)
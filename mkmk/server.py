@@ -0,0 +1,240 @@
+#- Copyright 2014 GOTO 10.
+#- Licensed under the Apache License, Version 2.0 (see LICENSE).
+
+## A persistent mkmk process that keeps the build graph in memory.
+##
+## The server loads the build scripts once and then waits for requests on a unix
+## socket. Between requests it polls the files the graph was computed from, and
+## when they change it updates the graph: if a build script changes, or files
+## are added to or removed from a folder, the scripts are evaluated again, and
+## if the contents of sources or headers change only the information computed
+## from those files is discarded. Clients send one json-encoded request per
+## connection and get one json-encoded response back.
+
+import json
+import logging
+import makefile
+import os
+import os.path
+import select
+import socket
+
+
+# How often, in seconds, to check for changed files while idle.
+_POLL_INTERVAL = 0.5
+
+
+# Returns the path of the socket the server for the given options listens on.
+def get_socket_path(options):
+  if options.socket:
+    return options.socket
+  else:
+    return os.path.join(options.bindir, "mkmk.sock")
+
+
+# Returns the key that determines whether a server can answer requests from a
+# client with the given options.
+def get_options_key(options):
+  sources = [(path, os.path.getmtime(path)) for path in makefile.get_mkmk_sources()]
+  key = (os.getcwd(), options.config, options.bindir, options.makefile,
+    options.buildflags, options.extension, options.system, options.noisy,
+    options.lazy, options.fragments, options.lean, options.trace,
+    options.git_index, options.snapshot, sources)
+  # Normalize the key the same way it will be when sent over the socket.
+  return json.loads(json.dumps(key))
+
+
+# Keeps track of the modification times of a set of files and reports which
+# ones have changed.
+class FileWatcher(object):
+
+  def __init__(self):
+    self.mtimes = {}
+
+  @staticmethod
+  def get_mtime(path):
+    try:
+      return os.path.getmtime(path)
+    except OSError:
+      return None
+
+  # Starts watching the given paths, ignoring those already being watched.
+  def watch(self, paths):
+    for path in paths:
+      if not path in self.mtimes:
+        self.mtimes[path] = self.get_mtime(path)
+
+  # Returns the sorted list of paths that have changed since they were last
+  # checked.
+  def get_changes(self):
+    result = []
+    for (path, mtime) in self.mtimes.items():
+      current = self.get_mtime(path)
+      if current != mtime:
+        self.mtimes[path] = current
+        result.append(path)
+    return sorted(result)
+
+
+# The server that keeps the environment warm.
+class MkMkServer(object):
+
+  def __init__(self, options):
+    self.options = options
+    self.runner = makefile.MkMkMakefile(options)
+    self.key = get_options_key(options)
+    self.env = None
+    self.bindir = None
+    self.watcher = None
+
+  # Evaluates all the build scripts from scratch.
+  def reload(self):
+    logging.info("Loading build scripts")
+    self.runner.load_file_metadata()
+    (self.env, self.bindir) = self.runner.load_environment()
+    self.watcher = FileWatcher()
+    self.watch_inputs()
+
+  # Starts watching all the files the environment depends on.
+  def watch_inputs(self):
+    self.watcher.watch([path for (path, digest) in self.env.get_scripts()])
+    self.watcher.watch(self.env.get_input_files())
+
+  # Brings the environment up to date with any changes to the files it was
+  # computed from.
+  def update(self):
+    changes = self.watcher.get_changes()
+    if not changes:
+      return
+    scripts = set([path for (path, digest) in self.env.get_scripts()])
+    for path in changes:
+      # Only changes to the contents of existing regular files can be handled
+      # incrementally.
+      if (path in scripts) or (not os.path.isfile(path)):
+        self.reload()
+        return
+    logging.info("Files changed: %s", " ".join(changes))
+    for path in changes:
+      self.env.invalidate_file(path)
+
+  # Handles a single request and returns the response.
+  def handle_request(self, request):
+    if request.get("key", None) != self.key:
+      return {"status": "mismatch"}
+    command = request.get("command", None)
+    if command == "makefile":
+      self.update()
+      # The goals are the client's --goals, which also go into the .goals file.
+      self.runner.write_outputs(self.env, self.bindir, request.get("goals", None))
+      self.watch_inputs()
+      return {"status": "ok"}
+    elif command == "stop":
+      return {"status": "ok"}
+    else:
+      return {"status": "error", "message": "Unknown command %s" % command}
+
+  # Reads a request from the given connection and sends back the response.
+  # Returns the request, or an empty one if it couldn't be read. Whatever the
+  # client sends the server keeps serving.
+  def serve_connection(self, connection):
+    try:
+      message = read_message(connection)
+    except socket.error, e:
+      logging.warning("Couldn't read request: %s", e)
+      return {}
+    request = parse_request(message)
+    if request is None:
+      response = {"status": "error", "message": "Malformed request"}
+      request = {}
+    else:
+      try:
+        response = self.handle_request(request)
+      except Exception, e:
+        logging.exception("Request failed")
+        response = {"status": "error", "message": str(e)}
+    try:
+      connection.sendall(json.dumps(response))
+    except socket.error, e:
+      logging.warning("Couldn't send response: %s", e)
+    return request
+
+  # Serves requests on the socket until asked to stop.
+  def run(self):
+    self.reload()
+    path = get_socket_path(self.options)
+    if os.path.exists(path):
+      os.remove(path)
+    makefile.ensure_parent(path)
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(path)
+    server.listen(5)
+    logging.info("Serving on %s", path)
+    try:
+      while True:
+        (readable, writable, errors) = select.select([server], [], [], _POLL_INTERVAL)
+        if not readable:
+          self.update()
+          continue
+        (connection, address) = server.accept()
+        try:
+          request = self.serve_connection(connection)
+        finally:
+          connection.close()
+        if request.get("command", None) == "stop":
+          return
+    finally:
+      server.close()
+      os.remove(path)
+
+
+# Returns the request encoded in the given message, or None if it isn't a
+# json-encoded object.
+def parse_request(message):
+  try:
+    result = json.loads(message)
+  except ValueError:
+    return None
+  if not isinstance(result, dict):
+    return None
+  return result
+
+
+# Reads everything the other end of the given connection sends until it shuts
+# down its end.
+def read_message(connection):
+  chunks = []
+  while True:
+    chunk = connection.recv(65536)
+    if not chunk:
+      break
+    chunks.append(chunk)
+  return "".join(chunks)
+
+
+# Sends the given request to the server for the given options, if there is one.
+# Returns the response if the server handled the request, otherwise None in
+# which case the caller should do the work itself.
+def try_request(options, command, **params):
+  path = get_socket_path(options)
+  if not os.path.exists(path):
+    return None
+  request = dict(params)
+  request["command"] = command
+  request["key"] = get_options_key(options)
+  client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+  try:
+    client.connect(path)
+    client.sendall(json.dumps(request))
+    client.shutdown(socket.SHUT_WR)
+    response = json.loads(read_message(client))
+  except socket.error:
+    # There's a socket but nobody is listening, most likely left over from a
+    # server that died.
+    return None
+  finally:
+    client.close()
+  if response.get("status", None) == "ok":
+    return response
+  elif response.get("status", None) == "error":
+    logging.warning("Server failed: %s", response.get("message", None))
+  return None
@@ -7,6 +7,8 @@
 
 from abc import ABCMeta, abstractmethod
 from command import Command, shell_escape
+import json
+import os
 import os.path
 import re
 import subprocess
@@ -19,10 +21,66 @@ class System(object):
 
   def __init__(self, os):
     self.os = os
+    self.library_cache = None
+    # Map from the names of automatically resolved libraries to the .pc files
+    # and folders they were resolved from, or None if those aren't known.
+    self.library_files = {}
 
   def get_os(self):
     return self.os
 
+  # Sets the persistent cache to use for automatically resolved libraries.
+  def set_library_cache(self, cache):
+    self.library_cache = cache
+
+  # Returns the files the automatically resolved libraries were resolved from
+  # as a sorted list of pairs of the path and modification time, or None if it
+  # isn't known for all of them.
+  def get_library_file_times(self):
+    paths = set()
+    for files in self.library_files.values():
+      if files is None:
+        return None
+      paths.update(files)
+    return [(path, LibraryCache.get_mtime(path)) for path in sorted(paths)]
+
+  # Writes the library cache back to disk if it has changed.
+  def save_library_cache(self):
+    if not self.library_cache is None:
+      self.library_cache.save()
+
+  # Starts resolving the libraries with the given names in the background, if
+  # the system supports automatic resolution. By default does nothing.
+  def prefetch_libraries(self, names):
+    pass
+
+  # Returns the contents of a script that runs a command while holding one of the
+  # given number of slots of a job pool, or None if pools aren't supported on
+  # this system in which case commands in pools run without limits.
+  def get_pool_script(self, depth):
+    return None
+
+  # Returns a command line that runs the given line within the pool implemented
+  # by the script at the given path.
+  def wrap_in_pool(self, script_path, line):
+    return line
+
+  # Returns the contents of a script that runs a command and appends when it
+  # started and ended to the log at the given path, or None if tracing isn't
+  # supported on this system.
+  def get_trace_script(self, log_path):
+    return None
+
+  # Returns a command line that runs the given line through the trace script at
+  # the given path, recording it under the given name.
+  def wrap_in_trace(self, script_path, name, line):
+    return line
+
+  # Can makefiles for this system use the lean profile? It relies on GNU make
+  # and on recipes being run by a posix shell.
+  def supports_lean_makefiles(self):
+    return False
+
   # Returns the command for ensuring that the folder with the given name
   # exists.
   @abstractmethod
@@ -50,11 +108,16 @@ class CommandBuilder(object):
     self.comment = None
     self.tee_dest = None
     self.env = []
+    self.jobserver = False
 
   def set_comment(self, comment):
     self.comment = comment
     return self
 
+  def set_jobserver(self, value):
+    self.jobserver = value
+    return self
+
   def set_tee_destination(self, dest):
     self.tee_dest = dest
     return self
@@ -106,11 +169,82 @@ class PosixCommandBuilder(CommandBuilder):
       result = Command(raw_command)
     if self.comment:
       result.set_comment(self.comment)
+    result.set_jobserver(self.jobserver)
     return result
 
 
+_POSIX_POOL_SCRIPT = """#!/bin/sh
+# Runs the given command line while holding one of the %(depth)i slots of this
+# pool. Generated by mkmk, don't edit.
+slots="$0.slots"
+mkdir -p "$slots"
+if ! command -v flock >/dev/null 2>&1; then
+  exec %(python)s -c '
+import fcntl, subprocess, sys, time
+while True:
+  for i in range(%(depth)i):
+    slot = open("%%s/%%i.lock" %% (sys.argv[1], i), "a")
+    try:
+      fcntl.flock(slot, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except (IOError, OSError):
+      slot.close()
+      continue
+    sys.exit(subprocess.call(["sh", "-c", sys.argv[2]], close_fds=True))
+  time.sleep(0.1)
+' "$slots" "$1"
+fi
+while true; do
+  i=0
+  while [ $i -lt %(depth)i ]; do
+    exec 9>>"$slots/$i.lock"
+    if flock -n 9; then
+      sh -c "$1" 9>&-
+      exit $?
+    fi
+    exec 9>&-
+    i=`expr $i + 1`
+  done
+  sleep 0.1
+done
+"""
+
+
+_POSIX_TRACE_SCRIPT = """#!/bin/sh
+# Runs the given command line and appends its start and end time, exit status,
+# the given output and the given name to the trace log. Generated by mkmk, don't
+# edit.
+log=%(log)s
+# Not every date supports %%N, those that don't print it literally or not at
+# all and then times are in whole seconds.
+now() {
+  time=`date +%%s.%%N`
+  case "$time" in
+    *[!0-9.]*|*.) date +%%s ;;
+    *) echo "$time" ;;
+  esac
+}
+start=`now`
+sh -c "$3"
+status=$?
+end=`now`
+echo "$start $end $status $2 $1" >> "$log"
+exit $status
+"""
+
+
+# Quotes the given string such that the posix shell passes it as a single
+# argument, verbatim.
+def quote_argument(s):
+  return "'%s'" % s.replace("'", "'\\''")
+
+
 class PosixSystem(System):
 
+  def __init__(self, os):
+    super(PosixSystem, self).__init__(os)
+    self.resolving = {}
+    self.search_path = None
+
   def new_command_builder(self, executable, *args):
     return PosixCommandBuilder(executable, *args)
 
@@ -131,15 +265,287 @@ class PosixSystem(System):
       .set_comment("Copying to '%s'" % target)
       .build())
 
+  def supports_lean_makefiles(self):
+    return True
+
+  # The slots are lock files next to the script, held by taking an flock on
+  # them. The lock is released by the OS when the holder exits, however it
+  # exits, so slots of jobs that were killed never have to be reclaimed. Where
+  # the flock tool isn't available, as on mac, python's flock is used instead.
+  def get_pool_script(self, depth):
+    return _POSIX_POOL_SCRIPT % {
+      "depth": depth,
+      "python": quote_argument(sys.executable or "python")
+    }
+
+  def wrap_in_pool(self, script_path, line):
+    return "sh %s %s" % (script_path, quote_argument(line))
+
+  def get_trace_script(self, log_path):
+    return _POSIX_TRACE_SCRIPT % {
+      "log": quote_argument(log_path)
+    }
+
+  # The output is the target make is building, which make substitutes for $@.
+  def wrap_in_trace(self, script_path, name, line):
+    return "sh %s %s '$@' %s" % (script_path, quote_argument(name),
+      quote_argument(line))
+
+  # Starts pkg-config for each of the given libraries that aren't cached or
+  # being resolved already, without waiting for them to complete.
+  def prefetch_libraries(self, names):
+    for name in names:
+      if (name in self.resolving) or (self.get_cached_library(name) is not None):
+        continue
+      self.resolving[name] = self.new_library_query(name)
+
+  # Returns a new query that resolves the library with the given name. The
+  # queries share the lookup of where pkg-config searches for .pc files.
+  def new_library_query(self, name):
+    if self.search_path is None:
+      self.search_path = PkgConfigSearchPath()
+    return PkgConfigQuery(name, self.search_path)
+
+  # Returns the cached resolution of the given library, or None if there is no
+  # valid cache entry.
+  def get_cached_library(self, name):
+    if self.library_cache is None:
+      return None
+    return self.library_cache.get(name)
+
   def auto_resolve_library(self, name):
-    process = subprocess.Popen(["pkg-config", "--cflags", "--libs", name], stdout=subprocess.PIPE)
+    cached = self.get_cached_library(name)
+    if not cached is None:
+      self.library_files[name] = self.library_cache.get_files(name)
+      return cached
+    query = self.resolving.pop(name, None)
+    if query is None:
+      query = self.new_library_query(name)
+    result = query.get_result()
+    if result is None:
+      sys.exit(1)
+    (includes, libs, pc_files) = result
+    self.library_files[name] = pc_files
+    if (not self.library_cache is None) and (not pc_files is None):
+      self.library_cache.put(name, includes, libs, pc_files)
+    return (includes, libs)
+
+  # Waits for any libraries still being prefetched, caching the ones that could
+  # be resolved, then writes the cache.
+  def save_library_cache(self):
+    for (name, query) in sorted(self.resolving.items()):
+      result = query.get_result()
+      if (not result is None) and (not self.library_cache is None):
+        (includes, libs, pc_files) = result
+        if not pc_files is None:
+          self.library_cache.put(name, includes, libs, pc_files)
+    self.resolving = {}
+    super(PosixSystem, self).save_library_cache()
+
+
+# Matches a variable definition or keyword line in a .pc file.
+_PC_LINE_RE = re.compile(r"^([\w.]+)\s*([:=])\s*(.*)$")
+
+# Matches a variable reference in a .pc file.
+_PC_VARIABLE_RE = re.compile(r"\$\{([\w.]+)\}")
+
+# The operators that can follow a package name in a list of requirements.
+_PC_VERSION_OPERATORS = set(["<", "<=", "=", "!=", ">=", ">"])
+
+
+# Returns the names of the packages the .pc file at the given path requires,
+# publicly or privately.
+def read_pc_requires(path):
+  variables = {}
+  result = []
+  with open(path, "rt") as f:
+    for line in f:
+      match = _PC_LINE_RE.match(line.split("#", 1)[0].strip())
+      if match is None:
+        continue
+      (key, kind, value) = match.groups()
+      value = _PC_VARIABLE_RE.sub(lambda m: variables.get(m.group(1), ""), value)
+      if kind == "=":
+        variables[key] = value
+      elif key in ["Requires", "Requires.private"]:
+        # Each package may be followed by an operator and a version, which
+        # may or may not be separated from them by spaces.
+        tokens = re.sub(r"([<>=!]+)", r" \1 ", value.replace(",", " ")).split()
+        is_version = False
+        for token in tokens:
+          if token in _PC_VERSION_OPERATORS:
+            is_version = True
+          elif is_version:
+            is_version = False
+          else:
+            result.append(token)
+  return result
+
+
+# The folders pkg-config searches for .pc files: those in PKG_CONFIG_PATH
+# followed by those in PKG_CONFIG_LIBDIR or, if that isn't set, pkg-config's
+# default search path. The default is looked up in the background, once for all
+# queries.
+class PkgConfigSearchPath(object):
+
+  def __init__(self):
+    self.process = None
+    if not "PKG_CONFIG_LIBDIR" in os.environ:
+      self.process = PkgConfigQuery.start("--variable=pc_path", "pkg-config",
+        stderr=subprocess.PIPE)
+    self.is_done = False
+    self.folders = None
+
+  # Returns the list of folders to search, or None if the default search path
+  # couldn't be determined.
+  def get_folders(self):
+    if not self.is_done:
+      self.folders = self.calc_folders()
+      self.is_done = True
+    return self.folders
+
+  def calc_folders(self):
+    libdir = os.environ.get("PKG_CONFIG_LIBDIR", None)
+    if libdir is None:
+      libdir = PkgConfigQuery.wait(self.process)
+      if libdir is None:
+        return None
+    paths = [os.environ.get("PKG_CONFIG_PATH", ""), libdir.strip()]
+    result = []
+    for path in paths:
+      result += [f for f in path.split(os.pathsep) if f]
+    return result
+
+  # Returns the path of the .pc file pkg-config uses for the library with the
+  # given name, or None if it can't be found.
+  def find_pc_file(self, name):
+    for folder in self.get_folders():
+      path = os.path.join(folder, "%s.pc" % name)
+      if os.path.isfile(path):
+        return path
+    return None
+
+
+# A pkg-config resolution of a library. The process is started immediately and
+# runs in the background until the result is requested, so many queries can be
+# running at the same time. The .pc files the result depends on are found by
+# reading them directly rather than by asking pkg-config about each one.
+class PkgConfigQuery(object):
+
+  def __init__(self, name, search_path):
+    self.name = name
+    self.search_path = search_path
+    self.flags = self.start("--cflags", "--libs", name)
+
+  @staticmethod
+  def start(*args, **kwargs):
+    return subprocess.Popen(["pkg-config"] + list(args), stdout=subprocess.PIPE,
+      **kwargs)
+
+  # Waits for the given process and returns its output, or None on failure.
+  @staticmethod
+  def wait(process):
     (stdout, stderr) = process.communicate()
     if process.returncode != 0:
-      sys.exit(1)
-    flags = stdout.split()
+      return None
+    return stdout
+
+  # Waits for the query to complete and returns a triple of the includes, the
+  # libraries and the files involved in resolving the library: the .pc files of
+  # the library and of everything it requires, directly or indirectly, and the
+  # folders searched for them since adding a .pc file to one can change which
+  # is used. Returns None if the library couldn't be resolved. The files are
+  # None if they couldn't be determined, in which case the result shouldn't be
+  # cached.
+  def get_result(self):
+    flags = self.wait(self.flags)
+    if flags is None:
+      return None
+    flags = flags.split()
     includes = [f[2:] for f in flags if f.startswith("-I")]
     libs = [f[2:] for f in flags if f.startswith("-l")]
-    return (includes, libs)
+    folders = self.search_path.get_folders()
+    if folders is None:
+      return (includes, libs, None)
+    pc_files = set()
+    visited = set()
+    pending = [self.name]
+    while pending:
+      name = pending.pop()
+      if name in visited:
+        continue
+      visited.add(name)
+      pc_file = self.search_path.find_pc_file(name)
+      if pc_file is None:
+        return (includes, libs, None)
+      pc_files.add(pc_file)
+      try:
+        pending += read_pc_requires(pc_file)
+      except IOError:
+        return (includes, libs, None)
+    return (includes, libs, sorted(pc_files | set(folders)))
+
+
+# A persistent cache of libraries resolved through pkg-config. Entries are keyed
+# by library name and only valid as long as PKG_CONFIG_PATH and the .pc files
+# and folders involved in resolving the library are unchanged.
+class LibraryCache(object):
+
+  def __init__(self, path):
+    self.path = path
+    self.entries = {}
+    self.is_dirty = False
+    if os.path.exists(path):
+      with open(path, "rt") as f:
+        self.entries = json.load(f)
+
+  # Returns the current modification time of the given file, or None if the file
+  # doesn't exist.
+  @staticmethod
+  def get_mtime(path):
+    try:
+      return os.path.getmtime(path)
+    except OSError:
+      return None
+
+  # Returns a pair of the cached includes and libs for the given library, or
+  # None if there is no valid entry.
+  def get(self, name):
+    entry = self.entries.get(name, None)
+    if entry is None:
+      return None
+    if entry["pkg_config_path"] != os.environ.get("PKG_CONFIG_PATH", ""):
+      return None
+    for (path, mtime) in entry["files"].items():
+      if self.get_mtime(path) != mtime:
+        return None
+    return (entry["includes"], entry["libs"])
+
+  # Returns the .pc files and folders the given library's cache entry was
+  # resolved from.
+  def get_files(self, name):
+    return sorted(self.entries[name]["files"].keys())
+
+  def put(self, name, includes, libs, pc_files):
+    self.entries[name] = {
+      "pkg_config_path": os.environ.get("PKG_CONFIG_PATH", ""),
+      "files": dict([(f, self.get_mtime(f)) for f in pc_files]),
+      "includes": includes,
+      "libs": libs
+    }
+    self.is_dirty = True
+
+  # Writes the cache to disk if it has changed.
+  def save(self):
+    if not self.is_dirty:
+      return
+    parent = os.path.dirname(self.path)
+    if parent and not os.path.exists(parent):
+      os.makedirs(parent)
+    with open(self.path, "wt") as f:
+      json.dump(self.entries, f, sort_keys=True, indent=None)
+    self.is_dirty = False
+
 
 def cmd_escape(str):
   return re.sub(r'([\"])', r"\\\g<1>", str)
@@ -184,6 +590,7 @@ class WindowsCommandBuilder(CommandBuilder):
       result = Command(raw_command)
     if self.comment:
       result.set_comment(self.comment)
+    result.set_jobserver(self.jobserver)
     return result
 
 
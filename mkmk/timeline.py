@@ -0,0 +1,147 @@
+#- Copyright 2014 GOTO 10.
+#- Licensed under the Apache License, Version 2.0 (see LICENSE).
+
+## Build timelines in the chrome trace-event format.
+##
+## When tracing is enabled every job of the build is recorded with the full
+## name of the node it builds, when it started and ended and which job slot it
+## ran in. The result is written as a trace.json that can be loaded into
+## chrome://tracing or the perfetto ui to see where cores were idle, which
+## targets serialized the build, and which were slow.
+##
+## Builds run by make log each job from a wrapper script to a trace log, one
+## line per job, which the trace command converts to trace.json once the build
+## is done. Make doesn't tell jobs which slot they're running in so slots are
+## reconstructed from the timestamps. The trace command also records how long
+## each output took in the build history, as farm builds do, such that the
+## critical path can be computed for builds run by make. Farm builds know which
+## worker ran each job and write trace.json directly.
+
+import history
+import json
+import os
+import os.path
+
+
+# Returns the path of the trace log that make jobs append to.
+def get_log_path(bindir):
+  return os.path.join(bindir, "Trace.log")
+
+
+# Returns the path of the trace to write for the given bindir.
+def get_trace_path(bindir):
+  return os.path.join(bindir, "trace.json")
+
+
+# A single job of the build.
+class TraceEvent(object):
+
+  def __init__(self, name, start, end, slot, args):
+    self.name = name
+    self.start = start
+    self.end = end
+    self.slot = slot
+    self.args = args
+
+  # Returns this event as a complete ("X") trace event, with times relative to
+  # the given origin in microseconds.
+  def to_json(self, origin):
+    return {
+      "name": self.name,
+      "cat": "build",
+      "ph": "X",
+      "ts": int((self.start - origin) * 1000000),
+      "dur": int((self.end - self.start) * 1000000),
+      "pid": 1,
+      "tid": self.slot,
+      "args": self.args
+    }
+
+
+# Writes the given events to the given path in trace-event format.
+def write_trace(path, events):
+  origin = min([e.start for e in events] or [0])
+  trace_events = [e.to_json(origin) for e in sorted(events, key=lambda e: e.start)]
+  for slot in sorted(set([e.slot for e in events])):
+    trace_events.append({
+      "name": "thread_name",
+      "ph": "M",
+      "pid": 1,
+      "tid": slot,
+      "args": {"name": "slot %i" % slot}
+    })
+  parent = os.path.dirname(path)
+  if parent and not os.path.exists(parent):
+    os.makedirs(parent)
+  with open(path, "wt") as out:
+    json.dump({"traceEvents": trace_events, "displayTimeUnit": "ms"}, out,
+      sort_keys=True, indent=None)
+
+
+# Assigns each of the given events, which don't have a slot yet, to the lowest
+# numbered slot that is free when it starts. Since make started each job in a
+# slot that was free at the time this gives the same number of slots as make
+# used, if not necessarily the same numbering.
+def assign_slots(events):
+  slot_ends = []
+  for event in sorted(events, key=lambda e: e.start):
+    for (slot, end) in enumerate(slot_ends):
+      if end <= event.start:
+        event.slot = slot
+        slot_ends[slot] = event.end
+        break
+    else:
+      event.slot = len(slot_ends)
+      slot_ends.append(event.end)
+
+
+# Reads the events written to the trace log by the wrapper script. Each line has
+# the start and end times, the exit status, the output built and the name of
+# the node.
+def read_log(path):
+  result = []
+  with open(path, "rt") as f:
+    for line in f:
+      parts = line.rstrip("\n").split(" ", 4)
+      if len(parts) < 5:
+        continue
+      (start, end, status, output, name) = parts
+      try:
+        args = {"output": output, "status": int(status)}
+        result.append(TraceEvent(name, float(start), float(end), None, args))
+      except ValueError:
+        # A line written by a job that was interrupted.
+        continue
+  return result
+
+
+# The main entry-point class for the trace command, which converts the log
+# written by the jobs of a make build into a trace.
+class MkMkTrace(object):
+
+  def __init__(self, options):
+    self.options = options
+
+  def run(self):
+    log_path = get_log_path(self.options.bindir)
+    if not os.path.exists(log_path):
+      return
+    events = read_log(log_path)
+    assign_slots(events)
+    write_trace(get_trace_path(self.options.bindir), events)
+    self.record_history(events)
+    # Start the next build with an empty log.
+    os.remove(log_path)
+
+  # Records the durations of the jobs that succeeded in the build history. The
+  # peak memory use isn't known for jobs run by make so whatever was recorded
+  # by earlier farm builds is kept.
+  def record_history(self, events):
+    build_history = history.BuildHistory(history.get_history_path(self.options.bindir))
+    for event in sorted(events, key=lambda e: e.start):
+      if event.args["status"] != 0:
+        continue
+      output = event.args["output"]
+      build_history.record(output, event.end - event.start,
+        build_history.get_peak_rss(output))
+    build_history.save()
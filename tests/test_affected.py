@@ -0,0 +1,48 @@
+#- Copyright 2014 GOTO 10.
+#- Licensed under the Apache License, Version 2.0 (see LICENSE).
+
+import unittest
+from workspace import SAMPLE_FILES, Workspace
+
+
+class AffectedTest(unittest.TestCase):
+
+  def setUp(self):
+    self.workspace = Workspace(SAMPLE_FILES)
+    self.workspace.write("src/tool/tool.mkmk",
+      "c.get_source_file('tool.c').get_object()\n")
+    self.workspace.write("src/tool/tool.c", "int tool;\n")
+    self.workspace.write("src/src.mkmk", SAMPLE_FILES["src/src.mkmk"]
+      + "include('tool', 'tool.mkmk')\n")
+
+  def tearDown(self):
+    self.workspace.dispose()
+
+  def get_affected(self, *paths):
+    return self.workspace.run("affected", *paths).split()
+
+  def test_source(self):
+    affected = self.get_affected("src/main.h")
+    self.assertIn("out/src/main.c.o", affected)
+    self.assertIn("run-tests", affected)
+    self.assertNotIn("out/deps/foo/lib/lib.c.o", affected)
+    self.assertNotIn("out/src/tool/tool.c.o", affected)
+
+  # A script that only defines nodes affects just those.
+  def test_local_script(self):
+    self.assertEqual(["out/src/tool/tool.c.o"],
+      self.get_affected("src/tool/tool.mkmk"))
+
+  # The root script sets pervasive settings so everything is affected.
+  def test_global_script(self):
+    affected = self.get_affected("root.mkmk")
+    self.assertIn("out/deps/foo/lib/lib.c.o", affected)
+    self.assertIn("out/src/tool/tool.c.o", affected)
+    self.assertIn("run-tests", affected)
+
+  def test_unrelated(self):
+    self.assertEqual([], self.get_affected("README"))
+
+
+if __name__ == '__main__':
+  unittest.main()
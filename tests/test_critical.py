@@ -0,0 +1,92 @@
+#- Copyright 2014 GOTO 10.
+#- Licensed under the Apache License, Version 2.0 (see LICENSE).
+
+import random
+import unittest
+from mkmk import critical
+from mkmk import history
+from workspace import SAMPLE_FILES, Workspace
+
+
+# Returns how long the build of the given graph takes if the given output took
+# no time, by computing the whole critical path again.
+def get_total_without(deps, durations, output):
+  def get_cost(o):
+    if o == output:
+      return 0
+    return durations[o]
+  return max(history.get_critical_path_costs(deps, get_cost).values() + [0])
+
+
+class CriticalPathTest(unittest.TestCase):
+
+  def test_chain(self):
+    deps = {"a": [], "b": ["a"], "c": ["b"], "d": ["a"]}
+    durations = {"a": 1, "b": 2, "c": 3, "d": 1}
+    analysis = critical.CriticalPathAnalysis(deps, durations)
+    self.assertEqual(6, analysis.get_total())
+    self.assertEqual(["a", "b", "c"], analysis.get_critical_path())
+    self.assertEqual(4, analysis.get_slack("d"))
+    self.assertEqual(1, analysis.get_saving("a"))
+    self.assertEqual(2, analysis.get_saving("b"))
+    self.assertEqual(0, analysis.get_saving("d"))
+
+  # Making one of two equally long chains faster doesn't help.
+  def test_parallel_chains(self):
+    deps = {"a": [], "b": [], "c": ["a", "b"]}
+    durations = {"a": 2, "b": 2, "c": 1}
+    analysis = critical.CriticalPathAnalysis(deps, durations)
+    self.assertEqual(0, analysis.get_saving("a"))
+    self.assertEqual(0, analysis.get_saving("b"))
+    self.assertEqual(1, analysis.get_saving("c"))
+
+  # The savings are the same as those found by computing the critical path
+  # again without each output.
+  def test_savings(self):
+    rng = random.Random(4)
+    for attempt in range(50):
+      count = rng.randint(1, 30)
+      deps = {}
+      durations = {}
+      for index in range(count):
+        output = "o%i" % index
+        deps[output] = ["o%i" % d for d in range(index) if rng.random() < 0.2]
+        durations[output] = rng.randint(0, 10)
+      analysis = critical.CriticalPathAnalysis(deps, durations)
+      total = analysis.get_total()
+      for output in deps.keys():
+        expected = total - get_total_without(deps, durations, output)
+        self.assertEqual(expected, analysis.get_saving(output), output)
+
+  # Cycles are broken where the critical path costs used for scheduling break
+  # them, here at b's dependency on a.
+  def test_cycle(self):
+    deps = {"a": ["c"], "b": ["a"], "c": ["b", "d"], "d": []}
+    durations = {"a": 1, "b": 2, "c": 3, "d": 4}
+    analysis = critical.CriticalPathAnalysis(deps, durations)
+    costs = history.get_critical_path_costs(deps, lambda o: durations[o])
+    self.assertEqual(max(costs.values()), analysis.get_total())
+    self.assertEqual(["d", "c", "a"], analysis.get_critical_path())
+    self.assertEqual(2, analysis.get_slack("b"))
+    self.assertEqual(0, analysis.get_saving("b"))
+    self.assertEqual(2, analysis.get_saving("d"))
+    self.assertEqual(1, analysis.get_saving("a"))
+
+class CriticalPathCommandTest(unittest.TestCase):
+
+  def setUp(self):
+    self.workspace = Workspace(SAMPLE_FILES)
+
+  def tearDown(self):
+    self.workspace.dispose()
+
+  # Nodes of dependencies are listed by their global names.
+  def test_global_names(self):
+    self.workspace.get_makefile()
+    output = self.workspace.run("critical-path", "run-tests")
+    self.assertIn("foo::lib::lib.c:object", output)
+    self.assertIn("src::main", output)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,87 @@
+#- Copyright 2014 GOTO 10.
+#- Licensed under the Apache License, Version 2.0 (see LICENSE).
+
+import os
+import os.path
+import shutil
+import tempfile
+import unittest
+from mkmk import explain
+from workspace import SAMPLE_FILES, Workspace
+
+
+class StalenessTest(unittest.TestCase):
+
+  def setUp(self):
+    self.root = tempfile.mkdtemp(prefix="mkmk-test-")
+
+  def tearDown(self):
+    shutil.rmtree(self.root, ignore_errors=True)
+
+  # Creates the files with the given names, each modified at the given time,
+  # and returns their paths.
+  def touch(self, time, *names):
+    result = []
+    for name in names:
+      path = os.path.join(self.root, name)
+      with open(path, "wt") as out:
+        out.write(name)
+      os.utime(path, (time, time))
+      result.append(path)
+    return result
+
+  # Only the outputs that are actually stale count as rebuilt because of a
+  # change, not everything built from it.
+  def test_downstream(self):
+    (a_o, a_exe) = self.touch(100, "a.o", "a")
+    (source,) = self.touch(200, "source.c")
+    (b_o, b_exe, c_o, c_exe) = self.touch(300, "b.o", "b", "c.o", "c")
+    (other,) = self.touch(400, "other.c")
+    inputs = {
+      a_o: [source], a_exe: [a_o],
+      b_o: [source], b_exe: [b_o],
+      c_o: [source, other], c_exe: [c_o],
+    }
+    analysis = explain.StalenessAnalysis(inputs, set())
+    self.assertEqual(sorted([a_o, a_exe, c_o, c_exe]), analysis.get_stale_outputs())
+    self.assertEqual({(explain.NEWER_INPUT, source): [a_o],
+      (explain.NEWER_INPUT, other): [c_o]}, analysis.get_causes())
+    self.assertEqual(set([a_o, a_exe]), analysis.get_downstream([a_o]))
+    self.assertEqual(set([c_o, c_exe]), analysis.get_downstream([c_o]))
+
+  def test_phony(self):
+    (obj,) = self.touch(100, "a.o")
+    (source,) = self.touch(200, "a.c")
+    inputs = {obj: [source], "all": [obj]}
+    analysis = explain.StalenessAnalysis(inputs, set(["all"]))
+    self.assertEqual([obj], analysis.get_stale_outputs())
+    self.assertTrue(analysis.is_stale("all"))
+    self.assertEqual(set([obj]), analysis.get_downstream([obj]))
+
+
+class ExplainTest(unittest.TestCase):
+
+  def setUp(self):
+    self.workspace = Workspace(SAMPLE_FILES)
+
+  def tearDown(self):
+    self.workspace.dispose()
+
+  # Changing a header rebuilds what's built from it but not the library.
+  def test_changed_header(self):
+    self.workspace.get_makefile()
+    self.workspace.make("run-tests")
+    path = os.path.join(self.workspace.root, "src", "main.h")
+    with open(path, "wt") as out:
+      out.write("#define MAIN 2\n")
+    later = os.path.getmtime(os.path.join(self.workspace.root, "out", "src",
+      "main.run")) + 10
+    os.utime(path, (later, later))
+    output = self.workspace.run("explain", "run-tests")
+    self.assertIn("3 of 4 targets are out of date", output)
+    self.assertIn("./src/main.h is newer than 1 of its outputs", output)
+    self.assertIn("3 targets will be rebuilt", output)
+
+
+if __name__ == '__main__':
+  unittest.main()
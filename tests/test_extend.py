@@ -0,0 +1,85 @@
+#- Copyright 2014 GOTO 10.
+#- Licensed under the Apache License, Version 2.0 (see LICENSE).
+
+import cPickle as pickle
+import unittest
+from mkmk import extend
+from workspace import Workspace
+
+
+class FakeTools(object):
+
+  def __init__(self, context):
+    self.context = context
+
+  def get_context(self):
+    return self.context
+
+
+# An environment with a single extension that records which contexts it has
+# created tool sets for.
+class FakeEnvironment(object):
+
+  def __init__(self):
+    self.created = []
+
+  def get_extension(self, name):
+    return self
+
+  def get_tools(self, context):
+    self.created.append(context)
+    return FakeTools(context)
+
+
+class LazyToolSetTest(unittest.TestCase):
+
+  # The tool set is created on first use, and only once.
+  def test_created_on_use(self):
+    env = FakeEnvironment()
+    tools = extend.LazyToolSet(env, "fake", "context")
+    self.assertEqual([], env.created)
+    self.assertEqual("context", tools.get_context())
+    self.assertEqual("context", tools.get_context())
+    self.assertEqual(["context"], env.created)
+
+  # Looking up special methods, which pickling does, doesn't create it.
+  def test_special_methods(self):
+    env = FakeEnvironment()
+    tools = extend.LazyToolSet(env, "fake", "context")
+    self.assertFalse(hasattr(tools, "__getstate__"))
+    self.assertRaises(AttributeError, lambda: tools.missing)
+    self.assertEqual(["context"], env.created)
+
+
+# A tree where the script in the middle never uses the c extension.
+_FILES = {
+  "root.mkmk": (
+    "c.get_settings().add_pervasive('cflags', '-DROOT')\n"
+    "c.get_settings().add_sticky('cflags', '-DSTICKY')\n"
+    "include('mid', 'mid.mkmk')\n"),
+  "mid/mid.mkmk": (
+    "include('leaf', 'leaf.mkmk')\n"),
+  "mid/leaf/leaf.mkmk": (
+    "c.get_source_file('leaf.c').get_object()\n"),
+  "mid/leaf/leaf.c": "int leaf;\n",
+}
+
+
+class LazySettingsTest(unittest.TestCase):
+
+  def setUp(self):
+    self.workspace = Workspace(_FILES)
+
+  def tearDown(self):
+    self.workspace.dispose()
+
+  # The settings of contexts that didn't use c are created when a child needs
+  # to inherit from them.
+  def test_inherited_through_unused_context(self):
+    makefile = self.workspace.get_makefile()
+    self.assertIn("-DROOT", makefile)
+    self.assertIn("-DSTICKY", makefile)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,72 @@
+#- Copyright 2014 GOTO 10.
+#- Licensed under the Apache License, Version 2.0 (see LICENSE).
+
+import json
+import os.path
+import unittest
+from mkmk import history
+from workspace import SAMPLE_FILES, Workspace
+
+
+# The outputs built for the run-tests alias of the sample tree.
+_OUTPUTS = ["out/deps/foo/lib/lib.c.o", "out/src/main", "out/src/main.c.o",
+  "out/src/main.run"]
+
+
+class FarmTest(unittest.TestCase):
+
+  def setUp(self):
+    self.workspace = Workspace(SAMPLE_FILES)
+
+  def tearDown(self):
+    self.workspace.dispose()
+
+  def build(self):
+    return self.workspace.run("farm", "--workers", "2", "--progress",
+      "out/progress.json", "--", "run-tests")
+
+  def read_progress(self):
+    with open(os.path.join(self.workspace.root, "out", "progress.json"), "rt") as f:
+      return [json.loads(line) for line in f]
+
+  # A coordinator with two local workers builds everything, records the history
+  # and reports each target starting and finishing.
+  def test_build(self):
+    self.workspace.clean()
+    output = self.build()
+    self.assertIn("Running src::main:test", output)
+    for path in _OUTPUTS:
+      self.assertTrue(os.path.exists(os.path.join(self.workspace.root, path)), path)
+    build_history = history.BuildHistory(history.get_history_path(
+      os.path.join(self.workspace.root, "out")))
+    self.assertEqual(_OUTPUTS, sorted(build_history.entries.keys()))
+    events = self.read_progress()
+    self.assertEqual("build", events[0]["event"])
+    self.assertEqual(4, events[0]["total"])
+    self.assertEqual(_OUTPUTS, sorted([e["target"] for e in events
+      if e["event"] == "start"]))
+    finished = [e for e in events if e["event"] == "finish"]
+    self.assertEqual(_OUTPUTS, sorted([e["target"] for e in finished]))
+    self.assertEqual([1, 2, 3, 4], [e["done"] for e in finished])
+    # The object files must be done before the executable is linked.
+    order = [e["target"] for e in finished]
+    self.assertTrue(order.index("out/src/main.c.o") < order.index("out/src/main"))
+    self.assertTrue(order.index("out/src/main") < order.index("out/src/main.run"))
+    self.assertEqual({"done": 4, "event": "end", "success": True, "total": 4},
+      dict([(k, v) for (k, v) in events[-1].items() if k != "time"]))
+
+  # Once built nothing is built again until a source changes, and then only
+  # what depends on it.
+  def test_rebuild(self):
+    self.workspace.clean()
+    self.build()
+    self.build()
+    self.assertEqual(["build", "end"], [e["event"] for e in self.read_progress()])
+    self.workspace.write("deps/foo/lib/lib.c", "int lib = 1;\n")
+    self.build()
+    self.assertEqual(["out/deps/foo/lib/lib.c.o", "out/src/main",
+      "out/src/main.run"], [e["target"] for e in self.read_progress()
+        if e["event"] == "finish"])
+
+if __name__ == '__main__':
+  unittest.main()
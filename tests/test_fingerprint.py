@@ -0,0 +1,56 @@
+#- Copyright 2014 GOTO 10.
+#- Licensed under the Apache License, Version 2.0 (see LICENSE).
+
+import subprocess
+import unittest
+from workspace import CHANGED_MAIN, SAMPLE_FILES, Workspace
+
+
+# Checks that the fingerprint of a goal changes with the files it's built from
+# and only with those.
+class FingerprintTest(unittest.TestCase):
+
+  def setUp(self):
+    self.workspace = Workspace(SAMPLE_FILES)
+
+  def tearDown(self):
+    self.workspace.dispose()
+
+  def get_fingerprint(self, *goals):
+    return self.workspace.run("fingerprint", *goals).strip()
+
+  def test_stable(self):
+    before = self.get_fingerprint("run-tests")
+    self.assertEqual(32, len(before))
+    self.assertEqual(before, self.get_fingerprint("run-tests"))
+
+  # The test is built from main.h but not from other.h, which nothing includes.
+  def test_unrelated_header(self):
+    before = self.get_fingerprint("run-tests")
+    self.workspace.write("src/other.h", "#define OTHER 2\n")
+    self.assertEqual(before, self.get_fingerprint("run-tests"))
+    self.workspace.write("src/main.h", "#define MAIN 2\n")
+    self.assertNotEqual(before, self.get_fingerprint("run-tests"))
+
+  # Once main.c starts including other.h changing it changes the fingerprint.
+  def test_new_include(self):
+    self.workspace.write("src/main.c", CHANGED_MAIN)
+    before = self.get_fingerprint("run-tests")
+    self.workspace.write("src/other.h", "#define OTHER 2\n")
+    self.assertNotEqual(before, self.get_fingerprint("run-tests"))
+
+  # The library object isn't built from anything in src.
+  def test_other_goal(self):
+    before = self.get_fingerprint("out/deps/foo/lib/lib.c.o")
+    self.workspace.write("src/main.h", "#define MAIN 2\n")
+    self.assertEqual(before, self.get_fingerprint("out/deps/foo/lib/lib.c.o"))
+    self.workspace.write("deps/foo/lib/lib.c", "int lib = 1;\n")
+    self.assertNotEqual(before, self.get_fingerprint("out/deps/foo/lib/lib.c.o"))
+
+  def test_unknown_goal(self):
+    self.assertRaises(subprocess.CalledProcessError, self.get_fingerprint,
+      "no-such-goal")
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,41 @@
+#- Copyright 2014 GOTO 10.
+#- Licensed under the Apache License, Version 2.0 (see LICENSE).
+
+import unittest
+from workspace import SAMPLE_FILES, Workspace
+
+
+# Returns the rules of the given makefile in a canonical order, with the phony
+# targets merged into a single rule, such that makefiles that only differ in how
+# the rules are laid out compare equal.
+def get_rules(makefile):
+  rules = []
+  phony = set()
+  for block in makefile.split("\n\n"):
+    block = block.strip()
+    if not block or block.startswith(".DEFAULT_GOAL"):
+      continue
+    if block.startswith(".PHONY:"):
+      phony.update(block[len(".PHONY:"):].split())
+    else:
+      rules.append(block)
+  return sorted(rules) + [".PHONY: %s" % " ".join(sorted(phony))]
+
+
+class FragmentsTest(unittest.TestCase):
+
+  def setUp(self):
+    self.workspace = Workspace(SAMPLE_FILES)
+
+  def tearDown(self):
+    self.workspace.dispose()
+
+  def test_fragments(self):
+    plain = self.workspace.get_makefile()
+    fragments = self.workspace.get_makefile("--fragments")
+    self.assertNotEqual(plain, fragments)
+    self.assertEqual(get_rules(plain), get_rules(fragments))
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,107 @@
+#- Copyright 2014 GOTO 10.
+#- Licensed under the Apache License, Version 2.0 (see LICENSE).
+
+import subprocess
+import unittest
+from mkmk import gitindex
+from workspace import CHANGED_MAIN, SAMPLE_FILES, Workspace
+
+
+# Returns an entry as printed by "git ls-files -s --debug -z".
+def format_entry(mode, blob, stage, path, mtime, size):
+  return ("%s %s %s\t%s\0"
+    "  ctime: %s\n"
+    "  mtime: %s\n"
+    "  dev: 65024\tino: 1234\n"
+    "  uid: 0\tgid: 0\n"
+    "  size: %i\tflags: 0\n") % (mode, blob, stage, path, mtime, mtime, size)
+
+
+_A_BLOB = "78981922613b2afb6025042ff6bd878ac1994e85"
+_B_BLOB = "e0b3f1b09bd1819ed1f7ce2e75fc7400809f5350"
+
+
+class ParseIndexTest(unittest.TestCase):
+
+  def test_regular_files(self):
+    output = (format_entry("100644", _A_BLOB, "0", "a.txt", "1400000000:500000000", 2)
+      + format_entry("100755", _B_BLOB, "0", "d/b c.sh", "1400000001:0", 3))
+    entries = gitindex.parse_index(output)
+    self.assertEqual(["a.txt", "d/b c.sh"], sorted(entries.keys()))
+    a = entries["a.txt"]
+    self.assertEqual(_A_BLOB, a.get_blob())
+    self.assertEqual(2, a.get_size())
+    self.assertAlmostEqual(1400000000.5, a.get_modified_time())
+    self.assertEqual(3, entries["d/b c.sh"].get_size())
+
+  # Symlinks, submodules and conflicted files are left to the file system.
+  def test_skipped_entries(self):
+    output = (format_entry("120000", _A_BLOB, "0", "link", "1:0", 5)
+      + format_entry("160000", _A_BLOB, "0", "module", "0:0", 0)
+      + format_entry("100644", _A_BLOB, "2", "conflict.c", "1:0", 2)
+      + format_entry("100644", _B_BLOB, "0", "kept.c", "1:0", 3))
+    self.assertEqual(["kept.c"], gitindex.parse_index(output).keys())
+
+  def test_empty(self):
+    self.assertEqual({}, gitindex.parse_index(""))
+
+
+class GitIndexTest(unittest.TestCase):
+
+  def setUp(self):
+    output = (format_entry("100644", _A_BLOB, "0", "src/a.c", "1:0", 2)
+      + format_entry("100644", _B_BLOB, "0", "src/lib/b.c", "1:0", 3)
+      + format_entry("100644", _B_BLOB, "0", "src/dirty.c", "1:0", 3))
+    # The current directory is the src folder of the checkout.
+    self.index = gitindex.GitIndex("src", gitindex.parse_index(output),
+      ["src/dirty.c"])
+
+  def test_entries(self):
+    self.assertEqual(_A_BLOB, self.index.get_entry("a.c").get_blob())
+    self.assertEqual(_B_BLOB, self.index.get_entry("./lib/b.c").get_blob())
+    self.assertEqual(None, self.index.get_entry("dirty.c"))
+    self.assertEqual(None, self.index.get_entry("../../outside.c"))
+
+  def test_kinds(self):
+    self.assertEqual(gitindex.FILE, self.index.get_kind("a.c"))
+    self.assertEqual(gitindex.FOLDER, self.index.get_kind("lib"))
+    self.assertEqual(gitindex.FOLDER, self.index.get_kind("."))
+    self.assertEqual(None, self.index.get_kind("dirty.c"))
+    self.assertEqual(None, self.index.get_kind("missing"))
+
+  def test_forget(self):
+    self.index.forget("a.c")
+    self.assertEqual(None, self.index.get_entry("a.c"))
+
+
+# Checks that the makefile generated using the index matches the one generated
+# without it.
+class GitIndexMakefileTest(unittest.TestCase):
+
+  def setUp(self):
+    self.workspace = Workspace(SAMPLE_FILES)
+
+  def tearDown(self):
+    self.workspace.dispose()
+
+  def git(self, *args):
+    subprocess.check_output(["git", "-c", "user.name=test",
+      "-c", "user.email=test@example.com"] + list(args), cwd=self.workspace.root,
+      stderr=subprocess.STDOUT)
+
+  def test_git_index(self):
+    self.git("init", "-q")
+    self.git("add", ".")
+    self.git("commit", "-q", "-m", "Initial")
+    plain = self.workspace.get_makefile()
+    self.assertEqual(plain, self.workspace.get_makefile("--git-index"))
+    # Files that have changed since they were committed come from the file
+    # system.
+    self.workspace.write("src/main.c", CHANGED_MAIN)
+    changed = self.workspace.get_makefile()
+    self.assertIn("./src/other.h", changed)
+    self.assertEqual(changed, self.workspace.get_makefile("--git-index"))
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,55 @@
+#- Copyright 2014 GOTO 10.
+#- Licensed under the Apache License, Version 2.0 (see LICENSE).
+
+import unittest
+from test_fragments import get_rules
+from workspace import SAMPLE_FILES, Workspace
+
+
+# Returns the rules of the given makefile, without the list of phony targets.
+def get_plain_rules(makefile):
+  return [r for r in get_rules(makefile) if not r.startswith(".PHONY:")]
+
+
+class GoalsTest(unittest.TestCase):
+
+  def setUp(self):
+    self.workspace = Workspace(SAMPLE_FILES)
+
+  def tearDown(self):
+    self.workspace.dispose()
+
+  # Returns the targets of the rules in the makefile generated for the given
+  # goals, after checking that the rules are exactly those of the full makefile.
+  def get_targets(self, full, goals):
+    rules = get_plain_rules(self.workspace.get_makefile("--goals", goals))
+    for rule in rules:
+      self.assertIn(rule, full)
+    return sorted([r.split(":", 1)[0] for r in rules])
+
+  def test_pruned(self):
+    full = get_plain_rules(self.workspace.get_makefile())
+    self.assertEqual(["clean", "out/deps/foo/lib/lib.c.o"],
+      self.get_targets(full, "out/deps/foo/lib/lib.c.o"))
+    self.assertEqual(["clean", "out/deps/foo/lib/lib.c.o", "out/src/main",
+      "out/src/main.c.o"], self.get_targets(full, "out/src/main"))
+    self.assertEqual(["clean", "out/deps/foo/lib/lib.c.o", "out/src/main",
+      "out/src/main.c.o", "out/src/main.run", "run-tests"],
+      self.get_targets(full, "run-tests"))
+
+  # Goals can be given by node name and several at once.
+  def test_node_names(self):
+    full = get_plain_rules(self.workspace.get_makefile())
+    self.assertEqual(self.get_targets(full, "out/src/main"),
+      self.get_targets(full, "src::main"))
+    self.assertEqual(["clean", "out/deps/foo/lib/lib.c.o", "out/src/main.c.o"],
+      self.get_targets(full, "out/src/main.c.o out/deps/foo/lib/lib.c.o"))
+
+  # Building the goal with the pruned makefile gives the same output.
+  def test_build(self):
+    self.workspace.get_makefile("--goals", "run-tests")
+    self.assertIn("Running src::main:test", self.workspace.make("run-tests"))
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,46 @@
+#- Copyright 2014 GOTO 10.
+#- Licensed under the Apache License, Version 2.0 (see LICENSE).
+
+import unittest
+from mkmk import history
+
+
+# The cost of an output is the number in its name.
+def get_cost(output):
+  return int(output[1:])
+
+
+class CriticalPathTest(unittest.TestCase):
+
+  def test_chain(self):
+    inputs = {"o1": ["o2"], "o2": ["o3"], "o3": ["source.c"]}
+    self.assertEqual({"o1": 6, "o2": 5, "o3": 3},
+      history.get_critical_path_costs(inputs, get_cost))
+
+  # An output's cost is that of its most expensive chain, not the sum of all
+  # its dependencies.
+  def test_diamond(self):
+    inputs = {"o1": ["o2", "o5"], "o2": ["o3"], "o5": ["o3"], "o3": []}
+    self.assertEqual({"o1": 9, "o2": 5, "o5": 8, "o3": 3},
+      history.get_critical_path_costs(inputs, get_cost))
+
+  def test_long_chain(self):
+    inputs = dict([("o%i" % i, ["o%i" % (i + 1)]) for i in range(1, 5000)])
+    inputs["o5000"] = []
+    costs = history.get_critical_path_costs(inputs, lambda o: 1)
+    self.assertEqual(5000, costs["o1"])
+
+  def test_cycle(self):
+    inputs = {"o1": ["o2"], "o2": ["o3"], "o3": ["o1", "o4"], "o4": []}
+    costs = history.get_critical_path_costs(inputs, get_cost)
+    self.assertEqual(["o1", "o2", "o3", "o4"], sorted(costs.keys()))
+    self.assertEqual(4, costs["o4"])
+    self.assertEqual(1 + 2 + 3 + 4, costs["o1"])
+
+  def test_self_cycle(self):
+    self.assertEqual({"o2": 2},
+      history.get_critical_path_costs({"o2": ["o2"]}, get_cost))
+
+
+if __name__ == '__main__':
+  unittest.main()
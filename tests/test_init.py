@@ -0,0 +1,75 @@
+#- Copyright 2014 GOTO 10.
+#- Licensed under the Apache License, Version 2.0 (see LICENSE).
+
+import os
+import os.path
+import subprocess
+import sys
+import unittest
+from workspace import SAMPLE_FILES, Workspace, get_environ
+
+
+# A stand-in for the mkmk tool that logs the commands it's asked to run before
+# running them.
+_LOGGING_MKMK = """#!/bin/sh
+echo "$1" >> mkmk.log
+exec %(python)s -m mkmk.main "$@"
+"""
+
+
+class InitTest(unittest.TestCase):
+
+  def setUp(self):
+    self.workspace = Workspace(SAMPLE_FILES)
+    self.workspace.write("mkmk.sh", _LOGGING_MKMK % {"python": sys.executable})
+    os.chmod(os.path.join(self.workspace.root, "mkmk.sh"), 0755)
+    self.workspace.run("init", "--shell", "sh", "--script", "build.sh",
+      "--self", "./mkmk.sh")
+
+  def tearDown(self):
+    self.workspace.dispose()
+
+  # Runs the build script with the given arguments and returns the commands it
+  # ran mkmk for.
+  def build(self, *args):
+    log_path = os.path.join(self.workspace.root, "mkmk.log")
+    if os.path.exists(log_path):
+      os.remove(log_path)
+    subprocess.check_output(["sh", "build.sh"] + list(args),
+      cwd=self.workspace.root, env=get_environ(), stderr=subprocess.STDOUT)
+    if not os.path.exists(log_path):
+      return []
+    with open(log_path, "rt") as f:
+      return f.read().split()
+
+  # Marks the file with the given path as changed since everything else in the
+  # workspace was written, by moving everything else back in time.
+  def touch(self, path):
+    for (folder, subfolders, names) in os.walk(self.workspace.root):
+      for name in names + subfolders:
+        full_path = os.path.join(folder, name)
+        earlier = os.path.getmtime(full_path) - 100
+        os.utime(full_path, (earlier, earlier))
+    os.utime(os.path.join(self.workspace.root, path), None)
+
+  # Once the makefile has been generated python isn't started again until one
+  # of its inputs changes.
+  def test_fast_path(self):
+    self.assertEqual(["has_changed", "makefile"], self.build("run-tests"))
+    self.assertTrue(os.path.exists(os.path.join(self.workspace.root, "out",
+      "src", "main.run")))
+    self.assertEqual([], self.build("run-tests"))
+    self.touch("src/src.mkmk")
+    self.assertEqual(["has_changed", "makefile"], self.build("run-tests"))
+    self.assertEqual([], self.build("run-tests"))
+
+  # Scanned headers are inputs too, and so is the build script itself.
+  def test_other_inputs(self):
+    self.build("run-tests")
+    self.touch("src/main.h")
+    self.assertEqual(["has_changed", "makefile"], self.build("run-tests"))
+    self.touch("build.sh")
+    self.assertEqual(["has_changed", "makefile"], self.build("run-tests"))
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,116 @@
+#- Copyright 2014 GOTO 10.
+#- Licensed under the Apache License, Version 2.0 (see LICENSE).
+
+import logging
+import os
+import os.path
+import shutil
+import tempfile
+import unittest
+from mkmk import jobserver
+from workspace import SAMPLE_FILES, Workspace
+
+
+class ParseMakeflagsTest(unittest.TestCase):
+
+  def setUp(self):
+    self.fds = []
+
+  def tearDown(self):
+    for fd in self.fds:
+      try:
+        os.close(fd)
+      except OSError:
+        pass
+
+  def pipe(self):
+    (read_fd, write_fd) = os.pipe()
+    self.fds += [read_fd, write_fd]
+    return (read_fd, write_fd)
+
+  def test_no_jobserver(self):
+    self.assertEqual(None, jobserver.parse_makeflags(None))
+    self.assertEqual(None, jobserver.parse_makeflags(""))
+    self.assertEqual(None, jobserver.parse_makeflags("-j4"))
+
+  # Tokens are taken without blocking and can be given back.
+  def test_pipe(self):
+    (read_fd, write_fd) = self.pipe()
+    os.write(write_fd, "ab")
+    server = jobserver.parse_makeflags(" -j4 --jobserver-auth=%i,%i" %
+      (read_fd, write_fd))
+    self.fds.append(server.read_fd)
+    self.assertEqual(["a", "b"], server.try_acquire_many(3))
+    self.assertEqual(None, server.try_acquire())
+    server.release_all(["a", "b"])
+    self.assertEqual("a", server.try_acquire())
+
+  # Older makes call the flag --jobserver-fds.
+  def test_fds(self):
+    (read_fd, write_fd) = self.pipe()
+    os.write(write_fd, "x")
+    server = jobserver.parse_makeflags("--jobserver-fds=%i,%i -j" %
+      (read_fd, write_fd))
+    self.fds.append(server.read_fd)
+    self.assertEqual(["x"], server.try_acquire_many(1))
+
+  # Make closes the pipe for recipes that aren't marked as recursive.
+  def test_closed_pipe(self):
+    (read_fd, write_fd) = self.pipe()
+    os.close(read_fd)
+    os.close(write_fd)
+    logging.disable(logging.WARNING)
+    try:
+      self.assertEqual(None, jobserver.parse_makeflags("--jobserver-auth=%i,%i" %
+        (read_fd, write_fd)))
+    finally:
+      logging.disable(logging.NOTSET)
+
+  def test_fifo(self):
+    folder = tempfile.mkdtemp(prefix="mkmk-test-")
+    try:
+      path = os.path.join(folder, "fifo")
+      os.mkfifo(path)
+      server = jobserver.parse_makeflags("-j2 --jobserver-auth=fifo:%s" % path)
+      self.fds += [server.read_fd, server.write_fd]
+      self.assertEqual(None, server.try_acquire())
+      server.release("+")
+      self.assertEqual(["+"], server.try_acquire_many(2))
+    finally:
+      shutil.rmtree(folder, ignore_errors=True)
+
+
+class JobserverRecipeTest(unittest.TestCase):
+
+  def setUp(self):
+    files = dict(SAMPLE_FILES)
+    files["src/src.mkmk"] += "t.set_jobserver_aware()\n"
+    self.workspace = Workspace(files)
+
+  def tearDown(self):
+    self.workspace.dispose()
+
+  # Returns the recipe lines of the rule for the given target.
+  def get_recipe(self, makefile, target):
+    for block in makefile.split("\n\n"):
+      if block.startswith("%s:" % target):
+        return block.split("\n")[1:]
+    return None
+
+  # Only the commands of nodes that take part in the jobserver are marked with
+  # a '+', in both plain and lean makefiles.
+  def test_marked(self):
+    plain = self.workspace.get_makefile()
+    test = self.get_recipe(plain, "out/src/main.run")
+    self.assertEqual(["@mkdir", "@echo", "+@out/src/main", "+@cat", "+@if"],
+      [l.split()[0] for l in test])
+    self.assertEqual(["@mkdir", "@echo", "@$(CC)"],
+      [l.split()[0] for l in self.get_recipe(plain, "out/src/main")])
+    lean = self.workspace.get_makefile("--lean")
+    test = self.get_recipe(lean, "out/src/main.run")
+    self.assertEqual(1, len(test))
+    self.assertTrue(test[0].startswith("\t+@{ echo 'Running"), test)
+    self.assertTrue(self.get_recipe(lean, "out/src/main")[0].startswith("\t@{"))
+
+if __name__ == '__main__':
+  unittest.main()
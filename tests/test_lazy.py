@@ -0,0 +1,67 @@
+#- Copyright 2014 GOTO 10.
+#- Licensed under the Apache License, Version 2.0 (see LICENSE).
+
+import unittest
+from workspace import Workspace
+
+
+# Two scripts that set a pervasive flag and define the same alias, and a leaf
+# script that only defines nodes.
+_FILES = {
+  "root.mkmk": (
+    "include('a', 'a.mkmk')\n"
+    "include('b', 'b.mkmk')\n"
+    "include('c', 'c.mkmk')\n"),
+  "a/a.mkmk": (
+    "c.get_settings().add_pervasive('cflags', '-DFROM_A')\n"
+    "add_alias('objs', c.get_source_file('a.c').get_object())\n"),
+  "a/a.c": "int a;\n",
+  "b/b.mkmk": (
+    "add_alias('objs', c.get_source_file('b.c').get_object())\n"),
+  "b/b.c": "int b;\n",
+  "c/c.mkmk": (
+    "c.get_source_file('c.c').get_object()\n"),
+  "c/c.c": "int c;\n",
+}
+
+
+# Checks that loading scripts lazily gives the same makefile as loading them
+# eagerly, for the same goals.
+class LazyTest(unittest.TestCase):
+
+  def setUp(self):
+    self.workspace = Workspace(_FILES)
+
+  def tearDown(self):
+    self.workspace.dispose()
+
+  def check_goals(self, goals):
+    eager = self.workspace.get_makefile("--goals", goals)
+    self.assertEqual(eager, self.workspace.get_makefile("--goals", goals, "--lazy"))
+    return eager
+
+  def test_pervasive_settings(self):
+    makefile = self.check_goals("out/b/b.c.o")
+    self.assertIn("-DFROM_A", makefile)
+
+  # The last definition of an alias wins.
+  def test_alias(self):
+    makefile = self.check_goals("objs")
+    self.assertIn("out/b/b.c.o", makefile)
+    self.assertNotIn("out/a/a.c.o", makefile)
+
+  def test_leaf(self):
+    self.check_goals("out/c/c.c.o")
+
+  # Scripts that only define nodes aren't loaded unless they're needed.
+  def test_deferred(self):
+    output = self.workspace.run("makefile", "--goals", "objs", "--lazy",
+      "--profile")
+    self.assertIn("./b/b.mkmk", output)
+    self.assertNotIn("./c/c.mkmk", output)
+    with open("%s/out/Makefile.mkmk.deps" % self.workspace.root) as f:
+      self.assertIn("c/c.mkmk", f.read())
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,59 @@
+#- Copyright 2014 GOTO 10.
+#- Licensed under the Apache License, Version 2.0 (see LICENSE).
+
+import os
+import os.path
+import subprocess
+import unittest
+from workspace import SAMPLE_FILES, Workspace
+
+
+# The source of main in the sample tree when its test fails.
+_FAILING_MAIN = "#include \"main.h\"\nint main() { return 1; }\n"
+
+
+# Checks that building with a lean makefile does the same as building with a
+# plain one.
+class LeanTest(unittest.TestCase):
+
+  def setUp(self):
+    self.workspace = Workspace(SAMPLE_FILES)
+
+  def tearDown(self):
+    self.workspace.dispose()
+
+  # Generates the makefile with the given flags, builds the tests, and returns
+  # the output and the files produced.
+  def build(self, *args):
+    self.workspace.get_makefile(*args)
+    output = self.workspace.make("run-tests")
+    files = []
+    for (folder, subfolders, names) in os.walk(os.path.join(self.workspace.root, "out")):
+      for name in names:
+        path = os.path.relpath(os.path.join(folder, name), self.workspace.root)
+        if not path.startswith("out/Makefile.mkmk"):
+          files.append(path)
+    return (output, sorted(files))
+
+  def test_same_build(self):
+    plain = self.build()
+    self.assertEqual(plain, self.build("--lean"))
+    self.assertIn("out/src/main.run", plain[1])
+
+  def test_up_to_date(self):
+    self.build("--lean")
+    self.assertEqual("", self.workspace.make("run-tests"))
+
+  # A failing command still fails the recipe when it's folded into one line.
+  def test_failure(self):
+    self.workspace.write("src/main.c", _FAILING_MAIN)
+    for args in [[], ["--lean"]]:
+      self.workspace.get_makefile(*args)
+      self.assertRaises(subprocess.CalledProcessError, self.workspace.make,
+        "run-tests")
+      self.assertFalse(os.path.exists(os.path.join(self.workspace.root, "out",
+        "src", "main.run")))
+
+
+if __name__ == '__main__':
+  unittest.main()
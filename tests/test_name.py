@@ -0,0 +1,48 @@
+#- Copyright 2014 GOTO 10.
+#- Licensed under the Apache License, Version 2.0 (see LICENSE).
+
+import cPickle as pickle
+import unittest
+from mkmk.makefile import Name
+
+
+class NameTest(unittest.TestCase):
+
+  # Equal names are the same instance however they're created.
+  def test_interning(self):
+    name = Name.of("a", "b", "c")
+    self.assertTrue(name is Name.of("a", "b", "c"))
+    self.assertTrue(name is Name.of("a").append("b", "c"))
+    self.assertTrue(name is Name.of("b", "c").prepend("a"))
+    self.assertTrue(Name.of("a", "b").get_child("c") is name)
+    self.assertFalse(name is Name.of("a", "c", "b"))
+
+  def test_equality(self):
+    name = Name.of("a", "b")
+    self.assertEqual(Name.of("a", "b"), name)
+    self.assertEqual(hash(Name.of("a", "b")), hash(name))
+    self.assertNotEqual(Name.of("a"), name)
+    self.assertTrue(Name.of("a") < name < Name.of("b"))
+    self.assertEqual(1, len(set([name, Name.of("a").append("b")])))
+    self.assertEqual("a::b", str(name))
+
+  # Unpickled names are the interned instances, also when pickled along with
+  # other values that refer to them.
+  def test_pickling(self):
+    name = Name.of("x", "y")
+    for protocol in range(pickle.HIGHEST_PROTOCOL + 1):
+      copy = pickle.loads(pickle.dumps(name, protocol))
+      self.assertTrue(copy is name)
+      mapping = pickle.loads(pickle.dumps({name: [name, Name.of("x")]}, protocol))
+      self.assertEqual([name], mapping.keys())
+      self.assertTrue(mapping.keys()[0] is name)
+      self.assertTrue(mapping[name][1] is Name.of("x"))
+
+  def test_prefix(self):
+    self.assertTrue(Name.of("a", "b").is_prefix_of(Name.of("a", "b", "c")))
+    self.assertTrue(Name.of("a", "b").is_prefix_of(Name.of("a", "b")))
+    self.assertFalse(Name.of("a", "b").is_prefix_of(Name.of("a", "c")))
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,104 @@
+#- Copyright 2014 GOTO 10.
+#- Licensed under the Apache License, Version 2.0 (see LICENSE).
+
+import unittest
+from workspace import SAMPLE_FILES, Workspace
+
+
+# A root and two dependencies that all add pervasive settings, before and after
+# including each other.
+_PERVASIVE_FILES = {
+  "root.mkmk": (
+    "c.get_settings().add_pervasive('cflags', '-DROOT1')\n"
+    "include_dep('d', 'd.mkmk')\n"
+    "c.get_settings().add_pervasive('cflags', '-DROOT2')\n"
+    "include_dep('e', 'e.mkmk')\n"
+    "c.get_settings().add_pervasive('cflags', '-DROOT3')\n"
+    "include('m', 'm.mkmk')\n"),
+  "deps/d/d.mkmk": (
+    "c.get_settings().add_pervasive('cflags', '-DFROM_D')\n"
+    "c.get_source_file('d.c').get_object()\n"),
+  "deps/d/d.c": "int d;\n",
+  "deps/e/e.mkmk": (
+    "c.get_settings().add_pervasive('cflags', '-DFROM_E')\n"
+    "c.get_settings().add_pervasive('warnings', 'all')\n"
+    "c.get_source_file('e.c').get_object()\n"),
+  "deps/e/e.c": "int e;\n",
+  "m/m.mkmk": (
+    "obj = c.get_source_file('m.c').get_object()\n"
+    "add_alias('objs', get_dep_external('d', 'd.c:object'),\n"
+    "  get_dep_external('e', 'e.c:object'), obj)\n"),
+  "m/m.c": "int m;\n",
+}
+
+
+class ParallelTest(unittest.TestCase):
+
+  def setUp(self):
+    self.workspace = Workspace(_PERVASIVE_FILES)
+
+  def tearDown(self):
+    self.workspace.dispose()
+
+  def test_pervasive_settings(self):
+    serial = self.workspace.get_makefile()
+    self.assertIn("-DROOT1 -DFROM_D -DROOT2 -DFROM_E -DROOT3 -Wall", serial)
+    self.assertEqual(serial, self.workspace.get_makefile("--jobs", "4"))
+
+  # The dependencies only create the pervasive settings after the root has
+  # included them.
+  def test_pervasive_settings_created_by_deps(self):
+    self.workspace.write("root.mkmk",
+      "include_dep('d', 'd.mkmk')\n"
+      "include_dep('e', 'e.mkmk')\n"
+      "c.get_settings().add_pervasive('cflags', '-DROOT')\n"
+      "include('m', 'm.mkmk')\n")
+    serial = self.workspace.get_makefile()
+    self.assertIn("-DFROM_D -DFROM_E -DROOT -Wall", serial)
+    self.assertEqual(serial, self.workspace.get_makefile("--jobs", "4"))
+
+  def test_sample(self):
+    sample = Workspace(SAMPLE_FILES)
+    try:
+      self.assertEqual(sample.get_makefile(), sample.get_makefile("--jobs", "4"))
+    finally:
+      sample.dispose()
+
+  # Two dependencies include the same nested dependency, which has to be loaded
+  # once, by the first.
+  def test_shared_nested_dep(self):
+    self.workspace.write("root.mkmk",
+      "include_dep('d', 'd.mkmk')\n"
+      "include_dep('e', 'e.mkmk')\n"
+      "include('m', 'm.mkmk')\n")
+    nested = (
+      "c.get_settings().add_pervasive('cflags', '-DNESTED')\n"
+      "c.get_source_file('n.c').get_object()\n")
+    self.workspace.write("deps/d/deps/n/n.mkmk", nested)
+    self.workspace.write("deps/d/deps/n/n.c", "int n;\n")
+    self.workspace.write("deps/e/deps/n/n.mkmk", nested)
+    self.workspace.write("deps/e/deps/n/n.c", "int n;\n")
+    self.workspace.write("deps/d/d.mkmk",
+      "include_dep('n', 'n.mkmk')\n"
+      "c.get_source_file('d.c').get_object()\n")
+    self.workspace.write("deps/e/e.mkmk",
+      "include_dep('n', 'n.mkmk')\n"
+      "c.get_source_file('e.c').get_object()\n")
+    serial = self.workspace.get_makefile()
+    self.assertIn("$(CFLAGS) -DNESTED -DENABLE_CHECKS", serial)
+    self.assertNotIn("-DNESTED -DNESTED", serial)
+    self.assertEqual(serial, self.workspace.get_makefile("--jobs", "4"))
+
+  # A dependency uses the nodes of a sibling loaded before it.
+  def test_sibling_dep(self):
+    self.workspace.write("deps/e/e.mkmk",
+      "c.get_settings().add_pervasive('cflags', '-DFROM_E')\n"
+      "obj = c.get_source_file('e.c').get_object()\n"
+      "add_alias('both', obj, get_dep_external('d', 'd.c:object'))\n")
+    serial = self.workspace.get_makefile()
+    self.assertIn("both:", serial)
+    self.assertEqual(serial, self.workspace.get_makefile("--jobs", "4"))
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,129 @@
+#- Copyright 2014 GOTO 10.
+#- Licensed under the Apache License, Version 2.0 (see LICENSE).
+
+import os
+import os.path
+import shutil
+import tempfile
+import unittest
+from distutils.spawn import find_executable
+from mkmk import system
+
+
+# A pkg-config that logs its arguments before running the real one.
+_LOGGING_PKG_CONFIG = """#!/bin/sh
+echo "$*" >> %(log)s
+exec %(real)s "$@"
+"""
+
+_PC_FILES = {
+  "a.pc": (
+    "prefix=/opt/a\n"
+    "Name: a\nDescription: a\nVersion: 1.0\n"
+    "Requires: b >= 1.0\n"
+    "Libs: -la\nCflags: -I${prefix}/include\n"),
+  "b.pc": (
+    "Name: b\nDescription: b\nVersion: 1.0\n"
+    "Requires.private: c\n"
+    "Libs: -lb\n"),
+  "c.pc": (
+    "Name: c\nDescription: c\nVersion: 2.0\n"
+    "Libs: -lc\n"),
+  "d.pc": (
+    "Name: d\nDescription: d\nVersion: 1.0\n"
+    "Requires: c, b >= 1.0\n"
+    "Libs: -ld\n"),
+}
+
+
+@unittest.skipIf(find_executable("pkg-config") is None, "pkg-config isn't installed")
+class PkgConfigTest(unittest.TestCase):
+
+  def setUp(self):
+    self.root = tempfile.mkdtemp(prefix="mkmk-test-")
+    self.pc = os.path.join(self.root, "pc")
+    os.makedirs(self.pc)
+    for (name, contents) in _PC_FILES.items():
+      self.write(name, contents)
+    bin = os.path.join(self.root, "bin")
+    os.makedirs(bin)
+    self.log = os.path.join(self.root, "log")
+    with open(os.path.join(bin, "pkg-config"), "wt") as out:
+      out.write(_LOGGING_PKG_CONFIG % {
+        "log": self.log,
+        "real": find_executable("pkg-config")
+      })
+    os.chmod(os.path.join(bin, "pkg-config"), 0755)
+    self.environ = dict(os.environ)
+    os.environ["PATH"] = "%s%s%s" % (bin, os.pathsep, os.environ["PATH"])
+    os.environ["PKG_CONFIG_PATH"] = self.pc
+    os.environ.pop("PKG_CONFIG_LIBDIR", None)
+
+  def tearDown(self):
+    os.environ.clear()
+    os.environ.update(self.environ)
+    shutil.rmtree(self.root, ignore_errors=True)
+
+  def write(self, name, contents):
+    with open(os.path.join(self.pc, name), "wt") as out:
+      out.write(contents)
+
+  def get_pc_files(self, *names):
+    return [os.path.join(self.pc, "%s.pc" % n) for n in names]
+
+  def read_log(self):
+    with open(self.log, "rt") as f:
+      return f.read().splitlines()
+
+  def test_requires(self):
+    self.assertEqual(["b"], system.read_pc_requires(self.get_pc_files("a")[0]))
+    self.assertEqual(["c"], system.read_pc_requires(self.get_pc_files("b")[0]))
+    self.assertEqual(["c", "b"], system.read_pc_requires(self.get_pc_files("d")[0]))
+
+  # The files of a library include everything it requires, indirectly and
+  # privately too, and the folders that were searched.
+  def test_closure(self):
+    search_path = system.PkgConfigSearchPath()
+    (includes, libs, files) = system.PkgConfigQuery("a", search_path).get_result()
+    self.assertEqual(["/opt/a/include"], includes)
+    self.assertEqual(["a", "b"], libs)
+    for path in self.get_pc_files("a", "b", "c") + [self.pc]:
+      self.assertIn(path, files)
+    self.assertNotIn(self.get_pc_files("d")[0], files)
+
+  # Resolving libraries runs pkg-config once for each and once for the search
+  # path they share.
+  def test_processes(self):
+    posix = system.PosixSystem("posix")
+    posix.prefetch_libraries(["a", "d"])
+    posix.auto_resolve_library("a")
+    posix.auto_resolve_library("d")
+    self.assertEqual(["--cflags --libs a", "--cflags --libs d",
+      "--variable=pc_path pkg-config"], sorted(self.read_log()))
+
+  # Cache entries become invalid when a library the library only requires
+  # indirectly changes.
+  def test_cache(self):
+    cache = system.LibraryCache(os.path.join(self.root, "cache"))
+    posix = system.PosixSystem("posix")
+    posix.set_library_cache(cache)
+    result = posix.auto_resolve_library("a")
+    self.assertEqual(result, cache.get("a"))
+    self.write("c.pc", _PC_FILES["c.pc"].replace("2.0", "2.1"))
+    (c_pc,) = self.get_pc_files("c")
+    os.utime(c_pc, (os.path.getmtime(c_pc) + 10,) * 2)
+    self.assertEqual(None, cache.get("a"))
+
+  # PKG_CONFIG_LIBDIR replaces the default search path, which then doesn't
+  # have to be looked up.
+  def test_libdir(self):
+    os.environ["PKG_CONFIG_PATH"] = ""
+    os.environ["PKG_CONFIG_LIBDIR"] = self.pc
+    search_path = system.PkgConfigSearchPath()
+    (includes, libs, files) = system.PkgConfigQuery("c", search_path).get_result()
+    self.assertEqual([self.pc] + self.get_pc_files("c"), files)
+    self.assertEqual(["--cflags --libs c"], self.read_log())
+
+
+if __name__ == '__main__':
+  unittest.main()
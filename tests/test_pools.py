@@ -0,0 +1,61 @@
+#- Copyright 2014 GOTO 10.
+#- Licensed under the Apache License, Version 2.0 (see LICENSE).
+
+import os
+import os.path
+import shutil
+import subprocess
+import tempfile
+import unittest
+from mkmk import system
+
+
+# A job that records how many jobs, including itself, were running when it
+# started.
+_JOB = (
+  "touch running/$$; ls running | wc -l >> counts; sleep 0.1; rm running/$$")
+
+
+class PosixPoolTest(unittest.TestCase):
+
+  def setUp(self):
+    self.root = tempfile.mkdtemp(prefix="mkmk-test-")
+    os.mkdir(os.path.join(self.root, "running"))
+
+  def tearDown(self):
+    shutil.rmtree(self.root, ignore_errors=True)
+
+  # Runs the given number of jobs at once through the pool script with the given
+  # contents and returns the most that ran at the same time.
+  def run_jobs(self, script, count):
+    path = os.path.join(self.root, "pool.sh")
+    with open(path, "wt") as out:
+      out.write(script)
+    processes = [subprocess.Popen(["sh", path, _JOB], cwd=self.root)
+      for i in range(count)]
+    for process in processes:
+      self.assertEqual(0, process.wait())
+    with open(os.path.join(self.root, "counts"), "rt") as f:
+      counts = [int(line) for line in f.read().split()]
+    self.assertEqual(count, len(counts))
+    return max(counts)
+
+  def test_depth(self):
+    script = system.PosixSystem("posix").get_pool_script(2)
+    self.assertTrue(self.run_jobs(script, 12) <= 2)
+
+  # Without the flock tool the script falls back to python.
+  def test_depth_without_flock(self):
+    script = system.PosixSystem("posix").get_pool_script(2)
+    script = script.replace("command -v flock", "command -v no-such-flock")
+    self.assertTrue(self.run_jobs(script, 12) <= 2)
+
+  def test_status(self):
+    path = os.path.join(self.root, "pool.sh")
+    with open(path, "wt") as out:
+      out.write(system.PosixSystem("posix").get_pool_script(1))
+    self.assertEqual(3, subprocess.call(["sh", path, "exit 3"]))
+
+
+if __name__ == '__main__':
+  unittest.main()
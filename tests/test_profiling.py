@@ -0,0 +1,114 @@
+#- Copyright 2014 GOTO 10.
+#- Licensed under the Apache License, Version 2.0 (see LICENSE).
+
+import json
+import os.path
+import StringIO
+import unittest
+from mkmk import profiling
+from workspace import SAMPLE_FILES, Workspace
+
+
+class ProfilerTest(unittest.TestCase):
+
+  def test_disabled(self):
+    profiler = profiling.Profiler()
+    with profiler.phase("outer"):
+      pass
+    self.assertEqual({}, profiler.stats)
+
+  # A nested phase's time is counted as part of the outer phase's total but not
+  # as part of its self time.
+  def test_nesting(self):
+    profiler = profiling.Profiler()
+    profiler.enable()
+    with profiler.phase("outer"):
+      with profiler.phase("inner"):
+        pass
+      with profiler.phase("inner"):
+        pass
+    outer = profiler.stats["outer"]
+    inner = profiler.stats["inner"]
+    self.assertEqual(1, outer.count)
+    self.assertEqual(2, inner.count)
+    self.assertAlmostEqual(outer.wall, outer.self_wall + inner.wall)
+
+  # A phase that's already active, a script including another script say, only
+  # has its total time counted once.
+  def test_recursion(self):
+    profiler = profiling.Profiler()
+    profiler.enable()
+    with profiler.phase("script"):
+      with profiler.phase("script"):
+        pass
+    stats = profiler.stats["script"]
+    self.assertEqual(2, stats.count)
+    self.assertAlmostEqual(stats.wall, stats.self_wall)
+
+
+class CountersTest(unittest.TestCase):
+
+  def test_hit_rate(self):
+    self.assertEqual(None, profiling.get_hit_rate(0, 0))
+    self.assertEqual(75.0, profiling.get_hit_rate(3, 1))
+
+  def test_write_counters(self):
+    out = StringIO.StringIO()
+    profiling.write_counters(out, {"stat calls": 12, "exists cache hits": 1,
+      "exists probes": 3})
+    self.assertEqual([
+      "Counters:",
+      "           1  exists cache hits",
+      "           3  exists probes",
+      "          12  stat calls",
+      "       25.0%  exists() cache hit rate",
+    ], out.getvalue().splitlines())
+
+
+# Checks that profiling and counters cost nothing unless asked for.
+class ProfileFlagTest(unittest.TestCase):
+
+  def setUp(self):
+    self.workspace = Workspace(SAMPLE_FILES)
+
+  def tearDown(self):
+    self.workspace.dispose()
+
+  def get_stats_path(self):
+    return os.path.join(self.workspace.root, "out", "Makefile.mkmk.stats")
+
+  def test_off_by_default(self):
+    output = self.workspace.run("makefile")
+    self.assertNotIn("Phases:", output)
+    self.assertNotIn("Counters:", output)
+    self.assertFalse(os.path.exists(self.get_stats_path()))
+
+  def test_profile(self):
+    output = self.workspace.run("makefile", "--profile")
+    self.assertIn("Phases:", output)
+    self.assertIn("evaluating build scripts", output)
+    self.assertIn("writing makefile", output)
+    self.assertIn("Build scripts:", output)
+    self.assertIn("root.mkmk", output)
+    # Profiling times the phases but doesn't keep counters.
+    self.assertNotIn("Counters:", output)
+    self.assertFalse(os.path.exists(self.get_stats_path()))
+
+  def test_stats(self):
+    output = self.workspace.run("makefile", "--stats")
+    self.assertIn("Counters:", output)
+    self.assertNotIn("Phases:", output)
+    with open(self.get_stats_path(), "rt") as f:
+      counters = json.load(f)
+    for name in ["stat calls", "exists probes", "files opened",
+        "get_flat_edges calls", "Settings.get calls"]:
+      self.assertTrue(counters.get(name, 0) > 0, name)
+    # The sources are each read once, when scanning for includes.
+    sources = [SAMPLE_FILES[p] for p in ["src/main.c", "src/main.h",
+      "deps/foo/lib/lib.c"]]
+    self.assertEqual(len(sources), counters["files opened"])
+    self.assertEqual(sum([len(s) for s in sources]), counters["bytes read"])
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,105 @@
+#- Copyright 2014 GOTO 10.
+#- Licensed under the Apache License, Version 2.0 (see LICENSE).
+
+import json
+import os
+import os.path
+import socket
+import time
+import unittest
+from mkmk import main
+from mkmk import server
+from workspace import CHANGED_MAIN, SAMPLE_FILES, Workspace
+
+
+# How long to wait for the server to start listening, in seconds.
+_START_TIMEOUT = 20
+
+
+class ServerTest(unittest.TestCase):
+
+  def setUp(self):
+    self.workspace = Workspace(SAMPLE_FILES)
+    self.plain = self.workspace.get_makefile()
+    self.socket_path = os.path.join(self.workspace.root, "mkmk.sock")
+    self.log = open(os.path.join(self.workspace.root, "server.log"), "wt")
+    self.server = self.workspace.start(self.log, "serve", "--socket", "mkmk.sock")
+    deadline = time.time() + _START_TIMEOUT
+    while not os.path.exists(self.socket_path):
+      self.assertTrue(self.server.poll() is None, "server exited")
+      self.assertTrue(time.time() < deadline, "server didn't start")
+      time.sleep(0.05)
+    self.cwd = os.getcwd()
+    # The options key includes the working directory.
+    os.chdir(self.workspace.root)
+
+  def tearDown(self):
+    os.chdir(self.cwd)
+    if self.server.poll() is None:
+      self.server.kill()
+      self.server.wait()
+    self.log.close()
+    self.workspace.dispose()
+
+  def get_options(self, *args):
+    return main.MkMk(self.workspace.get_arguments("makefile", "--socket",
+      "mkmk.sock", *args)).options
+
+  # Asks the server to generate the makefile and returns it, or None if the
+  # server wouldn't.
+  def request_makefile(self, *args):
+    self.workspace.clean()
+    if server.try_request(self.get_options(*args), "makefile") is None:
+      return None
+    return self.workspace.read_makefile()
+
+  # Sends the given raw message to the server and returns its response.
+  def send(self, message):
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+      client.connect(self.socket_path)
+      client.sendall(message)
+      client.shutdown(socket.SHUT_WR)
+      return json.loads(server.read_message(client))
+    finally:
+      client.close()
+
+  def test_makefile(self):
+    self.assertEqual(self.plain, self.request_makefile())
+
+  # Changes to sources and to scripts are picked up by the next request.
+  def test_reload(self):
+    self.assertEqual(self.plain, self.request_makefile())
+    self.workspace.write("src/main.c", CHANGED_MAIN)
+    makefile = self.request_makefile()
+    self.assertIn("./src/other.h", makefile)
+    self.workspace.write("src/src.mkmk", SAMPLE_FILES["src/src.mkmk"] +
+      "c.get_source_file('other.c').get_object()\n")
+    self.workspace.write("src/other.c", "int other;\n")
+    makefile = self.request_makefile()
+    self.assertIn("out/src/other.c.o", makefile)
+    os.chdir(self.cwd)
+    self.assertEqual(self.workspace.get_makefile(), makefile)
+
+  # Clients whose options would give a different makefile are turned away.
+  def test_options_key(self):
+    self.assertEqual(None, self.request_makefile("--noisy"))
+    self.assertEqual(None, self.request_makefile("--lean"))
+    self.assertNotEqual(server.get_options_key(self.get_options()),
+      server.get_options_key(self.get_options("--buildflags=--debug")))
+    self.assertEqual(self.plain, self.request_makefile())
+
+  def test_malformed_request(self):
+    self.assertEqual("error", self.send("not json")["status"])
+    self.assertEqual("error", self.send("[1, 2]")["status"])
+    self.assertEqual("error", self.send("")["status"])
+    self.assertEqual(self.plain, self.request_makefile())
+
+  def test_stop(self):
+    self.assertTrue(server.try_request(self.get_options(), "stop") is not None)
+    self.assertEqual(0, self.server.wait())
+    self.assertFalse(os.path.exists(self.socket_path))
+
+
+if __name__ == '__main__':
+  unittest.main()
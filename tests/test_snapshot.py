@@ -0,0 +1,53 @@
+#- Copyright 2014 GOTO 10.
+#- Licensed under the Apache License, Version 2.0 (see LICENSE).
+
+import os
+import unittest
+from workspace import CHANGED_MAIN, SAMPLE_FILES, Workspace
+
+
+class SnapshotTest(unittest.TestCase):
+
+  def setUp(self):
+    self.workspace = Workspace(SAMPLE_FILES)
+
+  def tearDown(self):
+    self.workspace.dispose()
+
+  def test_snapshot(self):
+    plain = self.workspace.get_makefile()
+    self.assertEqual(plain, self.workspace.get_makefile("--snapshot"))
+    output = self.workspace.run("makefile", "--snapshot", "--profile")
+    self.assertIn("loading snapshot", output)
+    self.assertNotIn("evaluating build scripts", output)
+    self.assertEqual(plain, self.workspace.read_makefile())
+
+  # Headers are scanned after the snapshot is loaded so changing which headers
+  # a source includes doesn't require the scripts to be evaluated again.
+  def test_snapshot_after_include_change(self):
+    self.workspace.get_makefile("--snapshot")
+    self.workspace.write("src/main.c", CHANGED_MAIN)
+    self.workspace.run("makefile", "--snapshot")
+    snapshot = self.workspace.read_makefile()
+    self.assertIn("./src/other.h", snapshot)
+    self.assertEqual(self.workspace.get_makefile(), snapshot)
+
+  # A snapshot that was cut short is ignored and replaced with a complete one.
+  def test_truncated_snapshot(self):
+    plain = self.workspace.get_makefile("--snapshot")
+    path = os.path.join(self.workspace.root, "out", "Snapshot.mkmk")
+    with open(path, "rb") as f:
+      data = f.read()
+    with open(path, "wb") as f:
+      f.write(data[:len(data) // 2])
+    self.workspace.run("makefile", "--snapshot")
+    self.assertEqual(plain, self.workspace.read_makefile())
+    output = self.workspace.run("makefile", "--snapshot", "--profile")
+    self.assertIn("loading snapshot", output)
+    self.assertNotIn("evaluating build scripts", output)
+    self.assertEqual([], [n for n in os.listdir(os.path.dirname(path))
+      if n.endswith(".tmp")])
+
+
+if __name__ == '__main__':
+  unittest.main()
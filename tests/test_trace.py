@@ -0,0 +1,56 @@
+#- Copyright 2014 GOTO 10.
+#- Licensed under the Apache License, Version 2.0 (see LICENSE).
+
+import json
+import os.path
+import unittest
+from mkmk import history
+from mkmk import timeline
+from workspace import SAMPLE_FILES, Workspace
+
+
+class TraceTest(unittest.TestCase):
+
+  def setUp(self):
+    self.workspace = Workspace(SAMPLE_FILES)
+
+  def tearDown(self):
+    self.workspace.dispose()
+
+  # Each node is recorded once however many commands its recipe has.
+  def test_one_event_per_node(self):
+    self.workspace.get_makefile("--trace")
+    self.workspace.make("run-tests")
+    log_path = os.path.join(self.workspace.root, "out", "Trace.log")
+    names = sorted([e.name for e in timeline.read_log(log_path)])
+    self.assertEqual(["lib::lib.c:object", "src::main", "src::main.c:object",
+      "src::main:test"], names)
+    self.workspace.run("trace")
+    with open(os.path.join(self.workspace.root, "out", "trace.json"), "rt") as f:
+      events = json.load(f)["traceEvents"]
+    self.assertEqual(names, sorted([e["name"] for e in events if e["ph"] == "X"]))
+
+  # The durations of the jobs in the trace log end up in the build history,
+  # keyed by their output like those recorded by farm builds.
+  def test_history(self):
+    self.workspace.get_makefile("--trace")
+    self.workspace.make("run-tests")
+    self.workspace.run("trace")
+    build_history = history.BuildHistory(history.get_history_path(
+      os.path.join(self.workspace.root, "out")))
+    self.assertEqual(["out/deps/foo/lib/lib.c.o", "out/src/main",
+      "out/src/main.c.o", "out/src/main.run"], sorted(build_history.entries.keys()))
+    self.assertTrue(build_history.get_duration("out/src/main") >= 0)
+
+  # Lines written without sub-second times are read as whole seconds.
+  def test_whole_seconds(self):
+    log_path = os.path.join(self.workspace.root, "Trace.log")
+    with open(log_path, "wt") as out:
+      out.write("10 12 0 out/a a\n10.5 11.25 1 out/b b\n")
+    events = timeline.read_log(log_path)
+    self.assertEqual([(10.0, 12.0, 0, "out/a"), (10.5, 11.25, 1, "out/b")],
+      [(e.start, e.end, e.args["status"], e.args["output"]) for e in events])
+
+
+if __name__ == '__main__':
+  unittest.main()
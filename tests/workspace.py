@@ -0,0 +1,132 @@
+#- Copyright 2014 GOTO 10.
+#- Licensed under the Apache License, Version 2.0 (see LICENSE).
+
+## Helpers for tests that run mkmk on small workspaces.
+
+import os
+import os.path
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+
+
+# The root of the mkmk checkout, which has to be on the python path for mkmk to
+# be runnable as a module.
+_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+# The attribute cache line holds modification times so it's left out when
+# makefiles are compared.
+_META_RE = re.compile(r"^# META: .*$", re.MULTILINE)
+
+
+# A small tree with a root, a dependency, an executable whose source includes
+# a header, and a test.
+SAMPLE_FILES = {
+  "root.mkmk": (
+    "c.get_settings().add_pervasive('cflags', '-DROOT')\n"
+    "include_dep('foo', 'foo.mkmk')\n"
+    "include('src', 'src.mkmk')\n"),
+  "deps/foo/foo.mkmk": (
+    "include('lib', 'lib.mkmk')\n"),
+  "deps/foo/lib/lib.mkmk": (
+    "add_alias('lib', c.get_source_file('lib.c').get_object())\n"),
+  "deps/foo/lib/lib.c": "int lib;\n",
+  "src/src.mkmk": (
+    "main = c.get_source_file('main.c')\n"
+    "main.add_include(get_root().get_child('src'))\n"
+    "exe = c.get_executable('main')\n"
+    "exe.add_object(main.get_object())\n"
+    "exe.add_object(get_dep_external('foo', 'lib', 'lib.c:object'))\n"
+    "t = test.get_exec_test_case('main')\n"
+    "t.set_runner(exe)\n"
+    "add_alias('run-tests', t)\n"),
+  "src/main.c": "#include \"main.h\"\nint main() { return 0; }\n",
+  "src/main.h": "#define MAIN 1\n",
+  "src/other.h": "#define OTHER 1\n",
+}
+
+
+# The source of main in the sample tree after it starts including a second
+# header.
+CHANGED_MAIN = "#include \"main.h\"\n#include \"other.h\"\nint main() { return 0; }\n"
+
+
+# Returns the environment to run mkmk in, with mkmk on the python path.
+def get_environ():
+  result = dict(os.environ)
+  result["PYTHONPATH"] = _ROOT
+  return result
+
+
+# A temporary folder holding build scripts and sources.
+class Workspace(object):
+
+  def __init__(self, files):
+    self.root = tempfile.mkdtemp(prefix="mkmk-test-")
+    for (path, contents) in files.items():
+      self.write(path, contents)
+
+  def write(self, path, contents):
+    full_path = os.path.join(self.root, path)
+    parent = os.path.dirname(full_path)
+    if not os.path.exists(parent):
+      os.makedirs(parent)
+    with open(full_path, "wt") as out:
+      out.write(contents)
+
+  # Returns the arguments to mkmk that run the given command in the workspace.
+  @staticmethod
+  def get_arguments(command, *args):
+    return [command, "--config", "root.mkmk", "--bindir", "out", "--makefile",
+      "out/Makefile.mkmk", "--extension", "c", "--extension", "test",
+      "--buildflags="] + list(args)
+
+  # Runs the given mkmk command in the workspace and returns its output.
+  def run(self, command, *args):
+    line = [sys.executable, "-m", "mkmk.main"] + self.get_arguments(command, *args)
+    return subprocess.check_output(line, cwd=self.root, env=get_environ(),
+      stderr=subprocess.STDOUT)
+
+  # Starts the given mkmk command in the workspace without waiting for it to
+  # complete, with its output going to the given file.
+  def start(self, out, command, *args):
+    line = [sys.executable, "-m", "mkmk.main"] + self.get_arguments(command, *args)
+    return subprocess.Popen(line, cwd=self.root, env=get_environ(), stdout=out,
+      stderr=subprocess.STDOUT)
+
+  # Runs make on the generated makefile with the given arguments and returns its
+  # output.
+  def make(self, *args):
+    line = ["make", "-s", "-f", "out/Makefile.mkmk"] + list(args)
+    return subprocess.check_output(line, cwd=self.root, stderr=subprocess.STDOUT)
+
+  # Generates the makefile with the given flags in a clean bindir and returns
+  # its contents, without the attribute cache.
+  def get_makefile(self, *args):
+    self.clean()
+    self.run("makefile", *args)
+    return self.read_makefile()
+
+  # Returns the contents of the current makefile, without the attribute cache
+  # and with any fragments it includes inlined.
+  def read_makefile(self):
+    return _META_RE.sub("", self.read_inlined("out/Makefile.mkmk"))
+
+  def read_inlined(self, path):
+    lines = []
+    with open(os.path.join(self.root, path), "rt") as f:
+      for line in f:
+        if line.startswith("include "):
+          lines.append(self.read_inlined(line[len("include "):].strip()))
+        else:
+          lines.append(line)
+    return "".join(lines)
+
+  def clean(self):
+    shutil.rmtree(os.path.join(self.root, "out"), ignore_errors=True)
+
+  def dispose(self):
+    shutil.rmtree(self.root, ignore_errors=True)